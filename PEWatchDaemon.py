@@ -7,12 +7,14 @@ sys.path.append(os.path.dirname(__file__))
 
 from app.common import *
 from app.daemon import Daemon as MainWorker
+from app.monitor import PRESSURE_HIGH
 
 from app.config import *
 
 from PyTango import DeviceProxy, DevFailed, Device_4Impl, DeviceClass, DevState
 from PyTango.server import Device, DeviceMeta, run, attribute, command
 
+import json
 import threading
 
 # main debug level
@@ -26,6 +28,43 @@ class PeWatchDaemon(Device, Tester):
 
     NumThreads = attribute(label="Server Total Thread number", dtype=int, fget="getbase_threads")
 
+    Schedule = attribute(doc="Per plugin schedule - period, runs, missed runs, last and maximum lateness, skipped and overlapping runs", dtype=str,
+                         fget="getbase_schedule")
+
+    Bandwidth = attribute(doc="Bandwidth limit of the remote copies (0 - no limit)", dtype=float, unit="MB/s",
+                          fget="get_bandwidth", fset="set_bandwidth")
+
+    SpoolState = attribute(doc="Write-behind spool - queued and active folders, concurrency, throughput", dtype=str,
+                           fget="getbase_spool")
+
+    RamDisk = attribute(doc="RAM disk pressure - used space of the local directories and the backlog of the stages",
+                        dtype=str, fget="getbase_ramdisk")
+
+    # per stage metrics - spectra in the order of StageNames, pushed as change events
+    StageNames = attribute(doc="Names of the stages of the metrics spectra", dtype=(str,), max_dim_x=16,
+                           fget="get_stage_names")
+    StageLatencyP50 = attribute(doc="Median time per frame of every stage", dtype=(float,), max_dim_x=16, unit="s",
+                                fget="get_stage_p50")
+    StageLatencyP90 = attribute(doc="90th percentile of the time per frame of every stage", dtype=(float,), max_dim_x=16,
+                                unit="s", fget="get_stage_p90")
+    StageLatencyP99 = attribute(doc="99th percentile of the time per frame of every stage", dtype=(float,), max_dim_x=16,
+                                unit="s", fget="get_stage_p99")
+    StageFrameRate = attribute(doc="Frames per second of every stage (sliding window)", dtype=(float,), max_dim_x=16,
+                               unit="1/s", fget="get_stage_fps")
+    StageThroughput = attribute(doc="MB per second of every stage (sliding window)", dtype=(float,), max_dim_x=16,
+                                unit="MB/s", fget="get_stage_mbps")
+    QueueNames = attribute(doc="Names of the queues of QueueDepths", dtype=(str,), max_dim_x=16,
+                           fget="get_queue_names")
+    QueueDepths = attribute(doc="Number of frames or folders waiting in every queue", dtype=(int,), max_dim_x=16,
+                            fget="get_queue_depths")
+    BytesMoved = attribute(doc="Total number of bytes copied to the output", dtype=float, unit="B",
+                           fget="get_bytes_moved")
+
+    StartupTimes = attribute(doc="Import and setup time of each plugin, s", dtype=str, fget="getbase_startup")
+
+    CopyRates = attribute(doc="Throughput of the finalize copies per destination directory, MB/s", dtype=str,
+                          fget="getbase_copy_rates")
+
     # additional attributes
     DirRaw = attribute(doc="Local directory containing raw detector data", dtype=str,
                        fget="get_rawdir", fset="set_rawdir")
@@ -45,6 +84,11 @@ class PeWatchDaemon(Device, Tester):
 
     THREAD_DEMON = None
 
+    # attribute name - key of the worker metrics
+    METRIC_ATTRIBUTES = (("StageLatencyP50", "p50"), ("StageLatencyP90", "p90"), ("StageLatencyP99", "p99"),
+                         ("StageFrameRate", "fps"), ("StageThroughput", "mbps"),
+                         ("QueueNames", "queues"), ("QueueDepths", "depths"), ("BytesMoved", "bytes"))
+
     logger = None
 
     def init_device(self):
@@ -58,10 +102,22 @@ class PeWatchDaemon(Device, Tester):
         self.worker = self.get_worker()
         self.thread = None
 
+        # metrics are pushed by a thread, the clients do not need to poll
+        self.metrics, self.last_pushed = {}, {}
+        self.metrics_stop = threading.Event()
+        for (name, key) in self.METRIC_ATTRIBUTES:
+            self.set_change_event(name, True, False)
+
+        th = threading.Thread(target=self.push_metrics, name="metrics_pusher")
+        th.setDaemon(True)
+        self.metrics_thread = th
+        th.start()
+
         self.Start()
 
     def delete_device(self):
         self.logger.debug("Server is stopped")
+        self.metrics_stop.set()
         self.Stop()
 
     @command()
@@ -111,12 +167,113 @@ class PeWatchDaemon(Device, Tester):
         self.set_state(DevState.ON)
         return DevState.ON
 
+    @command(dtype_in=str, dtype_out=str)
+    def FindFrame(self, name):
+        """
+        Returns the indexed copies of a frame - remote path, scan, size, checksum, header and timestamps as json
+        """
+        return json.dumps(self.worker.find_frame(name))
+
+    @command(dtype_in=str, dtype_out=int)
+    def CountFrames(self, scan):
+        """
+        Returns the number of indexed frames of a scan
+        """
+        return self.worker.count_frames(scan)
+
+    @command(dtype_out=str)
+    def ListScans(self):
+        """
+        Returns the summary of the indexed scans as json - frames, first and last frame number, bytes
+        """
+        return json.dumps(self.worker.get_scans_info())
+
     def getbase_tick_tack(self):
         return self.worker.TICKTACK / self.worker.MULTIPLIER
 
     def getbase_threads(self):
         return len(threading.enumerate())
 
+    def getbase_schedule(self):
+        return self.worker.get_schedule_info()
+
+    def getbase_copy_rates(self):
+        return self.worker.get_copy_info()
+
+    def getbase_startup(self):
+        return self.worker.get_startup_info()
+
+    def getbase_spool(self):
+        return self.worker.get_spool_info()
+
+    def getbase_ramdisk(self):
+        return self.worker.get_pressure_info()
+
+    def push_metrics(self):
+        """
+        Pushes the change events of the metrics attributes which have changed
+        """
+        while not self.metrics_stop.is_set():
+            try:
+                metrics = self.worker.get_metrics()
+                self.metrics = metrics
+
+                for (name, key) in self.METRIC_ATTRIBUTES:
+                    value = metrics[key]
+                    if value != self.last_pushed.get(name):
+                        self.push_change_event(name, value)
+                        self.last_pushed[name] = value
+            except DevFailed as e:
+                self.logger.error("Could not push the metrics: {}".format(e))
+
+            self.metrics_stop.wait(METRICS_PUSH_INTERVAL)
+
+    def get_metric(self, key):
+        metrics = self.metrics
+        if key not in metrics:
+            metrics = self.worker.get_metrics()
+        return metrics[key]
+
+    def get_stage_names(self):
+        return self.get_metric("stages")
+
+    def get_stage_p50(self):
+        return self.get_metric("p50")
+
+    def get_stage_p90(self):
+        return self.get_metric("p90")
+
+    def get_stage_p99(self):
+        return self.get_metric("p99")
+
+    def get_stage_fps(self):
+        return self.get_metric("fps")
+
+    def get_stage_mbps(self):
+        return self.get_metric("mbps")
+
+    def get_queue_names(self):
+        return self.get_metric("queues")
+
+    def get_queue_depths(self):
+        return self.get_metric("depths")
+
+    def get_bytes_moved(self):
+        return float(self.get_metric("bytes"))
+
+    def dev_state(self):
+        """
+        Running device goes into the ALARM state while the RAM disk is under pressure or if a plugin could not be loaded,
+        the device is in the FAULT state if no plugin could be loaded
+        """
+        state = self.get_state()
+        errors = self.worker.get_plugin_errors()
+        if len(errors) > 0 and self.worker.get_plugin_count() == 0:
+            state = DevState.FAULT
+        elif state == DevState.RUNNING and (len(errors) > 0 or self.worker.get_pressure_level() >= PRESSURE_HIGH):
+            state = DevState.ALARM
+        return state
+
     def get_worker(self):
         res = None
         try:
@@ -149,6 +306,25 @@ class PeWatchDaemon(Device, Tester):
 
         return res
 
+    def get_bandwidth(self):
+        """
+        Returns the bandwidth limit from the worker
+        :return:
+        """
+        self.logger.debug("Running ({})".format(sys._getframe().f_code.co_name))
+        worker = self.get_worker()
+
+        try:
+            res = float(worker.bandwidth)
+        except ValueError:
+            # fail safe
+            res = CONFIG_INI_BANDWIDTH
+            worker.bandwidth = res
+
+            self.logger.error("Failsafe to default values ({})".format(res))
+
+        return res
+
     def get_rawdir(self):
         """
         Returns the rawdir value from the worker
@@ -275,6 +451,28 @@ class PeWatchDaemon(Device, Tester):
             self.logger.error(msg)
             raise ValueError(msg)
 
+    def set_bandwidth(self, value):
+        """
+        Sets the bandwidth limit of the worker
+        :param value:
+        :return:
+        """
+        self.logger.debug("Running ({})".format(sys._getframe().f_code.co_name))
+        worker = self.get_worker()
+        self.logger.info("Setting the worker to the value ({}:{})".format(value, type(value)))
+
+        try:
+            value = float(value)
+            if value >= 0:
+                worker.bandwidth = value
+            else:
+                raise ValueError
+        except ValueError:
+            # fail safe
+            msg = "Wrong value was given ({} : {}) - must not be negative".format(value, type(value))
+            self.logger.error(msg)
+            raise ValueError(msg)
+
     def set_rawdir(self, value):
         """
         Sets the rawdir value from the worker
@@ -5,16 +5,235 @@ import sys
 import re
 import time
 import glob
+import atexit
 import logging
+import logging.handlers
 import stat
+import threading
+
+try:
+    # python v2
+    import Queue as queue
+except ImportError:
+    import queue
+
+try:
+    # posix
+    import fcntl
+    msvcrt = None
+except ImportError:
+    # windows
+    fcntl = None
+    import msvcrt
 
 import app.config as config
 
 DEBUG_LEVEL = None
 
+LOG_FORMAT = '%(asctime)s %(levelname)-8s %(process)-8d %(thread)-10d %(threadName)-16s %(name)-12s: %(message)s'
+LOG_DATEFMT = '%m-%d %H:%M'
+
+if hasattr(logging.handlers, "QueueHandler"):
+    # python v3
+    QueueHandler, QueueListener = logging.handlers.QueueHandler, logging.handlers.QueueListener
+else:
+    class QueueHandler(logging.Handler):
+        """
+        Puts the records into a queue - python v2 counterpart of logging.handlers.QueueHandler
+        """
+        def __init__(self, queue):
+            logging.Handler.__init__(self)
+            self.queue = queue
+
+        def prepare(self, record):
+            # the message is merged with its arguments in the calling thread, the arguments may change later
+            msg = self.format(record)
+            record.msg, record.message = msg, msg
+            record.args, record.exc_info = None, None
+            return record
+
+        def emit(self, record):
+            try:
+                self.queue.put_nowait(self.prepare(record))
+            except Exception:
+                self.handleError(record)
+
+    class QueueListener(object):
+        """
+        Hands the queued records to the handlers in a single thread - python v2 counterpart of logging.handlers.QueueListener
+        """
+        _sentinel = None
+
+        def __init__(self, queue, *handlers, **kwargs):
+            self.queue = queue
+            self.handlers = handlers
+            self._thread = None
+
+        def start(self):
+            self._thread = threading.Thread(target=self._monitor, name="log_listener")
+            self._thread.setDaemon(True)
+            self._thread.start()
+
+        def handle(self, record):
+            for handler in self.handlers:
+                if record.levelno >= handler.level:
+                    handler.handle(record)
+
+        def _monitor(self):
+            while True:
+                record = self.queue.get(True)
+                if record is self._sentinel:
+                    break
+                self.handle(record)
+
+        def stop(self):
+            self.queue.put_nowait(self._sentinel)
+            self._thread.join()
+            self._thread = None
+
+
+class LogRouter(logging.Handler):
+    """
+    Writes the records to the console and to the log file registered for their logger
+    Log files are opened once and shared by all the loggers and threads using them
+    """
+    def __init__(self):
+        logging.Handler.__init__(self)
+
+        fmtr = logging.Formatter(LOG_FORMAT, LOG_DATEFMT)
+
+        self.console = logging.StreamHandler()
+        self.console.setFormatter(fmtr)
+
+        # logger name - file name, file name - handler
+        self.files = {}
+        self.handlers = {}
+
+        self.formatter_file = logging.Formatter(LOG_FORMAT)
+
+    def add_file(self, name, filename):
+        """
+        Registers the log file of a logger, the file is truncated when it is opened for the first time
+        :param name: logger name
+        :param filename:
+        :return:
+        """
+        with self.lock:
+            if filename not in self.handlers:
+                # the log directory is not a part of the checkout
+                path = os.path.dirname(filename)
+                if len(path) > 0 and not os.path.isdir(path):
+                    os.makedirs(path)
+
+                fh = logging.FileHandler(filename, "w")
+                fh.setFormatter(self.formatter_file)
+                self.handlers[filename] = fh
+            self.files[name] = filename
+
+    def emit(self, record):
+        self.console.handle(record)
+
+        fh = self.handlers.get(self.files.get(record.name))
+        if fh is not None:
+            fh.handle(record)
+
+    def close(self):
+        for fh in list(self.handlers.values()):
+            fh.close()
+        self.console.close()
+        logging.Handler.close(self)
+
+
+# one router for the process, records are written by a single listener thread if the logging is asynchronous
+_LOG_ROUTER = None
+_LOG_LISTENER = None
+_LOG_LOCK = threading.Lock()
+
+
+def start_logging(level=logging.DEBUG):
+    """
+    Installs the shared handlers on the root logger, replaces logging.basicConfig - called once per process
+    The loggers only put their records into a queue if config.LOG_ASYNC is set
+    :param level: level of the root logger
+    :return: router of the records
+    """
+    global _LOG_ROUTER, _LOG_LISTENER
+    with _LOG_LOCK:
+        if _LOG_ROUTER is not None:
+            return _LOG_ROUTER
+
+        router = LogRouter()
+
+        root = logging.getLogger()
+        root.setLevel(level)
+
+        if config.LOG_ASYNC:
+            q = queue.Queue(config.LOG_QUEUE_SIZE)
+            _LOG_LISTENER = QueueListener(q, router)
+            _LOG_LISTENER.start()
+            root.addHandler(QueueHandler(q))
+        else:
+            root.addHandler(router)
+
+        _LOG_ROUTER = router
+    return router
+
+
+def stop_logging():
+    """
+    Writes the queued records and closes the log files
+    :return:
+    """
+    global _LOG_ROUTER, _LOG_LISTENER
+    with _LOG_LOCK:
+        listener, _LOG_LISTENER = _LOG_LISTENER, None
+        router, _LOG_ROUTER = _LOG_ROUTER, None
+
+    if listener is not None:
+        listener.stop()
+
+    if router is not None:
+        root = logging.getLogger()
+        for h in root.handlers[:]:
+            if h is router or isinstance(h, QueueHandler):
+                root.removeHandler(h)
+        router.close()
+
+
+def after_fork():
+    """
+    The listener thread does not exist in a forked child - its records are written synchronously
+    Locks held by the threads of the parent at the fork (the listener writing a record) are created anew
+    Called by os.register_at_fork (python v3.7+) and by the initializer of the process pools (python v2)
+    :return:
+    """
+    global _LOG_LISTENER, _LOG_LOCK
+    _LOG_LOCK = threading.Lock()
+
+    # module lock of logging - python v3 renews it on its own
+    if not hasattr(os, "register_at_fork") and getattr(logging, "_lock", None) is not None:
+        logging._lock = threading.RLock()
+
+    if _LOG_ROUTER is not None:
+        for h in [_LOG_ROUTER, _LOG_ROUTER.console] + list(_LOG_ROUTER.handlers.values()):
+            h.createLock()
+
+    if _LOG_LISTENER is not None:
+        _LOG_LISTENER = None
+        root = logging.getLogger()
+        for h in root.handlers[:]:
+            if isinstance(h, QueueHandler):
+                root.removeHandler(h)
+        root.addHandler(_LOG_ROUTER)
+
+atexit.register(stop_logging)
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=after_fork)
+
+
 # Logger class
 class Logger(object):
-    DEFAULTLEVEL = logging.DEBUG
+    DEFAULTLEVEL = config.LOG_LEVEL
 
     DEFAULTFILE = "{}{}".format(os.path.basename(__file__), ".log")
 
@@ -28,18 +247,13 @@ class Logger(object):
         if debug_level is not None:
             self.DEFAULTLEVEL = debug_level
 
-        logging.basicConfig(level=self.DEFAULTLEVEL,
-                            format='%(asctime)s %(levelname)-8s %(process)-8d %(thread)-10d %(threadName)-16s %(name)-12s: %(message)s',
-                            datefmt='%m-%d %H:%M',
-                            filemode='w')
+        start_logging(level=self.DEFAULTLEVEL)
 
         if def_file is None:
             self._logger = logging.getLogger("{}".format(self.__class__.__name__))
         else:
             self._logger = logging.getLogger("{}/{}".format(self.__class__.__name__, os.path.basename(str(def_file))))
 
-        self._fh = None
-
         self.debug_level = self.DEFAULTLEVEL
         self.setDebugLevel(self.debug_level)
 
@@ -88,24 +302,22 @@ class Logger(object):
         self.debug_level = level
         self.logger.setLevel(level)
 
-        for h in self.logger.handlers:
-            h.setLevel(level)
+    # messages are formatted lazily - msg % args is only evaluated if the level is enabled
+    def info(self, msg, *args):
+        if self._logger.isEnabledFor(logging.INFO):
+            self._logger.info(self._check_msg(msg), *args)
 
-    def info(self, msg):
-        msg = self._check_msg(msg)
-        self._logger.info(msg)
+    def debug(self, msg, *args):
+        if self._logger.isEnabledFor(logging.DEBUG):
+            self._logger.debug(self._check_msg(msg), *args)
 
-    def debug(self, msg):
-        msg = self._check_msg(msg)
-        self._logger.debug(msg)
+    def error(self, msg, *args):
+        if self._logger.isEnabledFor(logging.ERROR):
+            self._logger.error(self._check_msg(msg), *args)
 
-    def error(self, msg):
-        msg = self._check_msg(msg)
-        self._logger.error(msg)
-
-    def warning(self, msg):
-        msg = self._check_msg(msg)
-        self._logger.error(msg)
+    def warning(self, msg, *args):
+        if self._logger.isEnabledFor(logging.ERROR):
+            self._logger.error(self._check_msg(msg), *args)
 
     def _check_msg(self, msg):
         if msg is not None:
@@ -131,23 +343,53 @@ class Logger(object):
             self.error("Error message as follows:\n{0}".format(e))
 
     def addFileHandler(self, filename):
-        self.debug("Using default filename for logging ({})".format(filename))
-        fh = logging.FileHandler(filename, "w")
-        fh.setLevel(self.debug_level)
+        """
+        Registers the log file of the logger - the file handler is shared by all the instances using the file
+        :param filename:
+        :return:
+        """
+        self.debug("Using default filename for logging (%s)", filename)
+        start_logging().add_file(self.logger.name, filename)
 
-        # add formatter
-        fmtr = logging.Formatter('%(asctime)s %(levelname)-8s %(process)-8d %(thread)-10d %(threadName)-16s %(name)-12s: %(message)s')
-        fh.setFormatter(fmtr)
+# Lock file shared by several processes - the lock is held by the open handle and is released if the process dies
+class FileLock(object):
+    def __init__(self, filename):
+        self.filename = filename
+        self.fh = None
 
-        self.logger.addHandler(fh)
+    def acquire(self):
+        """
+        Tries to lock the file without blocking
+        :return: (bool) - True if the lock has been acquired
+        """
+        if self.fh is None:
+            self.fh = open(self.filename, "a+")
 
-    def __del__(self):
-        self.debug("Removing handlers")
-        handlers = self._logger.handlers[:]
-        for handler in handlers:
-            handler.close()
-            self._logger.removeHandler(handler)
-        del self._logger.handlers[:]
+        res = True
+        try:
+            if fcntl is not None:
+                fcntl.flock(self.fh.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            else:
+                self.fh.seek(0)
+                msvcrt.locking(self.fh.fileno(), msvcrt.LK_NBLCK, 1)
+        except (IOError, OSError):
+            res = False
+        return res
+
+    def release(self):
+        if self.fh is None:
+            return
+
+        if fcntl is not None:
+            fcntl.flock(self.fh.fileno(), fcntl.LOCK_UN)
+        else:
+            self.fh.seek(0)
+            msvcrt.locking(self.fh.fileno(), msvcrt.LK_UNLCK, 1)
+
+    def close(self):
+        if self.fh is not None:
+            self.fh.close()
+            self.fh = None
 
 # Wrapper to test specific value types
 class Tester(Logger):
@@ -229,6 +471,76 @@ class MutexLock(Tester):
 
         self.debug("Using a lock file ({})".format(self.lock_name))
 
+        # in-memory guard of the runs, the file lock is used only if several processes share the directories
+        self._guard = threading.Lock()
+        self._file_lock = None
+        if config.PLUGIN_FILE_LOCK:
+            self._file_lock = FileLock(self.lock_name)
+
+        # runs - accepted runs, skipped - refused runs, overlaps - refused while a run of this process was active
+        self.run_stats = {"runs": 0, "skipped": 0, "overlaps": 0}
+        self._stats_lock = threading.Lock()
+
+        # a run was refused while a run of this process held the guard - the holder runs once more on release
+        self.pending = False
+        self._pending_lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Starts a run if no other run holds the guard - does not block and does not touch the file system
+        unless the file lock is enabled
+        A run refused because of a run of this process is marked pending, release() reports it
+        :return: (bool) - True if the run may proceed
+        """
+        with self._pending_lock:
+            res = self._guard.acquire(False)
+            overlap = not res
+            if overlap:
+                self.pending = True
+
+        if res and self._file_lock is not None:
+            try:
+                res = self._file_lock.acquire()
+            except (IOError, OSError) as e:
+                self.error("Lock file ({}) cannot be used ({})".format(self.lock_name, e))
+                res = False
+
+            if not res:
+                self._guard.release()
+
+        with self._stats_lock:
+            if res:
+                self.run_stats["runs"] += 1
+            else:
+                self.run_stats["skipped"] += 1
+                if overlap:
+                    self.run_stats["overlaps"] += 1
+        return res
+
+    def release(self):
+        """
+        Finishes a run started by acquire()
+        :return: (bool) - True if a run was refused meanwhile, the caller runs once more
+        """
+        if self._file_lock is not None:
+            try:
+                self._file_lock.release()
+            except (IOError, OSError) as e:
+                self.error("Lock file ({}) cannot be released ({})".format(self.lock_name, e))
+
+        with self._pending_lock:
+            self._guard.release()
+            res, self.pending = self.pending, False
+        return res
+
+    def get_run_stats(self):
+        """
+        Returns a copy of the run counters
+        :return:
+        """
+        with self._stats_lock:
+            return dict(self.run_stats)
+
     def is_locked(self):
         """
         Returns True if the file lock exists and false otherwise
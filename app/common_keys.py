@@ -1,2 +1,3 @@
 __author__ = 'Konstantin Glazyrin'
-NAME, TICKTACK, TICKTACK_OFFSET = "NAME", "TICKTACK", "TICKTACK_OFFSET"
\ No newline at end of file
+NAME, TICKTACK, TICKTACK_OFFSET = "NAME", "TICKTACK", "TICKTACK_OFFSET"
+WATCH_RAW = "WATCH_RAW"
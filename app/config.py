@@ -1,8 +1,103 @@
 import os
+import logging
 
 # main controls over the server tick tack - number used for division of a second 10=0.1s step - 10Hz
 DAEMON_MULTIPLIER = 3
 DAEMON_TICKTACK = 1.
+# shortest period of a plugin (s) - plugin tacts may be fractions of the base tick down to this value
+DAEMON_MIN_PERIOD = 0.01
+
+# plugin runs are guarded in memory, the lock files (flock/msvcrt) are needed only if several daemon processes share the directories
+PLUGIN_FILE_LOCK = False
+
+# watcher of the raw directory started by the daemon next to the tick loop - "auto", "inotify", "poll" or None (disabled)
+DAEMON_WATCH_MODE = "auto"
+
+# in-process pipeline handing the folders between the prepare, merge and finalize stages
+DAEMON_PIPELINE = True
+# maximum number of folders waiting in a pipeline stage
+PIPELINE_QUEUE_SIZE = 64
+# time to wait for a free slot of a full stage before leaving the folder to the tick based plugins (s)
+PIPELINE_PUT_TIMEOUT = 1.
+# number of consumer threads per pipeline stage
+PIPELINE_WORKERS = 2
+
+# number of ready raw frames moved into a single temporary folder, 1 - one frame per folder
+RAW_BATCH_SIZE = 8
+
+# execution of the merge stage - "thread", "process" or "auto" (processes for bursts of MERGE_PROCESS_THRESHOLD folders or more)
+MERGE_MODE = "auto"
+MERGE_PROCESS_THRESHOLD = 4
+# number of processes of the merge stage, None - number of cores
+MERGE_PROCESSES = None
+
+# whitelist of the .metadata keys merged into the tif header and the nexus file, None - all the keys of the [metadata] section
+METADATA_KEYS = ("dateString", "exposureTime", "summedExposures",
+                 "userComment1", "userComment2", "userComment3", "userComment4")
+
+# the merged header is written into the ImageDescription tag without decoding the pixel data (fabio is used as a fallback)
+TIFF_HEADER_ONLY = True
+
+# image data in the nexus file - None (paths only), "external" (hdf5 external storage pointing into the tif) or
+# "copy" (gzip copy of the pixels - reads and compresses every frame, doubles the bytes sent to the output)
+# the readers of the "external" mode resolve the tif by the ${ORIGIN} prefix, see README.MD (NeXus files)
+NEXUS_DATA_MODE = None
+# gzip level of the "copy" mode
+NEXUS_DATA_COMPRESSION = 4
+
+# per scan master files - frame metadata written in the swmr mode on the local disk (NEXUS_MASTER_DIR) and published
+# to the output directory with a virtual dataset of the frame nexus files, the pixels are not copied
+# the virtual dataset reads the image data of the frame nexus files - NEXUS_DATA_MODE has to be set, zeros otherwise
+NEXUS_MASTER = False
+# header keys stored as per frame arrays of the master file
+NEXUS_MASTER_KEYS = ("dateString", "exposureTime", "summedExposures",
+                     "userComment1", "userComment2", "userComment3", "userComment4")
+
+# copy engine of the finalize stage - buffer used if the kernel copy is not available (bytes), concurrent copies per folder
+# without the spool (the spool copies the files of a folder one by one, its limit is the number of concurrent copies)
+COPY_BUFFER_SIZE = 8 * 1024 * 1024
+COPY_WORKERS = 4
+# checksums computed during the copy (xxhash if installed, blake2b or sha1) and stored in the per folder manifests
+# False - the kernel copies the data (copy_file_range, sendfile), the copies are verified by their size only;
+# True - every file passes through the daemon to be hashed, the kernel copy is not used (slower, more CPU)
+COPY_CHECKSUM = False
+
+# write-behind spool of the remote copies - finalize returns at once, folders are copied in the background (older first)
+DAEMON_SPOOL = True
+# bandwidth limit of the remote copies (MB/s), 0 - no limit, changed by the Bandwidth attribute
+SPOOL_BANDWIDTH = 0.
+# bytes the copies may send at once above the limit
+SPOOL_BURST = 16 * 1024 * 1024
+# throughput window (s) and relative gain required to keep on changing the number of concurrent copies
+SPOOL_ADAPT_INTERVAL = 5.
+SPOOL_ADAPT_GAIN = 0.05
+
+# number of concurrent copies of the spool under the RAM disk pressure, relative to MaxProc
+SPOOL_BOOST_FACTOR = 2.
+
+# RAM disk pressure monitor - free space of the raw/temp/proc directories and the backlog of the stages
+DAEMON_MONITOR = True
+# sampling period (s)
+MONITOR_INTERVAL = 1.
+# used fraction of the disk - high: finalize is boosted, nexus files are deferred; critical: bandwidth limit is lifted,
+# master files are skipped, the device goes into the ALARM state
+MONITOR_HIGH_WATERMARK = 0.7
+MONITOR_CRITICAL_WATERMARK = 0.85
+# number of folders waiting in the temporary and processed directories
+MONITOR_BACKLOG_HIGH = 200
+MONITOR_BACKLOG_CRITICAL = 1000
+# a level is left only below its watermark minus the hysteresis (relative for the backlog)
+MONITOR_HYSTERESIS = 0.05
+
+# period of the metrics published as tango change events (s)
+METRICS_PUSH_INTERVAL = 1.
+
+# default level of the loggers, disabled levels cost only a level check - the messages are formatted lazily
+LOG_LEVEL = logging.DEBUG
+# records are written to the console and the log files by a single listener thread, False - by the logging threads
+LOG_ASYNC = True
+# maximum number of queued records, 0 - unlimited
+LOG_QUEUE_SIZE = 0
 
 # main directory of the application folder for common use
 DIR_APP = os.path.dirname(__file__)
@@ -13,6 +108,7 @@ CONFIG_INI_TEMP = os.path.join(DIR_APP, "data", "temp")
 CONFIG_INI_PROC = os.path.join(DIR_APP, "data", "proc")
 CONFIG_INI_OUTPUT_ROOT = os.path.join(DIR_APP, "data", "output")
 CONFIG_INI_MAXPROC = 5
+CONFIG_INI_BANDWIDTH = SPOOL_BANDWIDTH
 
 CFG_SECTION = "Configuration"
 CFG_RAWDIR = "raw_dir"
@@ -21,6 +117,24 @@ CFG_PROCDIR = "proc_dir"
 CFG_OUTDIR = "output_dir"
 CFG_OUTROOT = "output_root"
 CFG_MAXPROC = "maxproc"
+CFG_BANDWIDTH = "bandwidth"
+
+# journal of the frame states (sqlite, WAL mode) - in-flight folders are resumed or rolled back on a restart
+DAEMON_JOURNAL = True
+JOURNAL_FILE = os.path.join(DIR_APP, "journal.db")
+
+# local index of the finalized frames (sqlite, WAL mode) - name, scan, remote path, size, checksum, header
+DAEMON_INDEX = True
+INDEX_FILE = os.path.join(DIR_APP, "frames.db")
+
+# local directory of the master files being written (NEXUS_MASTER)
+NEXUS_MASTER_DIR = os.path.join(DIR_APP, "masters")
+# masters without new frames are closed and published after (s), open masters are published at most every (s)
+NEXUS_MASTER_IDLE = 60.
+NEXUS_MASTER_PUBLISH_INTERVAL = 30.
+
+# plugins are imported by the daemon thread, not by the constructor - the tango device starts without waiting for them
+DAEMON_DEFER_PLUGINS = True
 
 # DIR_TEMPFILES - directory which can be considered external to the app
 # if it does not exist - the DIR_LOCKFILES will be used instead
@@ -2,6 +2,8 @@ __author__ = 'Konstantin Glazyrin'
 
 import os
 import time
+import heapq
+import sqlite3
 
 from copy import deepcopy
 from functools import partial
@@ -9,6 +11,17 @@ from pluginbase import PluginBase
 from app.config import *
 from app.common import *
 from app.common_keys import *
+from app.watcher import start_watcher, stop_watcher
+from app.pipeline import start_pipeline, stop_pipeline, get_pipeline
+from app.metrics import METRIC_STAGES, get_stats
+from app.pool import resize_pools, shutdown_pools
+from app.spool import start_spool, stop_spool, get_spool, set_bandwidth
+from app.journal import open_journal, close_journal
+from app.frame_index import open_frame_index, close_frame_index, get_frame_index
+from app.monitor import start_monitor, stop_monitor, get_monitor, PRESSURE_NORMAL, PRESSURE_NAMES
+from app.plugins.plugins_common.plugin_master import close_masters
+from app.plugins.plugins_common.plugin_copy import get_rates
+from app.plugins.plugins_common.plugin_memcached import close_memcached
 
 
 try:
@@ -21,6 +34,13 @@ except ImportError:
 
 import threading
 
+try:
+    # python v3
+    monotonic = time.monotonic
+except AttributeError:
+    # python v2 - no monotonic clock in the standard library
+    monotonic = time.time
+
 here = os.path.abspath(os.path.dirname(__file__))
 get_path = partial(os.path.join, here)
 
@@ -31,12 +51,35 @@ class Daemon(Tester):
     ID = "daemon"
 
     TICKTACK = DAEMON_TICKTACK
-    MAX_COUNTER = 10000.
     MULTIPLIER = DAEMON_MULTIPLIER
 
+    # shortest period of a plugin (s)
+    MIN_PERIOD = DAEMON_MIN_PERIOD
+
     BREAK = False
 
-    PLUGIN_TEMPLATE = {NAME: None, TICKTACK: None, TICKTACK_OFFSET: None}
+    PLUGIN_TEMPLATE = {NAME: None, TICKTACK: None, TICKTACK_OFFSET: None, WATCH_RAW: False}
+
+    # mode of the raw directory watcher
+    WATCH_MODE = DAEMON_WATCH_MODE
+
+    # in-process pipeline between the stages
+    PIPELINE = DAEMON_PIPELINE
+
+    # write-behind spool of the remote copies
+    SPOOL = DAEMON_SPOOL
+
+    # RAM disk pressure monitor
+    MONITOR = DAEMON_MONITOR
+
+    # journal of the frame states
+    JOURNAL = DAEMON_JOURNAL
+
+    # local index of the finalized frames
+    INDEX = DAEMON_INDEX
+
+    # plugins are imported by start() - the construction does not wait for them
+    DEFER_PLUGINS = DAEMON_DEFER_PLUGINS
 
     # attribute equivalents
     RAW_DIR = ""
@@ -45,29 +88,54 @@ class Daemon(Tester):
     OUTPUT_DIR = ""
     OUTPUT_ROOT = ""
     MAXPROC = 5
+    BANDWIDTH = CONFIG_INI_BANDWIDTH
 
     # error message if available
     ERRORMSG = ""
 
     @property
     def maxproc(self):
-        self.debug("!!! Reading value {}".format(self.MAXPROC))
+        self.debug("!!! Reading value %s", self.MAXPROC)
         return self.MAXPROC
 
     @maxproc.setter
     def maxproc(self, value):
         if value != self.MAXPROC:
-            self.debug("(*) Setting the ({}) to ({})".format(sys._getframe().f_code.co_name, value))
+            self.debug("(*) Setting the (%s) to (%s)", sys._getframe().f_code.co_name, value)
             self.MAXPROC = value
             self.sync_ini_file(bsync=True)
 
+            # worker pools follow the value without a restart
+            try:
+                resize_pools(int(value))
+
+                spool = get_spool()
+                if spool is not None:
+                    spool.resize(int(value))
+            except ValueError:
+                self.error("Could not resize the worker pools to (%s)", value)
+
+    @property
+    def bandwidth(self):
+        return self.BANDWIDTH
+
+    @bandwidth.setter
+    def bandwidth(self, value):
+        if value != self.BANDWIDTH:
+            self.debug("(*) Setting the (%s) to (%s)", sys._getframe().f_code.co_name, value)
+            self.BANDWIDTH = value
+            self.sync_ini_file(bsync=True)
+
+            # applied to the running copies at once
+            set_bandwidth(float(value))
+
     @property
     def rawdir(self):
         return self.RAW_DIR
 
     @rawdir.setter
     def rawdir(self, value):
-        self.debug("(*) Setting the ({}) to ({})".format(sys._getframe().f_code.co_name, value))
+        self.debug("(*) Setting the (%s) to (%s)", sys._getframe().f_code.co_name, value)
         if value != self.RAW_DIR:
             self.RAW_DIR = value
             self.sync_ini_file(bsync=True)
@@ -78,7 +146,7 @@ class Daemon(Tester):
 
     @tempdir.setter
     def tempdir(self, value):
-        self.debug("(*) Setting the ({}) to ({})".format(sys._getframe().f_code.co_name, value))
+        self.debug("(*) Setting the (%s) to (%s)", sys._getframe().f_code.co_name, value)
         if value != self.TEMP_DIR:
             self.TEMP_DIR = value
             self.sync_ini_file(bsync=True)
@@ -89,7 +157,7 @@ class Daemon(Tester):
 
     @procdir.setter
     def procdir(self, value):
-        self.debug("(*) Setting the ({}) to ({})".format(sys._getframe().f_code.co_name, value))
+        self.debug("(*) Setting the (%s) to (%s)", sys._getframe().f_code.co_name, value)
         if value != self.PROC_DIR:
             self.PROC_DIR = value
             self.sync_ini_file(bsync=True)
@@ -100,7 +168,7 @@ class Daemon(Tester):
 
     @outdir.setter
     def outdir(self, value):
-        self.debug("(*) Setting the ({}) to ({})".format(sys._getframe().f_code.co_name, value))
+        self.debug("(*) Setting the (%s) to (%s)", sys._getframe().f_code.co_name, value)
         if value != self.OUTPUT_DIR:
             self.OUTPUT_DIR = value
             self.sync_ini_file(bsync=True)
@@ -111,7 +179,7 @@ class Daemon(Tester):
 
     @outroot.setter
     def outroot(self, value):
-        self.debug("(*) Setting the ({}) to ({})".format(sys._getframe().f_code.co_name, value))
+        self.debug("(*) Setting the (%s) to (%s)", sys._getframe().f_code.co_name, value)
         if value != self.OUTPUT_ROOT:
             self.OUTPUT_ROOT = value
             self.sync_ini_file(bsync=True)
@@ -136,44 +204,98 @@ class Daemon(Tester):
 
         self.plugin_info = []
 
-        for plugin_name in self.plugin_base.list_plugins():
-            self.debug("Found a plugin with name ({})".format(plugin_name))
+        # startup report, list of (plugin name, import time, setup time)
+        self.startup_times = []
+        # plugins which could not be imported, list of (plugin name, error)
+        self.plugin_errors = []
+        self._plugins_loaded = False
+        self._plugins_lock = threading.Lock()
 
-            plugin = self.plugin_base.load_plugin(plugin_name)
-            try:
-                # simple test of the plugin validity - raises NameError or Attribute error if the plugin is not valid
-                plugin.setup(self)
-
-                # copy information on the plugin to the general storage
-                tmpl = deepcopy(self.PLUGIN_TEMPLATE)
-                tmpl[NAME] = plugin_name
-                tmpl[TICKTACK] = plugin.TICKTACK
-                tmpl[TICKTACK_OFFSET] = plugin.TICKTACK_OFFSET
-                self.plugin_info.append(tmpl)
-
-                test = plugin.work
-
-                self.debug("Plugin ({}) is valid, adding it".format(plugin_name))
-                self.plugins.append(plugin)
-                self.debug("Plugin ({}) has a tact of ({})".format(plugin_name, plugin.TICKTACK))
-
-                # test plugin tact
-                if plugin.TICKTACK < self.TICKTACK:
-                    self.error("Plugin ({}) has low TICKTACK value ({}), matching it with default ({})".format(plugin_name, plugin.TICKTACK, self.TICKTACK))
-                    plugin.TICKTACK = self.TICKTACK
-            except (NameError, AttributeError):
-                self.error("Plugin ({}) is invalid".format(plugin_name))
-
-        # internal counter
-        self.counter = 1
+        # the plugins are imported by the daemon thread unless they are requested at the construction
+        if not self.DEFER_PLUGINS:
+            self.load_plugins()
+
+        # schedule statistics, plugin name - {period, runs, missed, last and max lateness}
+        self.schedule = {}
+
+        # wakes up the scheduler on stop
+        self.stop_event = threading.Event()
+
+        # raw directory watcher and the thread reacting on its events
+        self.watcher = None
+        self.watch_thread = None
         self.remove_locks()
 
+    def load_plugins(self):
+        """
+        Imports and validates the plugins once, reports the import and setup time of each plugin
+        A plugin failing to import is skipped, the other plugins are loaded
+        :return:
+        """
+        with self._plugins_lock:
+            if self._plugins_loaded:
+                return
+
+            timestamp = monotonic()
+            errors = []
+            for plugin_name in self.plugin_base.list_plugins():
+                # packages next to the plugins (plugins_common, backup) hold their shared code
+                if os.path.isdir(get_path('./plugins', plugin_name)):
+                    self.debug("Skipping a package of the plugins (%s)", plugin_name)
+                    continue
+
+                self.debug("Found a plugin with name (%s)", plugin_name)
+
+                t_import = monotonic()
+                try:
+                    plugin = self.plugin_base.load_plugin(plugin_name)
+                    t_setup = monotonic()
+
+                    # simple test of the plugin validity - raises NameError or Attribute error if the plugin is not valid
+                    plugin.setup(self)
+
+                    # copy information on the plugin to the general storage
+                    tmpl = deepcopy(self.PLUGIN_TEMPLATE)
+                    tmpl[NAME] = plugin_name
+                    tmpl[TICKTACK] = plugin.TICKTACK
+                    tmpl[TICKTACK_OFFSET] = plugin.TICKTACK_OFFSET
+                    tmpl[WATCH_RAW] = getattr(plugin, WATCH_RAW, False)
+                    self.plugin_info.append(tmpl)
+
+                    test = plugin.work
+
+                    self.debug("Plugin (%s) is valid, adding it", plugin_name)
+                    self.plugins.append(plugin)
+                    self.debug("Plugin (%s) has a tact of (%s)", plugin_name, plugin.TICKTACK)
+
+                    # test plugin tact - fractions of the base tick are allowed down to MIN_PERIOD
+                    if plugin.TICKTACK * self.get_base_tick() < self.MIN_PERIOD:
+                        tact = self.MIN_PERIOD / self.get_base_tick()
+                        self.error("Plugin (%s) has low TICKTACK value (%s), matching it with the minimum (%s)", plugin_name, plugin.TICKTACK, tact)
+                        plugin.TICKTACK = tact
+                except (NameError, AttributeError) as e:
+                    self.error("Plugin (%s) is invalid, skipping it: %s", plugin_name, e)
+                    errors.append((plugin_name, "invalid plugin - {}: {}".format(e.__class__.__name__, e)))
+                    continue
+                except Exception as e:
+                    self.error("Plugin (%s) could not be loaded, skipping it: %s", plugin_name, e)
+                    errors.append((plugin_name, "{}: {}".format(e.__class__.__name__, e)))
+                    continue
+
+                self.startup_times.append((plugin_name, t_setup - t_import, monotonic() - t_setup))
+                self.info("Plugin (%s) was loaded: import (%.3fs), setup (%.3fs)", *self.startup_times[-1])
+
+            self.plugin_errors = errors
+            self._plugins_loaded = True
+            self.info("Plugins (%d) were loaded in (%.3fs), failed (%d)", len(self.plugins), monotonic() - timestamp,
+                      len(errors))
+
     def load_ini_variables(self):
         """
         Load variables form ini file
         :return:
         """
-        self.debug("Loading configuration from an ini file ({})".format(CONFIG_INI))
+        self.debug("Loading configuration from an ini file (%s)", CONFIG_INI)
         parser = configparser.RawConfigParser(allow_no_value=True)
 
         # one could think about test for directory, but who cares
@@ -183,34 +305,42 @@ class Daemon(Tester):
         parser.read(config.CONFIG_INI)
 
         # setting the
-        keys = (CFG_MAXPROC, CFG_OUTDIR, CFG_OUTROOT, CFG_RAWDIR, CFG_TEMPDIR, CFG_PROCDIR)
+        keys = (CFG_MAXPROC, CFG_OUTDIR, CFG_OUTROOT, CFG_RAWDIR, CFG_TEMPDIR, CFG_PROCDIR, CFG_BANDWIDTH)
         bsync = False
         for key in keys:
             try:
                 value = parser.get(config.CFG_SECTION, key)
 
-                # self.debug("Assigning ini values ({}/{})".format(key, value))
+                # self.debug("Assigning ini values (%s/%s)", key, value)
 
                 if key == CFG_MAXPROC:
-                    self.debug("(+) Setting the ({}) to ({}/{})".format(sys._getframe().f_code.co_name, key, value))
+                    self.debug("(+) Setting the (%s) to (%s/%s)", sys._getframe().f_code.co_name, key, value)
                     self.MAXPROC = value
                 elif key == CFG_OUTDIR:
-                    self.debug("(+) Setting the ({}) to ({}/{})".format(sys._getframe().f_code.co_name, key, value))
+                    self.debug("(+) Setting the (%s) to (%s/%s)", sys._getframe().f_code.co_name, key, value)
                     self.OUTPUT_DIR = value
                 elif key == CFG_OUTROOT:
-                    self.debug("(+) Setting the ({}) to ({}/{})".format(sys._getframe().f_code.co_name, key, value))
+                    self.debug("(+) Setting the (%s) to (%s/%s)", sys._getframe().f_code.co_name, key, value)
                     self.OUTPUT_ROOT = value
                 elif key == CFG_RAWDIR:
-                    self.debug("(+) Setting the ({}) to ({}/{})".format(sys._getframe().f_code.co_name, key, value))
+                    self.debug("(+) Setting the (%s) to (%s/%s)", sys._getframe().f_code.co_name, key, value)
                     self.RAW_DIR = value
                 elif key == CFG_TEMPDIR:
-                    self.debug("(+) Setting the ({}) to ({}/{})".format(sys._getframe().f_code.co_name, key, value))
+                    self.debug("(+) Setting the (%s) to (%s/%s)", sys._getframe().f_code.co_name, key, value)
                     self.TEMP_DIR = value
                 elif key == CFG_PROCDIR:
-                    self.debug("(+) Setting the ({}) to ({}/{})".format(sys._getframe().f_code.co_name, key, value))
+                    self.debug("(+) Setting the (%s) to (%s/%s)", sys._getframe().f_code.co_name, key, value)
                     self.PROC_DIR = value
-
-                self.debug("Found an ini file value ({}/{})".format(key, value))
+                elif key == CFG_BANDWIDTH:
+                    self.debug("(+) Setting the (%s) to (%s/%s)", sys._getframe().f_code.co_name, key, value)
+                    try:
+                        self.BANDWIDTH = float(value)
+                    except ValueError:
+                        self.error("Invalid bandwidth value (%s), the copies are not limited", value)
+                        self.BANDWIDTH = 0.
+                    set_bandwidth(self.BANDWIDTH)
+
+                self.debug("Found an ini file value (%s/%s)", key, value)
             except configparser.NoOptionError:
                 bsync = True
 
@@ -227,14 +357,16 @@ class Daemon(Tester):
                     value = CONFIG_INI_TEMP
                 elif key == CFG_PROCDIR:
                     value = CONFIG_INI_PROC
+                elif key == CFG_BANDWIDTH:
+                    value = CONFIG_INI_BANDWIDTH
 
-                self.warning("Adding a missing value ({}/{})".format(key, value))
+                self.warning("Adding a missing value (%s/%s)", key, value)
                 parser.set(CFG_SECTION, key, value)
 
         if bsync:
             self.sync_ini_file(bsync=bsync)
 
-        self.debug("Proc test 01 ({})".format(self.PROC_DIR))
+        self.debug("Proc test 01 (%s)", self.PROC_DIR)
 
     def sync_ini_file(self, bsync=False):
         """
@@ -253,7 +385,8 @@ class Daemon(Tester):
                 CFG_OUTROOT: CONFIG_INI_OUTPUT_ROOT,
                 CFG_RAWDIR: CONFIG_INI_RAW,
                 CFG_TEMPDIR: CONFIG_INI_TEMP,
-                CFG_PROCDIR: CONFIG_INI_PROC
+                CFG_PROCDIR: CONFIG_INI_PROC,
+                CFG_BANDWIDTH: CONFIG_INI_BANDWIDTH
             }
         elif bsync:
             value_dict = {
@@ -262,13 +395,14 @@ class Daemon(Tester):
                 CFG_OUTROOT: self.OUTPUT_ROOT,
                 CFG_RAWDIR: self.RAW_DIR,
                 CFG_TEMPDIR: self.TEMP_DIR,
-                CFG_PROCDIR: self.PROC_DIR
+                CFG_PROCDIR: self.PROC_DIR,
+                CFG_BANDWIDTH: self.BANDWIDTH
             }
         else:
             bsave = False
 
         if bsave:
-            self.debug("Saving the configuration file ({})".format(CONFIG_INI))
+            self.debug("Saving the configuration file (%s)", CONFIG_INI)
             parser.add_section(CFG_SECTION)
 
             for key in sorted(value_dict.keys()):
@@ -277,7 +411,7 @@ class Daemon(Tester):
             with open(CONFIG_INI, 'wb') as configfile:
                 parser.write(configfile)
 
-        self.debug("Proc test 02 ({})".format(self.PROC_DIR))
+        self.debug("Proc test 02 (%s)", self.PROC_DIR)
 
 
     def start(self):
@@ -286,36 +420,259 @@ class Daemon(Tester):
         :return:
         """
         self.BREAK = False
+        self.stop_event.clear()
+
+        # deferred plugins are imported by the daemon thread
+        self.load_plugins()
+
+        # folders left in flight by the previous run are resumed or rolled back before the plugins start
+        if self.JOURNAL:
+            self.recover_folders()
+
+        # finalized frames are indexed by the finalize stage
+        if self.INDEX:
+            self.open_index()
+
+        # folders are handed over between the stages without waiting for the ticks
+        if self.PIPELINE:
+            start_pipeline(debug_level=self.debug_level)
+
+        # remote copies run behind the finalize stage
+        if self.SPOOL:
+            try:
+                start_spool(workers=int(self.MAXPROC), debug_level=self.debug_level)
+            except ValueError:
+                start_spool(workers=CONFIG_INI_MAXPROC, debug_level=self.debug_level)
+
+        # scheduling follows the RAM disk pressure
+        if self.MONITOR:
+            start_monitor(self.get_local_dirs, debug_level=self.debug_level)
+
+        # event driven plugins run next to the tick loop
+        self.start_watcher()
+
+        if len(self.plugins) == 0:
+            self.error("No plugins found, exiting")
+        else:
+            self.debug("Found these plugins (%s)", self.plugins)
+            self.run_schedule()
+
+        self.stop_watcher()
+        stop_monitor()
+        stop_pipeline()
+        stop_spool()
+        shutdown_pools()
+        close_masters()
+        close_memcached(logger=self)
+        close_journal()
+        close_frame_index()
+
+    def recover_folders(self):
+        """
+        Opens the frame journal and replays it - errors are reported, the daemon runs without the journal then
+        :return:
+        """
+        try:
+            journal = open_journal(JOURNAL_FILE, debug_level=self.debug_level)
+            journal.recover(self.RAW_DIR, self.TEMP_DIR, self.PROC_DIR)
+        except (sqlite3.Error, OSError, IOError) as e:
+            self.error("Frame journal (%s) could not be replayed: %s", JOURNAL_FILE, e)
+            close_journal()
+
+    def open_index(self):
+        """
+        Opens the frame index - errors are reported, the frames are not indexed then
+        :return: index or None
+        """
+        try:
+            return open_frame_index(INDEX_FILE, debug_level=self.debug_level)
+        except (sqlite3.Error, OSError, IOError) as e:
+            self.error("Frame index (%s) could not be opened: %s", INDEX_FILE, e)
+        return None
+
+    def find_frame(self, name):
+        """
+        Returns the indexed copies of a frame
+        :param name: file name of the frame
+        :return: list of dictionaries, the latest copy first
+        """
+        index = get_frame_index() or self.open_index()
+        if index is None:
+            return []
+        return index.find(name)
+
+    def count_frames(self, scan):
+        """
+        Returns the number of indexed frames of a scan
+        :param scan: scan prefix
+        :return:
+        """
+        index = get_frame_index() or self.open_index()
+        if index is None:
+            return 0
+        return index.count(scan)
+
+    def get_scans_info(self):
+        """
+        Returns the summary of the indexed scans
+        :return: list of dictionaries
+        """
+        index = get_frame_index() or self.open_index()
+        if index is None:
+            return []
+        return index.get_scans()
+
+    def get_base_tick(self):
+        """
+        Returns the base tick (s) - unit of the plugin TICKTACK and TICKTACK_OFFSET values
+        :return:
+        """
+        return float(self.TICKTACK) / float(self.MULTIPLIER)
+
+    def run_schedule(self):
+        """
+        Fires the plugins on their deadlines - a heap of the next fire times on the monotonic clock
+        Deadlines advance by the plugin period, time spent in the loop does not accumulate as a drift
+        :return:
+        """
+        base_tick = self.get_base_tick()
+        start = monotonic()
+
+        heap = []
+        for (i, plugin) in enumerate(self.plugins):
+            period = float(plugin.TICKTACK) * base_tick
+            deadline = start + (float(plugin.TICKTACK_OFFSET) + float(plugin.TICKTACK)) * base_tick
+            heap.append((deadline, i, period))
+
+            self.schedule[self.get_plugin_name(plugin)] = {"period": period, "runs": 0, "missed": 0,
+                                                           "lateness": 0., "max_lateness": 0.}
+        heapq.heapify(heap)
+
         while not self.BREAK:
-            if len(self.plugins) == 0:
-                self.error("No plugins found, exiting")
-                break
-            else:
-                self.debug("Found these plugins ({})".format(self.plugins))
-
-            for plugin in self.plugins:
-                tact = int(plugin.TICKTACK)
-                base_tact = int(self.counter) - plugin.TICKTACK_OFFSET
-
-                # start new thread if a proper tact has come
-                if base_tact > 0 and not base_tact % tact:
-                    # self.info("!!! plugin {} tact {} basetact {} function {}".format(plugin, tact, base_tact, base_tact % tact))
-                    self.debug("Firing a tact ({}:{}:{})".format(self.counter, self.TICKTACK, self.counter * self.TICKTACK))
-                    self.debug("Running a plugin ({}); main tact ({}) plugin tact ({}); time ({})".format(plugin, base_tact, tact, time.time()))
-                    self.start_thread(plugin)
-
-            # sleep for a tact
-            sleep_time = float(self.TICKTACK) / float(self.MULTIPLIER)
-            self.debug("Sleeping a tact ({}:{})".format(self.counter, sleep_time))
-            time.sleep(sleep_time)
-            self.counter = self.counter + 1
-
-            # reset counter in order to avoid overflow
-            if self.counter == self.MAX_COUNTER:
-                if not self.MAX_COUNTER % 2:
-                    self.counter = 2
-                else:
-                    self.counter = 1
+            deadline, i, period = heap[0]
+
+            # sleep until the earliest deadline, stop() wakes us up
+            delay = deadline - monotonic()
+            if delay > 0:
+                self.stop_event.wait(delay)
+                continue
+
+            plugin = self.plugins[i]
+            now = monotonic()
+            lateness = now - deadline
+
+            stats = self.schedule[self.get_plugin_name(plugin)]
+            stats["runs"] += 1
+            stats["lateness"] = lateness
+            stats["max_lateness"] = max(stats["max_lateness"], lateness)
+
+            # deadlines missed completely are skipped, the phase of the plugin is kept
+            missed = int(lateness // period)
+            if missed > 0:
+                stats["missed"] += missed
+                self.warning("Plugin (%s) is late by (%.3fs), skipping (%s) runs", plugin, lateness, missed)
+
+            self.debug("Running a plugin (%s); period (%ss); lateness (%.4fs)", plugin, period, lateness)
+            self.start_thread(plugin)
+
+            heapq.heapreplace(heap, (deadline + (missed + 1) * period, i, period))
+
+    def get_plugin_name(self, plugin):
+        """
+        Returns the name of a plugin
+        :param plugin:
+        :return:
+        """
+        res = getattr(plugin, NAME, None)
+        if res is None:
+            res = getattr(plugin, "__name__", "Thread")
+        return res
+
+    def get_run_stats(self, plugin):
+        """
+        Returns the run guard counters of a plugin worker
+        :param plugin:
+        :return: dictionary, empty if the plugin has no worker
+        """
+        res = {}
+        worker = getattr(plugin, "worker", None)
+        if worker is not None and hasattr(worker, "get_run_stats"):
+            res = worker.get_run_stats()
+        return res
+
+    def get_schedule_info(self):
+        """
+        Returns the schedule statistics of the plugins in the form of text
+        :return:
+        """
+        res = ""
+        if len(self.schedule) > 0:
+            guards = dict([(self.get_plugin_name(plugin), self.get_run_stats(plugin)) for plugin in self.plugins])
+            for name in sorted(self.schedule.keys()):
+                el = self.schedule[name]
+                stats = guards.get(name, {})
+                res += "{:20s}\tperiod {:.3f}s\truns {}\tmissed {}\tlateness {:.4f}s\tmax {:.4f}s\tskipped {}\toverlaps {}\n".format(
+                    name, el["period"], el["runs"], el["missed"], el["lateness"], el["max_lateness"],
+                    stats.get("skipped", 0), stats.get("overlaps", 0))
+        else:
+            res = "Scheduler is not running"
+        return res
+
+    def start_watcher(self):
+        """
+        Starts a watcher of the raw directory and a long lived thread firing the plugins with WATCH_RAW header
+        :return:
+        """
+        if not self.WATCH_MODE:
+            self.debug("Raw directory watcher is disabled")
+            return
+
+        if not any([getattr(plugin, WATCH_RAW, False) for plugin in self.plugins]):
+            self.debug("No plugin requires the raw directory watcher")
+            return
+
+        th = threading.Thread(target=self.watch, name="watch_daemon")
+        th.setDaemon(True)
+
+        self.watch_thread = th
+        th.start()
+
+    def watch(self):
+        """
+        Waits for the watcher events, fires the plugins with WATCH_RAW header as soon as new files arrive
+        Restarts the watcher if the raw directory has been changed
+        :return:
+        """
+        timeout = self.get_base_tick()
+        while not self.BREAK:
+            raw_dir = self.RAW_DIR
+            if self.watcher is None or self.watcher.path != raw_dir:
+                if self.watcher is not None:
+                    stop_watcher(self.watcher.path)
+
+                self.watcher = start_watcher(raw_dir, mode=self.WATCH_MODE, debug_level=self.debug_level)
+                if self.watcher is None:
+                    self.error("Could not start a watcher for the raw directory (%s)", raw_dir)
+                    time.sleep(timeout)
+                    continue
+
+            if self.watcher.wait(timeout) and not self.BREAK:
+                for plugin in self.plugins:
+                    if getattr(plugin, WATCH_RAW, False):
+                        self.start_thread(plugin)
+
+    def stop_watcher(self):
+        """
+        Stops the watcher of the raw directory
+        :return:
+        """
+        if self.watch_thread is not None:
+            self.watch_thread.join(1.)
+            self.watch_thread = None
+
+        if self.watcher is not None:
+            stop_watcher(self.watcher.path)
+            self.watcher = None
 
     def start_thread(self, plugin):
         """
@@ -323,7 +680,7 @@ class Daemon(Tester):
         :param plugin:
         :return:
         """
-        self.debug("Starting a plugin thread ({})".format(plugin))
+        self.debug("Starting a plugin thread (%s)", plugin)
 
         # work_dir = "R:\\raw"
         raw_dir = self.RAW_DIR
@@ -341,7 +698,7 @@ class Daemon(Tester):
             os.makedirs(output_dir)
         except OSError as exc:
             if os.path.exists(output_dir) and os.path.isdir(output_dir):
-                self.debug("Directory ({}) exists".format(output_dir))
+                self.debug("Directory (%s) exists", output_dir)
             else:
                 output_dir = self.OUTPUT_ROOT
                 msg = "Could not create a directory ({})".format(output_dir)
@@ -352,11 +709,7 @@ class Daemon(Tester):
         except ValueError:
             max_proc = CONFIG_INI_MAXPROC
 
-        name = "Thread"
-        try:
-            name = plugin.NAME
-        except AttributeError:
-            pass
+        name = self.get_plugin_name(plugin)
 
         th = threading.Thread(target=plugin.work, name=name, args=(raw_dir, temp_dir, proc_dir, output_dir, max_proc))
         th.start()
@@ -366,6 +719,10 @@ class Daemon(Tester):
         Removes old lock files on the startup
         :return:
         """
+        # lock files held by other processes must stay, they cannot be stale
+        if PLUGIN_FILE_LOCK:
+            return
+
         m = MutexLock(def_file="lock_remover")
         m.unlock_all()
 
@@ -376,8 +733,133 @@ class Daemon(Tester):
         """
         self.debug("Received an exit message, quiting")
         self.BREAK = True
+        self.stop_event.set()
         time.sleep(0.1)
 
+    def get_copy_info(self):
+        """
+        Returns the copy throughput per destination in the form of text
+        :return:
+        """
+        res = ""
+        rates = get_rates()
+        if len(rates) > 0:
+            for dest in sorted(rates.keys()):
+                el = rates[dest]
+                res += "{}\t{:.1f} MB/s\taverage {:.1f} MB/s\tfiles {}\t{:.1f} MB\n".format(
+                    dest, el["rate"], el["average"], el["files"], el["bytes"] / 1e6)
+        else:
+            res = "No files have been copied"
+        return res
+
+    def get_local_dirs(self):
+        """
+        Returns the directories on the RAM disk
+        :return: (raw_dir, temp_dir, proc_dir)
+        """
+        return self.RAW_DIR, self.TEMP_DIR, self.PROC_DIR
+
+    def get_pressure_level(self):
+        """
+        Returns the RAM disk pressure level, PRESSURE_NORMAL if the monitor is not running
+        :return:
+        """
+        monitor = get_monitor()
+        if monitor is None:
+            return PRESSURE_NORMAL
+        return monitor.level
+
+    def get_pressure_info(self):
+        """
+        Returns the state of the RAM disk in the form of text
+        :return:
+        """
+        monitor = get_monitor()
+        if monitor is None:
+            return "Monitor is not running"
+
+        el = monitor.get_info()
+        res = "pressure {}\n".format(PRESSURE_NAMES[el["level"]])
+        for path in sorted(el["usage"].keys()):
+            res += "{}\tused {:.1%}\n".format(path, el["usage"][path])
+        for stage in sorted(el["counts"].keys()):
+            res += "{}\t{}\n".format(stage, el["counts"][stage])
+        return res
+
+    def get_metrics(self):
+        """
+        Returns the per stage metrics and the queue depths
+        :return: dictionary - stages (names), p50/p90/p99 (s), fps (frames/s), mbps (MB/s) in the order of stages,
+                 queues (names) and depths in the order of queues, bytes (total bytes finalized)
+        """
+        stats = get_stats()
+
+        res = {"stages": list(METRIC_STAGES), "bytes": stats[METRIC_STAGES[-1]]["bytes"]}
+        for key in ("p50", "p90", "p99", "fps", "mbps"):
+            res[key] = [stats[name][key] for name in METRIC_STAGES]
+
+        depths = {}
+        monitor = get_monitor()
+        if monitor is not None:
+            depths.update(monitor.get_info()["counts"])
+
+        pipeline = get_pipeline()
+        if pipeline is not None:
+            for (name, value) in pipeline.get_depths().items():
+                depths["pipeline_{}".format(name)] = value
+
+        spool = get_spool()
+        if spool is not None:
+            depths["spool"] = spool.get_info()["queued"]
+
+        res["queues"] = sorted(depths.keys())
+        res["depths"] = [depths[name] for name in res["queues"]]
+        return res
+
+    def get_spool_info(self):
+        """
+        Returns the state of the write-behind spool in the form of text
+        :return:
+        """
+        spool = get_spool()
+        if spool is None:
+            return "Spool is not running"
+
+        el = spool.get_info()
+        return "queued {}\tactive {}\tconcurrency {}/{}\tboost {}\tthroughput {:.1f} MB/s\tlimit {:.1f} MB/s".format(
+            el["queued"], el["active"], el["limit"], el["workers"], el["boost"], el["rate"], el["bandwidth"])
+
+    def get_startup_info(self):
+        """
+        Returns the import and setup time of the plugins in the form of text
+        :return:
+        """
+        res = ""
+        if len(self.startup_times) > 0:
+            for (name, t_import, t_setup) in self.startup_times:
+                res += "{:20s}\timport {:.3f}s\tsetup {:.3f}s\n".format(name, t_import, t_setup)
+            for (name, error) in self.plugin_errors:
+                res += "{:20s}\tfailed\t{}\n".format(name, error)
+        elif not self._plugins_loaded:
+            res = "Plugins are not loaded yet"
+        else:
+            res = "No plugin has been found"
+        return res
+
+    def get_plugin_errors(self):
+        """
+        Returns the plugins which could not be imported, known once all the plugins are loaded
+        :return: list of (plugin name, error)
+        """
+        return list(self.plugin_errors)
+
+    def get_plugin_count(self):
+        """
+        Returns the number of the valid plugins
+        :return:
+        """
+        return len(self.plugins)
+
     def get_plugin_info(self):
         """
         Returns information on the 'good' - loaded plugins in the form of text
@@ -390,5 +872,3 @@ class Daemon(Tester):
         else:
             res = "No plugin has been found"
         return res
-
-# TODO: Fix ticktack + offset issue of the plugins
\ No newline at end of file
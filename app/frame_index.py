@@ -0,0 +1,194 @@
+__author__ = 'Konstantin Glazyrin'
+
+"""
+Local index of the finalized frames
+The finalize stage records the name, scan prefix, remote path, size, checksum, header and timestamps of every frame
+Lookups ("where is frame X", "how many frames in scan Y") are index queries - the remote output tree is not listed
+The index is a sqlite database in the WAL mode, other processes can read it while the daemon writes
+
+from app.frame_index import FrameIndex
+index = FrameIndex("app/frames.db")
+index.find("CeO2_09_11_2017-00001.tif"), index.count("CeO2_09_11_2017")
+"""
+
+import re
+import json
+import sqlite3
+import threading
+
+from app.common import *
+from app.config import INDEX_FILE
+
+# frame file name - scan prefix and frame number
+FRAME_PATTERN = re.compile(r"^(.*)-(\d+)\.tif$")
+
+# columns of a record
+INDEX_COLUMNS = ("path", "name", "scan", "number", "size", "checksum", "algorithm", "header", "mtime", "finalized")
+
+_INDEX = None
+_INDEX_LOCK = threading.Lock()
+
+
+def get_scan_name(fn):
+    """
+    Returns the scan prefix of a frame
+    :param fn:
+    :return:
+    """
+    name = os.path.basename(fn)
+    m = FRAME_PATTERN.match(name)
+    if m is not None:
+        return m.group(1)
+    return os.path.splitext(name)[0]
+
+
+def get_frame_number(fn):
+    """
+    Returns the frame number from the file name or None
+    :param fn:
+    :return:
+    """
+    m = FRAME_PATTERN.match(os.path.basename(fn))
+    if m is not None:
+        return int(m.group(2))
+    return None
+
+
+class FrameIndex(Tester):
+    SCHEMA = ("CREATE TABLE IF NOT EXISTS frames (path TEXT PRIMARY KEY, name TEXT, scan TEXT, number INTEGER, "
+              "size INTEGER, checksum TEXT, algorithm TEXT, header TEXT, mtime REAL, finalized REAL)",
+              "CREATE INDEX IF NOT EXISTS frames_name ON frames (name)",
+              "CREATE INDEX IF NOT EXISTS frames_scan ON frames (scan, number)")
+
+    def __init__(self, filename=INDEX_FILE, debug_level=None):
+        Tester.__init__(self, def_file="frame_index", debug_level=debug_level, nofile=True)
+
+        self.filename = filename
+
+        # one connection shared by the threads
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(filename, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        with self.conn:
+            for sql in self.SCHEMA:
+                self.conn.execute(sql)
+
+    def add(self, records):
+        """
+        Adds or replaces the records of several frames in one transaction
+        :param records: list of dictionaries - path (remote), size, checksum, algorithm, header, mtime
+        :return:
+        """
+        if len(records) == 0:
+            return
+
+        now = time.time()
+        rows = []
+        for el in records:
+            name = os.path.basename(el["path"])
+            rows.append((el["path"], name, get_scan_name(name), get_frame_number(name), el.get("size"),
+                         el.get("checksum"), el.get("algorithm"), json.dumps(el.get("header", {}), default=str),
+                         el.get("mtime"), now))
+
+        with self._lock:
+            with self.conn:
+                self.conn.executemany("INSERT OR REPLACE INTO frames ({}) VALUES ({})".format(
+                    ", ".join(INDEX_COLUMNS), ", ".join(["?"] * len(INDEX_COLUMNS))), rows)
+
+    def _query(self, sql, args=()):
+        with self._lock:
+            return self.conn.execute(sql, args).fetchall()
+
+    def _to_records(self, rows):
+        res = []
+        for row in rows:
+            el = dict(zip(INDEX_COLUMNS, row))
+            try:
+                el["header"] = json.loads(el["header"])
+            except (TypeError, ValueError):
+                pass
+            res.append(el)
+        return res
+
+    def find(self, name):
+        """
+        Returns the records of a frame - the same name may have been copied to several output directories
+        :param name: file name of the frame
+        :return: list of dictionaries, the latest copy first
+        """
+        return self._to_records(self._query("SELECT {} FROM frames WHERE name = ? ORDER BY finalized DESC".format(
+            ", ".join(INDEX_COLUMNS)), (os.path.basename(name),)))
+
+    def count(self, scan):
+        """
+        Returns the number of frames of a scan - a frame copied to several directories is counted once
+        :param scan: scan prefix
+        :return:
+        """
+        return self._query("SELECT COUNT(DISTINCT name) FROM frames WHERE scan = ?", (scan,))[0][0]
+
+    def get_scan(self, scan, offset=0, limit=-1):
+        """
+        Returns the records of a scan ordered by the frame number
+        :param scan:
+        :param offset:
+        :param limit: -1 - all
+        :return: list of dictionaries
+        """
+        return self._to_records(self._query("SELECT {} FROM frames WHERE scan = ? ORDER BY number LIMIT ? OFFSET ?".format(
+            ", ".join(INDEX_COLUMNS)), (scan, limit, offset)))
+
+    def get_scans(self):
+        """
+        Returns the summary of the scans
+        :return: list of dictionaries - scan, frames, first and last frame number, bytes, last finalized time
+        """
+        rows = self._query("SELECT scan, COUNT(DISTINCT name), MIN(number), MAX(number), SUM(size), MAX(finalized) "
+                           "FROM frames GROUP BY scan ORDER BY MAX(finalized)")
+        return [dict(zip(("scan", "frames", "first", "last", "bytes", "finalized"), row)) for row in rows]
+
+    def close(self):
+        with self._lock:
+            self.conn.close()
+
+
+def get_frame_index():
+    return _INDEX
+
+
+def open_frame_index(filename=INDEX_FILE, debug_level=None):
+    """
+    Opens the index if it is not open
+    :param filename:
+    :param debug_level:
+    :return:
+    """
+    global _INDEX
+    with _INDEX_LOCK:
+        if _INDEX is None:
+            _INDEX = FrameIndex(filename, debug_level=debug_level)
+    return _INDEX
+
+
+def close_frame_index():
+    global _INDEX
+    with _INDEX_LOCK:
+        res, _INDEX = _INDEX, None
+    if res is not None:
+        res.close()
+
+
+def index_frames(records):
+    """
+    Adds the records of finalized frames if the index is open, errors are only reported
+    :param records:
+    :return:
+    """
+    index = _INDEX
+    if index is None:
+        return
+    try:
+        index.add(records)
+    except sqlite3.Error as e:
+        index.error("Frames could not be indexed: %s", e)
@@ -0,0 +1,282 @@
+__author__ = 'Konstantin Glazyrin'
+
+"""
+Journal of the frame states
+Every transition of a frame (claimed, moved, merged, nexus written, processed) is appended to a sqlite
+table in the WAL mode - one transaction per folder, the events of a folder are removed once it is finalized
+On a restart the last state of the unfinished frames is replayed, the folders left in flight are resumed or rolled back
+without scanning the stage directories
+"""
+
+import shutil
+import sqlite3
+import threading
+
+from app.common import *
+from app.config import JOURNAL_FILE
+
+# states of a frame in the order of the processing
+STATE_CLAIMED, STATE_MOVED, STATE_MERGED, STATE_NEXUS, STATE_PROCESSED, STATE_FINALIZED = 1, 2, 3, 4, 5, 6
+STATE_NAMES = {STATE_CLAIMED: "claimed", STATE_MOVED: "moved", STATE_MERGED: "merged", STATE_NEXUS: "nexus",
+               STATE_PROCESSED: "processed", STATE_FINALIZED: "finalized"}
+
+LOCK_SUFFIX = ".lock"
+
+_JOURNAL = None
+_JOURNAL_LOCK = threading.Lock()
+
+
+def get_folder_name(path):
+    """
+    Returns the name of a stage folder - the same in the temporary and the processed directory, locked or not
+    :param path:
+    :return:
+    """
+    res = os.path.basename(os.path.normpath(path))
+    if res.endswith(LOCK_SUFFIX):
+        res = res[:-len(LOCK_SUFFIX)]
+    return res
+
+
+class Journal(Tester):
+    SCHEMA = ("CREATE TABLE IF NOT EXISTS events (id INTEGER PRIMARY KEY, ts REAL, frame TEXT, folder TEXT, state INTEGER)",
+              "CREATE INDEX IF NOT EXISTS events_frame ON events (frame)",
+              "CREATE INDEX IF NOT EXISTS events_folder ON events (folder)")
+
+    def __init__(self, filename=JOURNAL_FILE, debug_level=None):
+        Tester.__init__(self, def_file="journal", debug_level=debug_level, nofile=True)
+
+        self.filename = filename
+
+        # one connection shared by the threads
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(filename, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        with self.conn:
+            for sql in self.SCHEMA:
+                self.conn.execute(sql)
+
+    def record(self, frames, folder, state):
+        """
+        Appends the transition of several frames
+        :param frames: tif file names or paths
+        :param folder: stage folder
+        :param state:
+        :return:
+        """
+        if len(frames) == 0:
+            return
+
+        ts = time.time()
+        folder = get_folder_name(folder)
+        rows = [(ts, os.path.basename(fn), folder, state) for fn in frames]
+        with self._lock:
+            with self.conn:
+                self.conn.executemany("INSERT INTO events (ts, frame, folder, state) VALUES (?, ?, ?, ?)", rows)
+
+    def record_folder(self, folder, state):
+        """
+        Appends the transition of all the frames last seen in a folder - the folder is not listed
+        Finalized frames have nothing to replay - the events of the folder are removed, the table stays small
+        :param folder:
+        :param state:
+        :return:
+        """
+        with self._lock:
+            with self.conn:
+                if state == STATE_FINALIZED:
+                    self.conn.execute("DELETE FROM events WHERE folder = ?", (get_folder_name(folder),))
+                    return
+                self.conn.execute("INSERT INTO events (ts, frame, folder, state) "
+                                  "SELECT ?, frame, folder, ? FROM events WHERE folder = ? GROUP BY frame",
+                                  (time.time(), state, get_folder_name(folder)))
+
+    def replay(self):
+        """
+        Returns the folders holding unfinished frames, finalized frames left by the older versions are removed
+        :return: dictionary, folder - (lowest state of its frames, highest state, list of frames)
+        """
+        with self._lock:
+            with self.conn:
+                # a frame name may be claimed again after it was finalized - only the older events are removed
+                self.conn.execute("DELETE FROM events WHERE id <= (SELECT MAX(e.id) FROM events e "
+                                  "WHERE e.frame = events.frame AND e.state = ?)", (STATE_FINALIZED,))
+            rows = self.conn.execute("SELECT frame, folder, state FROM events WHERE id IN "
+                                     "(SELECT MAX(id) FROM events GROUP BY frame)").fetchall()
+
+        res = {}
+        for (frame, folder, state) in rows:
+            low, high, frames = res.get(folder, (state, state, []))
+            frames.append(frame)
+            res[folder] = (min(low, state), max(high, state), frames)
+        return res
+
+    def forget(self, frames):
+        """
+        Removes the frames from the journal
+        :param frames:
+        :return:
+        """
+        with self._lock:
+            with self.conn:
+                self.conn.executemany("DELETE FROM events WHERE frame = ?", [(os.path.basename(fn),) for fn in frames])
+
+    def close(self):
+        with self._lock:
+            self.conn.close()
+
+    def recover(self, raw_dir, temp_dir, proc_dir):
+        """
+        Resumes or rolls back the folders left in flight by the previous run
+        Claimed frames go back to the raw directory, the other folders are unlocked for the plugins
+        Without a record a locked temporary folder may not hold all the files of its frames - it is rolled back
+        :param raw_dir:
+        :param temp_dir:
+        :param proc_dir:
+        :return: (number of resumed folders, number of rolled back folders)
+        """
+        timestamp = time.time()
+        folders = self.replay()
+
+        # locked folders without records (the journal did not exist before or was lost) are found by a single listing
+        # of the stage directories - they are handled the same as with an empty journal
+        # only the processed folders are known to be complete, the temporary ones are handled as claimed
+        locked = {}
+        for (path, state) in ((temp_dir, STATE_CLAIMED), (proc_dir, STATE_PROCESSED)):
+            try:
+                names = os.listdir(path)
+            except OSError:
+                continue
+            for name in names:
+                if name.endswith(LOCK_SUFFIX):
+                    locked[get_folder_name(name)] = (state, state, [])
+
+        for (folder, record) in locked.items():
+            if folder not in folders:
+                folders[folder] = record
+
+        resumed, rolled_back = 0, 0
+        for (folder, (low, high, frames)) in folders.items():
+            if high == STATE_CLAIMED:
+                # the folder has never been unlocked - the frames are moved back to the raw directory
+                path = os.path.join(temp_dir, folder + LOCK_SUFFIX)
+                if os.path.isdir(path):
+                    self.rollback(path, raw_dir)
+                    rolled_back += 1
+                self.forget(frames)
+                continue
+
+            found = False
+            for stage_dir in (proc_dir, temp_dir) if high >= STATE_PROCESSED else (temp_dir, proc_dir):
+                path = os.path.join(stage_dir, folder)
+                if os.path.isdir(path + LOCK_SUFFIX):
+                    try:
+                        os.rename(path + LOCK_SUFFIX, path)
+                        found = True
+                    except OSError as e:
+                        self.error("Could not unlock the folder (%s): %s", path + LOCK_SUFFIX, e)
+                    break
+                elif os.path.isdir(path):
+                    found = True
+                    break
+
+            if found:
+                resumed += 1
+                self.info("Folder (%s) is resumed from the state (%s)", folder, STATE_NAMES.get(low))
+            else:
+                # the folder was finalized or removed after the last record
+                self.forget(frames)
+
+        self.info("Journal was replayed in (%.3fs): resumed (%d), rolled back (%d) folders",
+                  time.time() - timestamp, resumed, rolled_back)
+        return resumed, rolled_back
+
+    def rollback(self, path, raw_dir):
+        """
+        Moves the files of a claimed folder back to the raw directory, removes the folder
+        :param path:
+        :param raw_dir:
+        :return:
+        """
+        for name in os.listdir(path):
+            try:
+                os.rename(os.path.join(path, name), os.path.join(raw_dir, name))
+            except OSError:
+                shutil.move(os.path.join(path, name), os.path.join(raw_dir, name))
+        shutil.rmtree(path, ignore_errors=True)
+        self.info("Claimed frames of (%s) were moved back to (%s)", path, raw_dir)
+
+
+def get_journal():
+    return _JOURNAL
+
+
+def open_journal(filename=JOURNAL_FILE, debug_level=None):
+    """
+    Opens the journal if it is not open
+    :param filename:
+    :param debug_level:
+    :return:
+    """
+    global _JOURNAL
+    with _JOURNAL_LOCK:
+        if _JOURNAL is None:
+            _JOURNAL = Journal(filename, debug_level=debug_level)
+    return _JOURNAL
+
+
+def close_journal():
+    global _JOURNAL
+    with _JOURNAL_LOCK:
+        res, _JOURNAL = _JOURNAL, None
+    if res is not None:
+        res.close()
+
+
+def record_frames(frames, folder, state):
+    """
+    Records the transition of the frames if the journal is open, errors are only reported
+    :param frames:
+    :param folder:
+    :param state:
+    :return:
+    """
+    journal = _JOURNAL
+    if journal is None:
+        return
+    try:
+        journal.record(frames, folder, state)
+    except sqlite3.Error as e:
+        journal.error("Frames of (%s) could not be journaled: %s", folder, e)
+
+
+def record_folder(folder, state):
+    """
+    Records the transition of the frames of a folder if the journal is open
+    :param folder:
+    :param state:
+    :return:
+    """
+    journal = _JOURNAL
+    if journal is None:
+        return
+    try:
+        journal.record_folder(folder, state)
+    except sqlite3.Error as e:
+        journal.error("Folder (%s) could not be journaled: %s", folder, e)
+
+
+def forget_frames(frames):
+    """
+    Removes the frames from the journal if it is open - frames left in the raw directory
+    :param frames:
+    :return:
+    """
+    journal = _JOURNAL
+    if journal is None or len(frames) == 0:
+        return
+    try:
+        journal.forget(frames)
+    except sqlite3.Error as e:
+        journal.error("Frames (%s) could not be removed from the journal: %s", frames, e)
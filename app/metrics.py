@@ -0,0 +1,154 @@
+__author__ = 'Konstantin Glazyrin'
+
+"""
+Per stage latency and throughput metrics
+Every stage keeps a fixed size histogram of the per frame times (logarithmic buckets), the number of frames and bytes
+Rates are computed over a sliding window of one second slots - the memory use does not grow with the run time
+"""
+
+import math
+import time
+import threading
+
+# stages of a frame
+METRIC_DISCOVERY, METRIC_RAW_MOVE, METRIC_MERGE, METRIC_NEXUS, METRIC_FINALIZE = \
+    "discovery", "raw_move", "merge", "nexus", "finalize"
+METRIC_STAGES = (METRIC_DISCOVERY, METRIC_RAW_MOVE, METRIC_MERGE, METRIC_NEXUS, METRIC_FINALIZE)
+
+# histogram range (s) and resolution
+HIST_MIN, HIST_MAX = 1e-5, 1e3
+HIST_BUCKETS_PER_DECADE = 10
+
+# sliding window of the rates (s)
+RATE_WINDOW = 10
+
+_STAGES = {}
+_STAGES_LOCK = threading.Lock()
+
+
+class Histogram(object):
+    def __init__(self, vmin=HIST_MIN, vmax=HIST_MAX, per_decade=HIST_BUCKETS_PER_DECADE):
+        self.log_min = math.log10(vmin)
+        self.per_decade = per_decade
+
+        # underflow and overflow buckets at the ends
+        self.size = int(math.ceil((math.log10(vmax) - self.log_min) * per_decade)) + 2
+        self.counts = [0] * self.size
+        self.total = 0
+        self.max = 0.
+
+    def _index(self, value):
+        if value <= 0:
+            return 0
+        index = int(math.floor((math.log10(value) - self.log_min) * self.per_decade)) + 1
+        return max(0, min(self.size - 1, index))
+
+    def _upper(self, index):
+        """
+        Returns the upper bound of a bucket
+        :param index:
+        :return:
+        """
+        return 10 ** (self.log_min + float(index) / self.per_decade)
+
+    def add(self, value, count=1):
+        self.counts[self._index(value)] += count
+        self.total += count
+        self.max = max(self.max, value)
+
+    def percentile(self, p):
+        """
+        Returns the upper bound of the bucket holding the percentile, limited by the maximum value
+        :param p: 0-100
+        :return:
+        """
+        if self.total == 0:
+            return 0.
+
+        rank = p / 100. * self.total
+        acc = 0
+        for (index, count) in enumerate(self.counts):
+            acc += count
+            if acc >= rank and count > 0:
+                return min(self._upper(index), self.max)
+        return self.max
+
+
+class StageMetrics(object):
+    def __init__(self, name):
+        self.name = name
+        self.hist = Histogram()
+        self.frames = 0
+        self.bytes = 0
+
+        # one second slots of the sliding window - [second, frames, bytes]
+        self.slots = [[0, 0, 0] for i in range(RATE_WINDOW)]
+
+        self._lock = threading.Lock()
+
+    def record(self, seconds, frames=1, nbytes=0):
+        """
+        Records the processing of frames
+        :param seconds: time per frame (s)
+        :param frames:
+        :param nbytes:
+        :return:
+        """
+        now = int(time.time())
+        with self._lock:
+            self.hist.add(seconds, frames)
+            self.frames += frames
+            self.bytes += nbytes
+
+            slot = self.slots[now % RATE_WINDOW]
+            if slot[0] != now:
+                slot[0], slot[1], slot[2] = now, 0, 0
+            slot[1] += frames
+            slot[2] += nbytes
+
+    def get_stats(self):
+        """
+        Returns the statistics of the stage
+        :return: dictionary - frames, bytes, p50, p90, p99, max (s), fps (frames/s), mbps (MB/s)
+        """
+        now = int(time.time())
+        with self._lock:
+            # the current second is not complete yet
+            slots = [s for s in self.slots if now - RATE_WINDOW <= s[0] < now]
+            frames = sum([s[1] for s in slots])
+            nbytes = sum([s[2] for s in slots])
+
+            return {"frames": self.frames, "bytes": self.bytes,
+                    "p50": self.hist.percentile(50), "p90": self.hist.percentile(90),
+                    "p99": self.hist.percentile(99), "max": self.hist.max,
+                    "fps": float(frames) / RATE_WINDOW, "mbps": nbytes / 1e6 / RATE_WINDOW}
+
+
+def get_stage(name):
+    with _STAGES_LOCK:
+        res = _STAGES.get(name)
+        if res is None:
+            res = StageMetrics(name)
+            _STAGES[name] = res
+    return res
+
+
+def record(name, seconds, frames=1, nbytes=0):
+    """
+    Records the time per frame of a stage
+    :param name: stage
+    :param seconds: time per frame (s)
+    :param frames:
+    :param nbytes:
+    :return:
+    """
+    if frames > 0:
+        get_stage(name).record(seconds, frames=frames, nbytes=nbytes)
+
+
+def get_stats():
+    """
+    Returns the statistics of all the stages
+    :return: dictionary, stage - statistics
+    """
+    return dict([(name, get_stage(name).get_stats()) for name in METRIC_STAGES])
@@ -0,0 +1,234 @@
+__author__ = 'Konstantin Glazyrin'
+
+"""
+Pressure monitor of the RAM disk
+Free space of the raw, temporary and processed directories and the number of frames/folders waiting in every stage
+are sampled periodically, the worst value is mapped to a pressure level by the configurable watermarks
+Under pressure the finalize stage is boosted and the optional work (nexus files, master files) is deferred
+"""
+
+import threading
+
+from app.common import *
+from app.config import MONITOR_INTERVAL, MONITOR_HIGH_WATERMARK, MONITOR_CRITICAL_WATERMARK, MONITOR_HYSTERESIS
+from app.config import MONITOR_BACKLOG_HIGH, MONITOR_BACKLOG_CRITICAL
+from app.spool import get_spool, suspend_bandwidth
+
+try:
+    # python v3
+    from shutil import disk_usage as _disk_usage
+except ImportError:
+    _disk_usage = None
+
+# pressure levels
+PRESSURE_NORMAL, PRESSURE_HIGH, PRESSURE_CRITICAL = 0, 1, 2
+PRESSURE_NAMES = {PRESSURE_NORMAL: "normal", PRESSURE_HIGH: "high", PRESSURE_CRITICAL: "critical"}
+
+# optional work and the level it is deferred at
+OPTIONAL_NEXUS, OPTIONAL_MASTER = "nexus", "master"
+OPTIONAL_LEVELS = {OPTIONAL_NEXUS: PRESSURE_HIGH, OPTIONAL_MASTER: PRESSURE_CRITICAL}
+
+# stages
+STAGE_RAW, STAGE_TEMP, STAGE_PROC, STAGE_SPOOL = "raw", "temp", "proc", "spool"
+
+_MONITOR = None
+_MONITOR_LOCK = threading.Lock()
+
+
+def disk_usage(path):
+    """
+    Returns the total and the free space of the file system holding the path
+    :param path:
+    :return: (total bytes, free bytes)
+    """
+    if _disk_usage is not None:
+        res = _disk_usage(path)
+        return res.total, res.free
+
+    if hasattr(os, "statvfs"):
+        st = os.statvfs(path)
+        return st.f_blocks * st.f_frsize, st.f_bavail * st.f_frsize
+
+    # python v2 on windows
+    import ctypes
+    free, total = ctypes.c_ulonglong(0), ctypes.c_ulonglong(0)
+    if not ctypes.windll.kernel32.GetDiskFreeSpaceExW(ctypes.c_wchar_p(path), ctypes.byref(free),
+                                                      ctypes.byref(total), None):
+        raise OSError("Could not get the free space of ({})".format(path))
+    return total.value, free.value
+
+
+def _count_entries(path, suffix=None):
+    try:
+        names = os.listdir(path)
+    except OSError:
+        return 0
+    if suffix is not None:
+        names = [name for name in names if name.endswith(suffix)]
+    return len(names)
+
+
+class PressureMonitor(Tester):
+    def __init__(self, get_dirs, interval=MONITOR_INTERVAL, debug_level=None):
+        """
+        :param get_dirs: callable returning (raw_dir, temp_dir, proc_dir) - the directories may change at runtime
+        :param interval: sampling period (s)
+        :param debug_level:
+        """
+        Tester.__init__(self, def_file="monitor", debug_level=debug_level, nofile=True)
+
+        self.get_dirs = get_dirs
+        self.interval = interval
+
+        self.level = PRESSURE_NORMAL
+
+        # last sample - used fraction per directory, counts per stage
+        self.usage = {}
+        self.counts = {}
+
+        self._lock = threading.Lock()
+        self._stop_flag = threading.Event()
+
+        self.thread = threading.Thread(target=self._run, name="pressure_monitor")
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def stop(self, timeout=1.):
+        self._stop_flag.set()
+        self.thread.join(timeout)
+
+        # leave the other components in the normal state
+        self._apply(PRESSURE_NORMAL)
+
+    def sample(self):
+        """
+        Measures the free space and the backlog, updates the pressure level
+        :return: pressure level
+        """
+        raw_dir, temp_dir, proc_dir = self.get_dirs()
+
+        usage = {}
+        for path in (raw_dir, temp_dir, proc_dir):
+            try:
+                total, free = disk_usage(path)
+                usage[path] = 1. - float(free) / total if total > 0 else 0.
+            except (OSError, ValueError) as e:
+                self.debug("Could not get the free space of ({}): {}".format(path, e))
+
+        counts = {STAGE_RAW: _count_entries(raw_dir, ".tif"), STAGE_TEMP: _count_entries(temp_dir),
+                  STAGE_PROC: _count_entries(proc_dir), STAGE_SPOOL: 0}
+        spool = get_spool()
+        if spool is not None:
+            counts[STAGE_SPOOL] = spool.get_info()["queued"]
+
+        used = max(usage.values()) if len(usage) > 0 else 0.
+        backlog = counts[STAGE_TEMP] + counts[STAGE_PROC]
+
+        level = self._get_level(used, backlog)
+
+        with self._lock:
+            self.usage, self.counts = usage, counts
+            old, self.level = self.level, level
+
+        if level != old:
+            msg = "RAM disk pressure has changed from ({}) to ({}), used ({:.1%}), backlog ({})".format(
+                PRESSURE_NAMES[old], PRESSURE_NAMES[level], used, counts)
+            if level > old:
+                self.warning(msg)
+            else:
+                self.info(msg)
+            self._apply(level)
+        return level
+
+    def _get_level(self, used, backlog):
+        """
+        Maps the used fraction and the backlog to a level - a level is left only below its watermark minus hysteresis
+        :param used:
+        :param backlog:
+        :return:
+        """
+        res = PRESSURE_NORMAL
+        for (level, watermark, backlog_mark) in ((PRESSURE_CRITICAL, MONITOR_CRITICAL_WATERMARK, MONITOR_BACKLOG_CRITICAL),
+                                                 (PRESSURE_HIGH, MONITOR_HIGH_WATERMARK, MONITOR_BACKLOG_HIGH)):
+            if self.level >= level:
+                watermark -= MONITOR_HYSTERESIS
+                backlog_mark = int(backlog_mark * (1. - MONITOR_HYSTERESIS))
+
+            if used >= watermark or backlog >= backlog_mark:
+                res = level
+                break
+        return res
+
+    def _apply(self, level):
+        """
+        Changes the scheduling - finalize is boosted under pressure, the bandwidth limit is lifted if critical
+        :param level:
+        :return:
+        """
+        spool = get_spool()
+        if spool is not None:
+            spool.set_boost(level >= PRESSURE_HIGH)
+        suspend_bandwidth(level >= PRESSURE_CRITICAL)
+
+    def get_info(self):
+        """
+        Returns the last sample
+        :return: dictionary - level, usage (directory - used fraction), counts (stage - number of entries)
+        """
+        with self._lock:
+            return {"level": self.level, "usage": dict(self.usage), "counts": dict(self.counts)}
+
+    def _run(self):
+        while not self._stop_flag.is_set():
+            try:
+                self.sample()
+            except Exception as e:
+                self.error("RAM disk pressure could not be measured: {}".format(e))
+            self._stop_flag.wait(self.interval)
+
+
+def get_monitor():
+    return _MONITOR
+
+
+def start_monitor(get_dirs, debug_level=None):
+    """
+    Starts the monitor if it is not running
+    :param get_dirs: callable returning (raw_dir, temp_dir, proc_dir)
+    :param debug_level:
+    :return:
+    """
+    global _MONITOR
+    with _MONITOR_LOCK:
+        if _MONITOR is None:
+            _MONITOR = PressureMonitor(get_dirs, debug_level=debug_level)
+    return _MONITOR
+
+
+def stop_monitor():
+    global _MONITOR
+    with _MONITOR_LOCK:
+        res, _MONITOR = _MONITOR, None
+    if res is not None:
+        res.stop()
+
+
+def get_pressure_level():
+    """
+    Returns the current pressure level, PRESSURE_NORMAL if the monitor is not running
+    :return:
+    """
+    res = PRESSURE_NORMAL
+    monitor = _MONITOR
+    if monitor is not None:
+        res = monitor.level
+    return res
+
+
+def is_deferred(work):
+    """
+    Tests if an optional work should be deferred at the current pressure
+    :param work: OPTIONAL_NEXUS or OPTIONAL_MASTER
+    :return:
+    """
+    return get_pressure_level() >= OPTIONAL_LEVELS.get(work, PRESSURE_CRITICAL + 1)
@@ -0,0 +1,211 @@
+__author__ = 'Konstantin Glazyrin'
+
+"""
+In-process pipeline between the prepare, merge and finalize stages
+Folders are handed over from stage to stage through bounded queues, the directory renames (.lock) remain the source of truth
+If a stage queue is full, the folder is left in its directory and is picked up by the tick based plugins
+"""
+
+import threading
+
+try:
+    # python v2
+    import Queue as queue
+except ImportError:
+    import queue
+
+from app.common import *
+from app.config import PIPELINE_QUEUE_SIZE, PIPELINE_PUT_TIMEOUT, PIPELINE_WORKERS
+
+# names of the stages
+STAGE_MERGE, STAGE_FINALIZE = "merge", "finalize"
+
+# stage handlers registered by the plugin implementation - handler(path, *args, t=logger)
+_HANDLERS = {}
+
+_PIPELINE = None
+_PIPELINE_LOCK = threading.Lock()
+
+
+class Pipeline(Tester):
+    def __init__(self, size=PIPELINE_QUEUE_SIZE, timeout=PIPELINE_PUT_TIMEOUT, workers=PIPELINE_WORKERS,
+                 debug_level=None):
+        Tester.__init__(self, def_file="pipeline", debug_level=debug_level)
+
+        self.size = size
+        self.timeout = timeout
+        self.workers = workers
+
+        # name - {queue, threads}
+        self.stages = {}
+
+        # paths handed over to the pipeline - the tick based plugins should not touch them
+        self.in_flight = set()
+        self._lock = threading.Lock()
+
+        self._stop_flag = threading.Event()
+
+    def reserve(self, path):
+        """
+        Marks the path as owned by the pipeline - called before the folder becomes visible to the plugins
+        :param path:
+        :return:
+        """
+        with self._lock:
+            self.in_flight.add(_norm_path(path))
+
+    def release(self, path):
+        with self._lock:
+            self.in_flight.discard(_norm_path(path))
+
+    def is_busy(self, path):
+        with self._lock:
+            return _norm_path(path) in self.in_flight
+
+    def submit(self, name, path, *args):
+        """
+        Puts the folder into the queue of a stage, blocks up to timeout if the stage is full (backpressure)
+        :param name: stage name
+        :param path: folder path
+        :param args: additional arguments of the stage handler
+        :return: (bool) - True if the stage has accepted the folder
+        """
+        if self._stop_flag.is_set() or name not in _HANDLERS:
+            self.release(path)
+            return False
+
+        stage = self._get_stage(name)
+
+        self.reserve(path)
+        try:
+            stage["queue"].put((path, args), timeout=self.timeout)
+        except queue.Full:
+            self.warning("Pipeline stage ({}) is full, leaving ({}) to the plugins".format(name, path))
+            self.release(path)
+            return False
+
+        self.debug("Folder (%s) was submitted to the stage (%s)", path, name)
+        return True
+
+    def get_depths(self):
+        """
+        Returns the number of folders waiting in every stage
+        :return: dictionary, stage - number of folders
+        """
+        with self._lock:
+            return dict([(name, stage["queue"].qsize()) for (name, stage) in self.stages.items()])
+
+    def stop(self, timeout=1.):
+        """
+        Stops the consumer threads, folders left in the queues are picked up by the plugins
+        :param timeout:
+        :return:
+        """
+        self._stop_flag.set()
+        for name, stage in self.stages.items():
+            for th in stage["threads"]:
+                th.join(timeout)
+
+        with self._lock:
+            self.in_flight.clear()
+
+    def _get_stage(self, name):
+        """
+        Returns a stage, starts its consumer threads on the first use
+        :param name:
+        :return:
+        """
+        with self._lock:
+            stage = self.stages.get(name)
+            if stage is None:
+                stage = {"queue": queue.Queue(maxsize=self.size), "threads": []}
+                for i in range(self.workers):
+                    th = threading.Thread(target=self._consume, args=(name, stage["queue"]),
+                                          name="pipeline_{}".format(name))
+                    th.setDaemon(True)
+                    stage["threads"].append(th)
+                    th.start()
+                self.stages[name] = stage
+        return stage
+
+    def _consume(self, name, local_queue):
+        """
+        Consumer thread of a stage
+        :param name:
+        :param local_queue:
+        :return:
+        """
+        handler = _HANDLERS[name]
+        while not self._stop_flag.is_set():
+            try:
+                path, args = local_queue.get(timeout=0.5)
+            except queue.Empty:
+                continue
+
+            try:
+                handler(path, *args, t=self)
+            except Exception as e:
+                self.error("Pipeline stage ({}) has failed on ({}): {}".format(name, path, e))
+            finally:
+                self.release(path)
+                local_queue.task_done()
+
+
+def _norm_path(path):
+    return os.path.normcase(os.path.abspath(path))
+
+
+def register_stage(name, handler):
+    """
+    Registers a handler of a stage
+    :param name:
+    :param handler:
+    :return:
+    """
+    _HANDLERS[name] = handler
+
+
+def get_pipeline():
+    """
+    Returns the running pipeline or None
+    :return:
+    """
+    return _PIPELINE
+
+
+def start_pipeline(debug_level=None):
+    """
+    Starts the pipeline if it is not running
+    :param debug_level:
+    :return:
+    """
+    global _PIPELINE
+    with _PIPELINE_LOCK:
+        if _PIPELINE is None:
+            _PIPELINE = Pipeline(debug_level=debug_level)
+    return _PIPELINE
+
+
+def stop_pipeline():
+    """
+    Stops the pipeline
+    :return:
+    """
+    global _PIPELINE
+    with _PIPELINE_LOCK:
+        res, _PIPELINE = _PIPELINE, None
+    if res is not None:
+        res.stop()
+
+
+def is_busy(path):
+    """
+    Tests if the folder is owned by the pipeline
+    :param path:
+    :return:
+    """
+    res = False
+    pipeline = _PIPELINE
+    if pipeline is not None:
+        res = pipeline.is_busy(path)
+    return res
@@ -7,7 +7,7 @@ Please write it accordingly.
 
 # typical import for common funcitonality
 from app.plugins.plugins_common import *
-from app.workers import *
+from app.watcher import get_watcher
 
 ##########
 # The header which must exist
@@ -34,6 +34,9 @@ def setup(obj):
 # Unnesessary header
 NAME = "01_prepare_raw"
 
+# optional header - plugin is also fired by the daemon as soon as the raw directory watcher reports new files
+WATCH_RAW = True
+
 
 ##########
 # Major work load - worker has 3 parameters to load, called as a thread
@@ -47,6 +50,12 @@ class RawDataWorker(PluginWorker):
     # maximum number of processes to spawn for individual task
     MAX_PROC = 5
 
+    def __init__(self, *args, **kwargs):
+        PluginWorker.__init__(self, *args, **kwargs)
+
+        # files reported by the watcher which did not pass the requirements yet - persistent between the runs
+        self.pending_files = set()
+
     def work(self, *args, **kwargs):
         """ Do some useful work - lock/unlock functionality is already implemented"""
         PluginWorker.work(self, *args, **kwargs)
@@ -59,10 +68,14 @@ class RawDataWorker(PluginWorker):
 
         # we do useful work only if the raw and the temporary directories exits
         if self.check_directories(self.raw_dir, self.temp_dir):
-            self.info("Directories exist ({})".format((self.raw_dir, self.temp_dir)))
+            self.info("Directories exist (%s, %s)", self.raw_dir, self.temp_dir)
 
             # filter raw data, find files which satisfy requirements
-            self.get_existing_files()
+            watcher = get_watcher(self.raw_dir)
+            if watcher is not None:
+                self.get_watched_files(watcher)
+            else:
+                self.get_existing_files()
         else:
             self.error("Could not find either raw ({}) or temporary dir ({}), please create them".format(self.raw_dir,
                                                                                        self.temp_dir))
@@ -89,22 +102,67 @@ class RawDataWorker(PluginWorker):
     def get_existing_files(self):
         """
         Processes files in the raw data, checks them for requirements
+        The directory is read once - darks, frames and their meta are found in the same pass
         :return:
         """
+        try:
+            frames, darks, orphans = scan_raw_dir(self.raw_dir)
+        except OSError as e:
+            self.error("Could not scan the raw directory ({}): {}".format(self.raw_dir, e))
+            return
+
         # cleanup files which are useless from our point of view
-        self.FILES2REMOVE = list(glob.glob(os.path.join(self.raw_dir, "*dark*")))
+        self.FILES2REMOVE = darks
 
-        self.debug("List of files to remove ({})".format(self.FILES2REMOVE))
+        self.debug("List of files to remove (%s)", self.FILES2REMOVE)
         if len(self.FILES2REMOVE) > 0:
             self.remove_bad_files()
 
         # find files which are useful
-        files2store = glob.glob(os.path.join(self.raw_dir, "*.tif"))
-        self.check_existing_files(*files2store)
+        self.debug("List of promising files (%s), waiting for the meta (%s)", frames, orphans)
+        if len(frames) > 0:
+            self.EXISTING_FILES = self.check_scanned_files(frames)
 
         # move useful files to the new directories with lock
         self.move_existing_files()
 
+    def get_watched_files(self, watcher):
+        """
+        Processes files reported by the watcher - cost depends on the number of new files, not on the directory size
+        Files which do not satisfy the requirements yet stay pending until the next run
+        :param watcher:
+        :return:
+        """
+        events = watcher.get_events()
+        while True:
+            for fn in events:
+                if "dark" in os.path.basename(fn):
+                    self.FILES2REMOVE.append(fn)
+                elif fn.endswith(".tif.metadata"):
+                    self.pending_files.add(fn[:-len(".metadata")])
+                elif fn.endswith(".tif"):
+                    self.pending_files.add(fn)
+
+            self.debug("List of files to remove (%s)", self.FILES2REMOVE)
+            if len(self.FILES2REMOVE) > 0:
+                self.remove_bad_files()
+                self.FILES2REMOVE = []
+
+            # forget files which have disappeared
+            self.pending_files = set([fn for fn in self.pending_files if os.path.exists(fn)])
+
+            self.check_existing_files(*sorted(self.pending_files))
+            self.pending_files.difference_update(self.EXISTING_FILES)
+
+            # files which could not be moved are retried on the next run
+            self.pending_files.update(self.move_existing_files())
+            self.EXISTING_FILES = []
+
+            # files could have arrived while we were busy
+            events = watcher.get_events()
+            if len(events) == 0:
+                break
+
     def remove_bad_files(self):
         """
         Removes the files found to be unnecessary
@@ -112,7 +170,7 @@ class RawDataWorker(PluginWorker):
         """
         # TODO: remove files by spanning some processes
         for fn in self.FILES2REMOVE:
-            self.debug("Removing ({})".format(fn))
+            self.debug("Removing (%s)", fn)
 
         temp_copy = copy.deepcopy(self.FILES2REMOVE)
         self.remove_raw_files(self.max_proc, *temp_copy)
@@ -134,24 +192,26 @@ class RawDataWorker(PluginWorker):
             if patt.match(file):
                 files2raw.append(file)
 
-        self.debug("List of promising files ({})".format(files2raw))
+        self.debug("List of promising files (%s)", files2raw)
         if len(files2raw) > 0:
             self.EXISTING_FILES = list(self.check_raw_files(*files2raw))
 
     def move_existing_files(self):
         """
         Moves the existing files to the temporary folder
-        :return:
+        :return: list of files left in the raw directory
         """
+        res = []
         if len(self.EXISTING_FILES) > 0:
             temp_files = copy.deepcopy(self.EXISTING_FILES)
-            self.debug("Starting the file moving process ({})".format(temp_files))
-            self.move_raw_files(self.max_proc, self.temp_dir, *temp_files)
+            self.debug("Starting the file moving process (%s)", temp_files)
+            res = self.move_raw_files(self.max_proc, self.temp_dir, *temp_files)
+        return res
 
 
 # default implementation of the exported work function
 plugin_id = os.path.basename(__file__)
-worker = RawDataWorker(def_file=plugin_id, debug_level=PluginWorker.DEBUG)
+worker = LazyWorker(RawDataWorker, def_file=plugin_id, debug_level=PluginWorker.DEBUG)
 work = worker.run
 
 ##########
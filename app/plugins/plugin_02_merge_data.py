@@ -7,7 +7,7 @@ Please write it accordingly.
 
 # typical import for common funcitonality
 from app.plugins.plugins_common import *
-from app.workers import *
+from app.pipeline import is_busy
 
 ##########
 # The header which must exist
@@ -56,7 +56,7 @@ class MergeDataWorker(PluginWorker):
 
         # we do useful work only if the raw and the processed directories exits
         if self.check_directories(self.temp_dir, self.proc_dir):
-            self.info("Directories exist ({})".format((self.temp_dir, self.proc_dir)))
+            self.info("Directories exist (%s, %s)", self.temp_dir, self.proc_dir)
 
             # obtain data to be processed
             self.get_existing_files()
@@ -85,7 +85,7 @@ class MergeDataWorker(PluginWorker):
         :return:
         """
         # cleanup files which are useless from our point of view
-        files2merge = glob.glob(os.path.join(self.temp_dir, "temp*"))
+        files2merge = scan_folders(self.temp_dir)
         self.check_existing_files(*files2merge)
 
         # process folders and data
@@ -108,16 +108,16 @@ class MergeDataWorker(PluginWorker):
         files2merge = []
 
         if len(temp) > 0:
-            # remove locked folders - skip folders with .lock and .dump in their names
-            files2merge = filter(lambda p: not ".lock" in p and not ".dump" in p, temp)
+            # remove locked folders - skip folders with .lock and .dump in their names and folders owned by the pipeline
+            files2merge = filter(lambda p: not ".lock" in p and not ".dump" in p and not is_busy(p), temp)
 
-        self.debug("List of folders containing files to process ({})".format(files2merge))
+        self.debug("List of folders containing files to process (%s)", files2merge)
         if len(files2merge) > 0:
             self.FILES2MERGE = list(files2merge)
 
 # default implementation of the exported work function
 plugin_id = os.path.basename(__file__)
-worker = MergeDataWorker(def_file=plugin_id, debug_level=PluginWorker.DEBUG)
+worker = LazyWorker(MergeDataWorker, def_file=plugin_id, debug_level=PluginWorker.DEBUG)
 work = worker.run
 
 ##########
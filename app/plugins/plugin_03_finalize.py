@@ -7,7 +7,7 @@ Please write it accordingly.
 
 # typical import for common funcitonality
 from app.plugins.plugins_common import *
-from app.workers import *
+from app.pipeline import is_busy
 
 ##########
 # The header which must exist
@@ -56,13 +56,17 @@ class ProcessedDataWorker(PluginWorker):
 
         # we do useful work only if the raw and the processed directories exits
         if self.check_directories(self.output_dir, self.proc_dir):
-            self.info("Directories exist ({})".format((self.output_dir, self.proc_dir)))
+            self.info("Directories exist (%s, %s)", self.output_dir, self.proc_dir)
 
             # obtain data to be processed
             self.get_existing_files()
 
             # move processed files into the processed folder
             self.move_existing_files()
+
+            # master files of the finished scans are closed and published
+            if NEXUS_MASTER:
+                close_idle_masters()
         else:
             self.error("Could not find either temporary ({}) or processed dir ({}), please create them".format(self.temp_dir,
                                                                                                          self.proc_dir))
@@ -84,7 +88,7 @@ class ProcessedDataWorker(PluginWorker):
 
     def get_existing_files(self):
         # cleanup files which are useless from our point of view
-        files2move = glob.glob(os.path.join(self.proc_dir, "temp*"))
+        files2move = scan_folders(self.proc_dir)
         self.check_existing_files(*files2move)
 
     def check_existing_files(self, *args):
@@ -97,10 +101,10 @@ class ProcessedDataWorker(PluginWorker):
         files2move = []
 
         if len(temp) > 0:
-            # remove locked folders - skip folders with .lock and .dump in their names
-            files2move = filter(lambda p: not ".lock" in p and not ".dump" in p, temp)
+            # remove locked folders - skip folders with .lock and .dump in their names and folders owned by the pipeline
+            files2move = filter(lambda p: not ".lock" in p and not ".dump" in p and not is_busy(p), temp)
 
-        self.debug("List of folders containing files to move ({})".format(files2move))
+        self.debug("List of folders containing files to move (%s)", files2move)
         if len(files2move) > 0:
             self.EXISTING_FILES = list(files2move)
 
@@ -115,7 +119,7 @@ class ProcessedDataWorker(PluginWorker):
 
 # default implementation of the exported work function
 plugin_id = os.path.basename(__file__)
-worker = ProcessedDataWorker(def_file=plugin_id, debug_level=PluginWorker.DEBUG)
+worker = LazyWorker(ProcessedDataWorker, def_file=plugin_id, debug_level=PluginWorker.DEBUG)
 work = worker.run
 
 ##########
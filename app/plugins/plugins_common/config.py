@@ -1 +1,6 @@
-MEMCACHED_HOST = '127.0.0.1:55211'
\ No newline at end of file
+MEMCACHED_HOST = '127.0.0.1:55211'
+
+# number of persistent memcached connections shared by the threads
+MEMCACHED_POOL_SIZE = 4
+# values are collected and sent in one round trip at most every interval (s), 0 - sent at once
+MEMCACHED_FLUSH_INTERVAL = 0.
@@ -0,0 +1,341 @@
+__author__ = 'Konstantin Glazyrin'
+
+"""
+Copy engine of the finalize stage - RAM disk to the remote output
+The kernel copies the data where possible (os.copy_file_range, os.sendfile), large aligned buffers are used otherwise
+Every chunk is taken from the bandwidth limit of the spool
+Files of a folder are copied concurrently (one by one in the spool), the throughput is accumulated per destination directory
+Copies are verified by their size, checksums (COPY_CHECKSUM) are computed on the copied chunks instead of the kernel copy
+Sizes and checksums are kept in a per folder manifest - files which match it are not copied again
+"""
+
+import io
+import os
+import json
+import time
+import shutil
+import hashlib
+import threading
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+from app.config import COPY_BUFFER_SIZE, COPY_WORKERS, COPY_CHECKSUM
+from app.pool import POOL_COPY, get_pool
+from app.spool import throttle, is_throttled
+
+# alignment of the copy buffer
+BUFFER_ALIGNMENT = 64 * 1024
+
+# chunk handed to the kernel per call
+KERNEL_CHUNK = 64 * 1024 * 1024
+
+# weight of the last copy in the running throughput value
+RATE_WEIGHT = 0.2
+
+# destination - {bytes, files, time, rate}
+_RATES = {}
+_RATES_LOCK = threading.Lock()
+
+# the kernel methods are disabled after the first failure (e.g. a network share not supporting them)
+_KERNEL_COPY = {"copy_file_range": hasattr(os, "copy_file_range"), "sendfile": hasattr(os, "sendfile")}
+
+_BUFFERS = threading.local()
+
+# manifest of a local folder - hidden from glob("*")
+MANIFEST_NAME = ".manifest.json"
+# manifest stored next to the copies
+MANIFEST_SUFFIX = ".manifest.json"
+
+# checksum algorithms in the order of preference
+CHECKSUM_XXH64, CHECKSUM_BLAKE2B, CHECKSUM_SHA1 = "xxh64", "blake2b", "sha1"
+
+
+def get_checksum_algorithm():
+    """
+    Returns the fastest available checksum algorithm
+    :return:
+    """
+    if xxhash is not None:
+        return CHECKSUM_XXH64
+    if hasattr(hashlib, "blake2b"):
+        return CHECKSUM_BLAKE2B
+    return CHECKSUM_SHA1
+
+
+def new_hasher(algorithm=None):
+    """
+    Returns a new hash object
+    :param algorithm:
+    :return:
+    """
+    if algorithm is None:
+        algorithm = get_checksum_algorithm()
+
+    if algorithm == CHECKSUM_XXH64:
+        return xxhash.xxh64()
+    elif algorithm == CHECKSUM_BLAKE2B:
+        return hashlib.blake2b(digest_size=16)
+    return hashlib.new(algorithm)
+
+
+def _get_buffer(size=COPY_BUFFER_SIZE):
+    """
+    Returns the copy buffer of the thread - allocated once, size aligned to BUFFER_ALIGNMENT
+    :param size:
+    :return: memoryview
+    """
+    size = max(BUFFER_ALIGNMENT, (int(size) + BUFFER_ALIGNMENT - 1) // BUFFER_ALIGNMENT * BUFFER_ALIGNMENT)
+    buf = getattr(_BUFFERS, "buf", None)
+    if buf is None or len(buf) != size:
+        buf = memoryview(bytearray(size))
+        _BUFFERS.buf = buf
+    return buf
+
+
+def _kernel_copy(method, fsrc, fdst, size):
+    """
+    Copies the data by the kernel
+    :param method: "copy_file_range" or "sendfile"
+    :param fsrc: source file descriptor
+    :param fdst: destination file descriptor
+    :param size: size of the source file
+    :return: number of bytes copied
+    """
+    # smaller chunks keep a limited bandwidth smooth
+    chunk = COPY_BUFFER_SIZE if is_throttled() else KERNEL_CHUNK
+
+    offset = 0
+    while offset < size:
+        count = min(chunk, size - offset)
+        throttle(count)
+        if method == "copy_file_range":
+            sent = os.copy_file_range(fsrc, fdst, count)
+        else:
+            sent = os.sendfile(fdst, fsrc, offset, count)
+        if sent == 0:
+            break
+        offset += sent
+    return offset
+
+
+def _buffer_copy(fsrc, fdst, hasher=None):
+    """
+    Copies the data through a large buffer
+    :param fsrc: source file object (unbuffered)
+    :param fdst: destination file object (unbuffered)
+    :param hasher: hash object updated with every chunk
+    :return: number of bytes copied
+    """
+    buf = _get_buffer()
+    res = 0
+    while True:
+        count = fsrc.readinto(buf)
+        if not count:
+            break
+
+        throttle(count)
+
+        chunk = buf[:count]
+        if hasher is not None:
+            hasher.update(chunk)
+
+        while len(chunk) > 0:
+            written = fdst.write(chunk)
+            if written is None:
+                written = len(chunk)
+            chunk = chunk[written:]
+        res += count
+    return res
+
+
+def copy_file(src, dst, checksum=COPY_CHECKSUM):
+    """
+    Copies a single file, the permission bits are copied as well
+    The checksum is computed on the copied chunks - the kernel copy is not used then, the source is read once
+    The size of the copy is verified in any case
+    :param src: source file
+    :param dst: destination file or directory
+    :param checksum: compute the checksum
+    :return: (number of bytes copied, hex digest or None), raises IOError if the copy is incomplete
+    """
+    if os.path.isdir(dst):
+        dst = os.path.join(dst, os.path.basename(src))
+
+    hasher = new_hasher() if checksum else None
+
+    size = os.path.getsize(src)
+    with io.open(src, "rb", buffering=0) as fsrc:
+        with io.open(dst, "wb", buffering=0) as fdst:
+            res = None
+            for method in ("copy_file_range", "sendfile"):
+                if hasher is not None or not _KERNEL_COPY[method]:
+                    continue
+                try:
+                    res = _kernel_copy(method, fsrc.fileno(), fdst.fileno(), size)
+                    break
+                except OSError:
+                    # not supported by the file systems - start from the beginning with the next method
+                    _KERNEL_COPY[method] = False
+                    fsrc.seek(0)
+                    fdst.seek(0)
+                    fdst.truncate()
+                    res = None
+
+            if res is None or res < size:
+                if hasher is not None:
+                    hasher = new_hasher()
+                fsrc.seek(0)
+                fdst.seek(0)
+                res = _buffer_copy(fsrc, fdst, hasher=hasher)
+                fdst.truncate()
+
+    # a file changed during the copy or a short write of the destination file system
+    copied = os.path.getsize(dst)
+    if res != size or copied != size:
+        raise IOError("Copy of ({}) is incomplete: ({}) of ({}) bytes".format(src, copied, size))
+
+    try:
+        shutil.copymode(src, dst)
+    except OSError:
+        pass
+    return res, hasher.hexdigest() if hasher is not None else None
+
+
+def _copy_task(item):
+    """
+    Worker of the copy pool
+    :param item: (src, dst, copy function)
+    :return: (src, bytes copied, elapsed time, error, digest)
+    """
+    src, dst, func = item
+    timestamp = time.time()
+    try:
+        size, digest = func(src, dst)
+        return src, size, time.time() - timestamp, None, digest
+    except (OSError, IOError) as e:
+        return src, 0, time.time() - timestamp, e, None
+
+
+def copy_files(files, outdir, func=None, workers=COPY_WORKERS):
+    """
+    Copies several files into a directory concurrently
+    :param files:
+    :param outdir:
+    :param func: copy function func(src, outdir) returning (bytes, digest), copy_file by default
+    :param workers: number of concurrent copies
+    :return: list of (src, bytes copied, elapsed time, error, digest) in the order of files
+    """
+    if func is None:
+        func = copy_file
+
+    timestamp = time.time()
+    if len(files) > 1 and workers > 1:
+        res = get_pool(POOL_COPY, workers).map(_copy_task, [(fn, outdir, func) for fn in files])
+        res = [r if r is not None else (fn, 0, 0., IOError("Copy task has failed"), None) for (fn, r) in zip(files, res)]
+    else:
+        res = [_copy_task((fn, outdir, func)) for fn in files]
+
+    add_rate(outdir, sum([r[1] for r in res]), len([r for r in res if r[3] is None]), time.time() - timestamp)
+    return res
+
+
+def read_manifest(path):
+    """
+    Reads the manifest of a local folder
+    :param path: folder
+    :return: dictionary - algorithm, files {name: {size, mtime, digest}}
+    """
+    res = {"algorithm": get_checksum_algorithm(), "files": {}}
+    try:
+        with open(os.path.join(path, MANIFEST_NAME), "r") as fh:
+            data = json.load(fh)
+        if data.get("algorithm") == res["algorithm"]:
+            res["files"].update(data.get("files", {}))
+    except (IOError, OSError, ValueError):
+        pass
+    return res
+
+
+def write_manifest(filename, manifest):
+    """
+    Writes a manifest
+    :param filename:
+    :param manifest:
+    :return:
+    """
+    with open(filename, "w") as fh:
+        json.dump(manifest, fh, indent=1, sort_keys=True)
+
+
+def add_to_manifest(manifest, src, size, digest):
+    """
+    Records a copied file
+    :param manifest:
+    :param src: local file
+    :param size:
+    :param digest:
+    :return:
+    """
+    manifest["files"][os.path.basename(src)] = {"size": size, "mtime": os.path.getmtime(src), "digest": digest}
+
+
+def is_copied(manifest, src, outdir):
+    """
+    Tests if a file has already been copied - the local file is unchanged and the copy has the recorded size
+    The copy is not read again
+    :param manifest:
+    :param src: local file
+    :param outdir:
+    :return:
+    """
+    name = os.path.basename(src)
+    el = manifest["files"].get(name)
+    if el is None:
+        return False
+
+    try:
+        st = os.stat(src)
+        if st.st_size != el["size"] or st.st_mtime != el["mtime"]:
+            return False
+        return os.path.getsize(os.path.join(outdir, name)) == el["size"]
+    except (OSError, KeyError):
+        return False
+
+
+def add_rate(dest, size, files, elapsed):
+    """
+    Accumulates the throughput to a destination
+    :param dest:
+    :param size: bytes
+    :param files:
+    :param elapsed: s
+    :return:
+    """
+    with _RATES_LOCK:
+        el = _RATES.setdefault(dest, {"bytes": 0, "files": 0, "time": 0., "rate": 0.})
+        el["bytes"] += size
+        el["files"] += files
+        el["time"] += elapsed
+
+        if elapsed > 0 and size > 0:
+            rate = size / elapsed / 1e6
+            if el["rate"] == 0.:
+                el["rate"] = rate
+            else:
+                el["rate"] = (1. - RATE_WEIGHT) * el["rate"] + RATE_WEIGHT * rate
+
+
+def get_rates():
+    """
+    Returns the throughput per destination
+    :return: dictionary, destination - {bytes, files, time, rate (MB/s, running value), average (MB/s)}
+    """
+    res = {}
+    with _RATES_LOCK:
+        for (dest, el) in _RATES.items():
+            res[dest] = dict(el)
+            res[dest]["average"] = el["bytes"] / el["time"] / 1e6 if el["time"] > 0 else 0.
+    return res
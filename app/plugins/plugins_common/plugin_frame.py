@@ -0,0 +1,116 @@
+__author__ = 'Konstantin Glazyrin'
+
+"""
+Zero copy access to the detector frames
+The strip layout of a TIFF file is parsed once, the pixel block is exposed as a read-only numpy.memmap or memoryview
+Consumers of the same frame share one mapping - frames must be released before the file is moved (windows locks mapped files)
+numpy is imported on the first pixel access
+"""
+
+import mmap
+import threading
+
+from app.plugins.plugins_common.plugin_tiff import read_tiff_ifd, read_tiff_layout
+
+# shared frames, key - file name
+_FRAMES = {}
+_FRAMES_LOCK = threading.Lock()
+
+
+class TiffFrame(object):
+    def __init__(self, filename):
+        self.filename = filename
+
+        with open(filename, "rb") as fh:
+            order, ifd_offset, entries = read_tiff_ifd(fh)
+            layout = read_tiff_layout(fh, order, entries)
+
+        self.width, self.height = layout["width"], layout["height"]
+        # numpy notation, e.g. <u2
+        self.dtype = layout["dtype"]
+        self.offset, self.size = layout["offset"], layout["size"]
+
+        # number of the consumers sharing the frame
+        self.refs = 0
+
+        # consumers of a shared frame map it once
+        self._lock = threading.Lock()
+        self._data = None
+        self._fh = None
+        self._mmap = None
+
+    @property
+    def shape(self):
+        return (self.height, self.width)
+
+    @property
+    def data(self):
+        """
+        Read-only numpy view of the pixel block, the file is mapped on the first access
+        :return:
+        """
+        with self._lock:
+            if self._data is None:
+                import numpy
+                self._data = numpy.memmap(self.filename, dtype=self.dtype, mode="r", offset=self.offset,
+                                          shape=self.shape)
+            return self._data
+
+    def buffer(self):
+        """
+        Read-only memoryview of the pixel block bytes
+        :return:
+        """
+        with self._lock:
+            if self._mmap is None:
+                self._fh = open(self.filename, "rb")
+                self._mmap = mmap.mmap(self._fh.fileno(), 0, access=mmap.ACCESS_READ)
+            return memoryview(self._mmap)[self.offset:self.offset + self.size]
+
+    def close(self):
+        """
+        Releases the mappings - a memmap still referenced by a consumer is unmapped when the last view is gone
+        :return:
+        """
+        with self._lock:
+            self._data = None
+
+            if self._mmap is not None:
+                try:
+                    self._mmap.close()
+                except BufferError:
+                    pass
+                self._mmap = None
+
+            if self._fh is not None:
+                self._fh.close()
+                self._fh = None
+
+
+def open_frame(filename):
+    """
+    Returns a shared frame for the file, the layout is parsed only by the first consumer
+    :param filename:
+    :return: TiffFrame, raises ValueError for unsupported files
+    """
+    with _FRAMES_LOCK:
+        frame = _FRAMES.get(filename)
+        if frame is None:
+            frame = TiffFrame(filename)
+            _FRAMES[filename] = frame
+        frame.refs += 1
+    return frame
+
+
+def release_frame(frame):
+    """
+    Releases the frame, the mapping is closed when the last consumer has released it
+    :param frame:
+    :return:
+    """
+    with _FRAMES_LOCK:
+        frame.refs -= 1
+        if frame.refs > 0:
+            return
+        _FRAMES.pop(frame.filename, None)
+    frame.close()
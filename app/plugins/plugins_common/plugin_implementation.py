@@ -4,18 +4,33 @@ __author__ = 'Konstantin Glazyrin'
 General plugin object oriented implementation
 """
 
+import errno
 import shutil
+import multiprocessing
 import tempfile
-import queue
-import threading
 import re
-
-# data format specific
-import fabio
-import h5py
 import copy
 
+from functools import partial
+
 from app.common import *
+from app.config import MERGE_MODE, MERGE_PROCESS_THRESHOLD, MERGE_PROCESSES, TIFF_HEADER_ONLY
+from app.config import NEXUS_DATA_MODE, NEXUS_DATA_COMPRESSION, NEXUS_MASTER, RAW_BATCH_SIZE, COPY_WORKERS
+from app.plugins.plugins_common.plugin_tiff import update_tiff_header, is_tiff_complete
+from app.plugins.plugins_common.plugin_frame import TiffFrame, open_frame, release_frame
+from app.plugins.plugins_common.plugin_master import append_frame, close_idle_masters
+from app.plugins.plugins_common.plugin_metadata import read_header, is_metadata_complete
+from app.plugins.plugins_common.plugin_scan import scan_raw_dir, scan_folders
+from app.plugins.plugins_common.plugin_copy import copy_file, copy_files, MANIFEST_NAME, MANIFEST_SUFFIX
+from app.plugins.plugins_common.plugin_copy import read_manifest, write_manifest, add_to_manifest, is_copied
+from app.pool import POOL_LOCAL, POOL_MERGE, POOL_REMOTE, get_pool
+from app.pipeline import STAGE_MERGE, STAGE_FINALIZE, get_pipeline, register_stage
+from app.spool import get_spool
+from app.journal import STATE_CLAIMED, STATE_MOVED, STATE_MERGED, STATE_NEXUS, STATE_PROCESSED, STATE_FINALIZED
+from app.journal import record_frames, record_folder, forget_frames
+from app.frame_index import get_frame_index, index_frames
+from app.monitor import OPTIONAL_NEXUS, OPTIONAL_MASTER, is_deferred
+from app.metrics import METRIC_DISCOVERY, METRIC_RAW_MOVE, METRIC_MERGE, METRIC_NEXUS, METRIC_FINALIZE, record
 
 KEY_UNLOCK = "unlock"
 
@@ -24,36 +39,67 @@ OSTIMEOUT = 1
 # sleep time inbetween waiting for OS operation
 OSSLEEP = 0.1
 
+# execution modes of the merge stage
+MERGE_THREAD, MERGE_PROCESS, MERGE_AUTO = "thread", "process", "auto"
+
+# pool of the merge stage in the process mode
+POOL_MERGE_PROCESS = "merge_process"
+
+# keys of the merge reports
+MERGE_FILE, MERGE_HEADER, MERGE_TIME, MERGE_NEXUS_TIME = "file", "header", "merge_time", "nexus_time"
+
 class PluginWorker(MutexLock):
+    # frames are claimed once their structure is complete - the delay and the size threshold are used only
+    # for the files which cannot be checked (not a classic TIFF file)
     # value controlling check for test for a delay after the last file modification (s)
     FILE_MODIFICATION_DELAY = 0.2
 
     # value controlling minimal size of the file for the test of a valid file
     FILE_SIZE_THRESHOLD = 8
 
+    # pool size used if max_proc is not valid
+    MAX_PROC = 5
+
     def __init__(self, def_file=None, debug_level=None):
         MutexLock.__init__(self, def_file=def_file, debug_level=debug_level)
 
         self.id = def_file
 
+        # modification times of the frames found ready, the frames are not checked again before the move
+        self.raw_mtimes = {}
+
+        # frames found incomplete - tif file: (sizes and modification times), not read again until they change
+        self.incomplete = {}
+
+        # a run was refused during the last run (e.g. a watcher event) - the worker runs once more
+        self.rerun = False
+
     def run(self, *args, **kwargs):
         """
         General macro implementing a functionality
         :return:
         """
         self.debug("Entering the abstract implementation of run() function")
-        self.debug("Formal arguments are ({})".format(args))
-        self.debug("Variable length arguments are ({})".format(kwargs))
+        self.debug("Formal arguments are (%s)", args)
+        self.debug("Variable length arguments are (%s)", kwargs)
 
         # functionality on start
         res = self.on_start(args, kwargs)
+        if not res:
+            return
 
-        # useful load
-        if self.test(res):
-            self.work(args, kwargs)
+        while True:
+            # useful load
+            try:
+                self.work(args, kwargs)
+            finally:
+                # functionality on stop
+                self.on_stop(args, kwargs)
 
-        # functionality on stop
-        self.on_stop(args, kwargs)
+            # files announced during the run are handled at once, not on the next tick
+            if not self.rerun or not self.on_start(args, kwargs):
+                break
+            self.debug("Running again for the runs refused meanwhile")
 
     def on_start(self, *args, **kwargs):
         """
@@ -61,24 +107,18 @@ class PluginWorker(MutexLock):
         :return: (bool) - state of the lock - locked or not
         """
         self.debug("Entering the abstract implementation of on_start()")
-        self.debug("Input parameters are args ({}) and kwargs ({})".format(*args, **kwargs))
-        self.form_var, self.var_var = args[0], args[1]
+        self.debug("Input parameters are args (%s) and kwargs (%s)", args, kwargs)
 
-        res = True
+        # a run guard cannot be left stale - the force unlock (KEY_UNLOCK) is not needed anymore
+        if not self.acquire():
+            stats = self.get_run_stats()
+            self.debug("Previous run is still active.. Aborting (skipped %s, overlaps %s)", stats["skipped"],
+                       stats["overlaps"])
+            return False
 
-        # test if we need to force unlock
-        if self.var_var.has_key(KEY_UNLOCK):
-            if self.var_var[KEY_UNLOCK]:
-                self.debug("Unlocking by force")
-                self.unlock()
-
-        if self.is_locked():
-            self.debug("Device is locked.. Aborting.")
-            res = False
-
-        self.lock()
-
-        return res
+        # the arguments belong to the run holding the guard
+        self.form_var, self.var_var = args[0], args[1]
+        return True
 
     def on_stop(self, *args, **kwargs):
         """
@@ -86,11 +126,10 @@ class PluginWorker(MutexLock):
         :return:
         """
         self.debug("Entering the abstract implementation of on_stop()")
-        self.debug("Input parameters are args ({}) and kwargs ({})".format(*args, **kwargs))
-        form_var, var_var = args[0], args[1]
+        self.debug("Input parameters are args (%s) and kwargs (%s)", args, kwargs)
 
         # unlocking on stop
-        self.unlock()
+        self.rerun = self.release()
 
     def work(self, *args, **kwargs):
         """
@@ -98,9 +137,20 @@ class PluginWorker(MutexLock):
         :return:
         """
         self.debug("Entering the abstract implementation of work()")
-        self.debug("Input parameters are args ({}) and kwargs ({})".format(*args, **kwargs))
+        self.debug("Input parameters are args (%s) and kwargs (%s)", args, kwargs)
         form_var, var_var = args[0], args[1]
 
+    def get_pipeline_target(self):
+        """
+        Returns the directories used by the in-process pipeline stages (proc_dir, output_dir)
+        :return: tuple or None if the pipeline is not running
+        """
+        res = None
+        if get_pipeline() is not None:
+            raw_dir, temp_dir, proc_dir, output_dir, max_proc = self.form_var
+            res = (proc_dir, output_dir)
+        return res
+
     def check_directories(self, *args):
         """
         Tests that the provided directories exist
@@ -112,57 +162,123 @@ class PluginWorker(MutexLock):
             res = True
             for el in args:
                 if not os.path.isdir(el):
-                    self.error("Directory ({}) does not exist".format(el))
+                    self.error("Directory (%s) does not exist", el)
                     res = False
                     break
         return res
 
     def check_raw_files(self, *args, **kwargs):
         """
-        Checks non zero file size requirements for the files
+        Checks non zero file size requirements for the files - a single stat per file
         :return:
         """
         res = []
 
-        self.debug("List of files is ({})".format(args))
-        for fn in args:
-            self.debug("Checking file ({}) for requirements".format(fn))
+        self.debug("List of files is (%s)", args)
+        self.forget_incomplete(args)
 
-            # get timestamp
-            timestamp = time.time()
+        # get timestamp
+        timestamp = time.time()
+
+        for fn in args:
+            self.debug("Checking file (%s) for requirements", fn)
 
             fnmeta = self.get_meta(fn)
 
             # check that files exist
-            if not os.path.exists(fn) or not os.path.exists(fnmeta):
-                self.warning("Either the ({}) or ({}) do not exist".format(fn, fnmeta))
-                continue
-
             try:
-                # check if files have proper timestamp of modification time
-                fm, fmmeta = os.path.getmtime(fn), os.path.getmtime(fnmeta)
-
-                if timestamp - fm < self.FILE_MODIFICATION_DELAY or timestamp - fmmeta < self.FILE_MODIFICATION_DELAY:
-                    self.warning("Files ({}) or ({}) did not pass the time of modification test")
-                    raise ValueError
+                st, stmeta = os.stat(fn), os.stat(fnmeta)
+            except OSError:
+                self.warning("Either the (%s) or (%s) do not exist", fn, fnmeta)
+                continue
 
-                # check size
-                fs, fsmeta = os.path.getsize(fn), os.path.getsize(fnmeta)
+            if self.is_ready(fn, fnmeta, st, stmeta, timestamp):
+                res.append(fn)
+        return res
 
-                if fs < self.FILE_SIZE_THRESHOLD or fsmeta < self.FILE_SIZE_THRESHOLD:
-                    self.warning("Files ({}) or ({}) did not pass the time of modification test")
-                    raise ValueError
-            except OSError as e:
-                self.error("Either the main file ({}) or its meta ({}) have troubles".format(fn, fnmeta))
-                continue
-            except ValueError:
-                continue
+    def check_scanned_files(self, frames):
+        """
+        Checks the frames of a directory scan for requirements - the stat results of the scan are used
+        :param frames: list of (fn, fnmeta, tif stat, meta stat)
+        :return: list of the tif files
+        """
+        res = []
+        self.forget_incomplete([frame[0] for frame in frames])
 
-            # seems like the file is good - add it to the existing files
-            self.debug("Marking the file ({}) and its meta ({}) as valid".format(fn, fnmeta))
-            res.append(fn)
+        timestamp = time.time()
+        for (fn, fnmeta, st, stmeta) in frames:
+            if self.is_ready(fn, fnmeta, st, stmeta, timestamp):
+                res.append(fn)
         return res
 
+    def is_ready(self, fn, fnmeta, st, stmeta, timestamp):
+        """
+        Tests that a frame and its meta have been written completely - only the tiff header/IFD and the meta are read
+        Frames found incomplete are not read again until their size or modification time changes
+        The modification time of a ready frame is kept for move_raw_files
+        :param fn:
+        :param fnmeta:
+        :param st: stat of the tif file
+        :param stmeta: stat of the meta file
+        :param timestamp: current time
+        :return: (bool)
+        """
+        state = (st.st_size, st.st_mtime, stmeta.st_size, stmeta.st_mtime)
+        if self.incomplete.get(fn) == state:
+            return False
+
+        try:
+            res = is_tiff_complete(fn, size=st.st_size) and is_metadata_complete(fnmeta, st=stmeta)
+        except ValueError as e:
+            self.debug("Structure of (%s) cannot be checked (%s), testing the time of modification", fn, e)
+            res = self.is_settled(fn, fnmeta, st, stmeta, timestamp)
+        except (IOError, OSError) as e:
+            self.error("Either the main file (%s) or its meta (%s) have troubles: %s", fn, fnmeta, e)
+            return False
+
+        if not res:
+            self.debug("Files (%s) or (%s) are not complete yet", fn, fnmeta)
+            self.incomplete[fn] = state
+            return False
+
+        # seems like the file is good - add it to the existing files
+        self.debug("Marking the file (%s) and its meta (%s) as valid", fn, fnmeta)
+        self.incomplete.pop(fn, None)
+        self.raw_mtimes[fn] = st.st_mtime
+        return True
+
+    def is_settled(self, fn, fnmeta, st, stmeta, timestamp):
+        """
+        Tests the age and the size of the files - used for the files which cannot be checked on their structure
+        :param fn:
+        :param fnmeta:
+        :param st:
+        :param stmeta:
+        :param timestamp:
+        :return: (bool)
+        """
+        # check if files have proper timestamp of modification time
+        if timestamp - st.st_mtime < self.FILE_MODIFICATION_DELAY or timestamp - stmeta.st_mtime < self.FILE_MODIFICATION_DELAY:
+            self.warning("Files (%s) or (%s) did not pass the time of modification test", fn, fnmeta)
+            return False
+
+        # check size
+        if st.st_size < self.FILE_SIZE_THRESHOLD or stmeta.st_size < self.FILE_SIZE_THRESHOLD:
+            self.warning("Files (%s) or (%s) did not pass the size test", fn, fnmeta)
+            return False
+        return True
+
+    def forget_incomplete(self, files):
+        """
+        Keeps the incomplete state only of the files still waiting
+        :param files:
+        :return:
+        """
+        files = set(files)
+        for fn in list(self.incomplete.keys()):
+            if fn not in files:
+                del self.incomplete[fn]
+
     def get_meta(self, filename):
         """
         Returns name for the meta file
@@ -171,44 +287,72 @@ class PluginWorker(MutexLock):
         """
         return "{}{}".format(filename, ".metadata")
 
-    def move_raw_files(self, max_proc, outdir, *args):
+    def get_pool(self, name, max_proc):
         """
-        Copies files to the directory, unlocks directory - renames to the value without .lock
-        Thread based, limited by the maximum thread count of max_proc
+        Returns a long lived thread pool of the I/O class sized by max_proc
+        :param name:
+        :param max_proc:
         :return:
         """
+        if not self.test(max_proc) or int(max_proc) < 1:
+            max_proc = self.MAX_PROC
+        return get_pool(name, max_proc, maxproc=True)
+
+    def move_raw_files(self, max_proc, outdir, *args):
+        """
+        Moves files to new directories in batches of RAW_BATCH_SIZE frames, unlocks directories - renames to the value without .lock
+        Thread pool based, limited by the maximum thread count of max_proc
+        :return: list of files left in the raw directory
+        """
+
+        # folders are handed over to the merge stage if the pipeline is running
+        target = self.get_pipeline_target()
 
-        q = queue.Queue()
+        pairs = []
         if os.path.isdir(outdir):
+            now = time.time()
             for fn in args:
                 fnmeta = self.get_meta(fn)
 
-                # check that files exist
-                if not os.path.exists(fn) or not os.path.exists(fnmeta):
-                    self.warning("Either the ({}) or ({}) do not exist".format(fn, fnmeta))
+                # check that files exist - unless they have just been checked
+                mtime = self.raw_mtimes.pop(fn, None)
+                try:
+                    if mtime is None:
+                        mtime = os.path.getmtime(fn)
+                        if not os.path.exists(fnmeta):
+                            raise OSError
+                except OSError:
+                    self.warning("Either the (%s) or (%s) do not exist", fn, fnmeta)
                     continue
 
-                # add to a queue
-                q.put((fn, fnmeta, outdir))
+                # time from the last write of the frame to its discovery
+                record(METRIC_DISCOVERY, max(0., now - mtime))
+                pairs.append((fn, fnmeta))
 
-        threads = []
-        for i in range(max_proc):
-            th = threading.Thread(target=_move_raw_file, args=(q,), name="move_raw")
-            threads.append(th)
-            th.start()
+        # frames of a batch share a folder, consecutive frames stay together
+        pairs.sort()
+        size = max(1, int(RAW_BATCH_SIZE))
+        items = [(pairs[i:i + size], outdir, target) for i in range(0, len(pairs), size)]
+
+        self.raw_mtimes.clear()
 
         # block until the work is done
-        q.join()
+        failed = []
+        for res in self.get_pool(POOL_LOCAL, max_proc).map(_move_raw_file, items, self):
+            if res is None:
+                # the task has failed before moving anything
+                continue
+            failed.extend(res)
 
-        # join available threads
-        for th in threads:
-            th.join()
+        if len(failed) > 0:
+            self.warning("Files (%s) could not be moved, left in the raw directory", failed)
 
         self.debug("Moving raw files procedure is finished")
+        return failed
 
     def remove_raw_files(self, max_proc, *args):
         """
-        Spans multiprocessing (thread), removes files and waits until the multiprocess ends its operation
+        Removes files using the thread pool and waits until the pool ends its operation
         Python module multiprocessing was extremely slow for IO operation with the drive. We are limiting ourselves by max_proc argument
         :param max_proc:
         :param args:
@@ -216,241 +360,473 @@ class PluginWorker(MutexLock):
         """
 
         timestamp = time.time()
-        threads = []
-
-        q = queue.Queue()
-        for (i, fn) in enumerate(args):
-            q.put(fn)
-
-        for i in range(max_proc):
-            th = threading.Thread(target=_remove_file, args=(q,), name="remove_raw")
-            th.start()
-            threads.append(th)
 
-        q.join()
-        for th in threads:
-            th.join()
+        self.get_pool(POOL_LOCAL, max_proc).map(_remove_file, args, self)
 
-        self.debug("Pool was working for ({}s)".format(time.time() - timestamp))
+        self.debug("Pool was working for (%ss)", time.time() - timestamp)
 
     def process_raw_files(self, max_proc, *args):
         """
-        Spans multiprocessing (thread), locks the temporary directory, parses metadata,
-        Python module multiprocessing was extremely slow for IO operation with the drive. We are limiting ourselves by max_proc argument
+        Locks the temporary directory, parses metadata
+        Small bursts are processed by the thread pool (limited by max_proc), large bursts - by the process pool using all the cores
         :param max_proc:
         :param args:
-        :return:
+        :return: list of merge reports
         """
 
         timestamp = time.time()
-        threads = []
 
-        q = queue.Queue()
-        for (i, fn) in enumerate(args):
-            q.put(fn)
+        mode = self.get_merge_mode(len(args))
+        self.debug("Merging (%s) folders in the (%s) mode", len(args), mode)
+
+        if mode == MERGE_PROCESS:
+            # the children do not see the pressure monitor of the daemon - the decision is taken here
+            bdefer = is_deferred(OPTIONAL_NEXUS)
+            results = get_pool(POOL_MERGE_PROCESS, _get_merge_processes(), process=True).map(_merge_tiff_process, args,
+                                                                                              bdefer)
+        else:
+            results = self.get_pool(POOL_MERGE, max_proc).map(_merge_tiff_data, args, self)
+
+        res = []
+        for reports in results:
+            if reports is not None:
+                res.extend(reports)
 
-        for i in range(max_proc):
-            th = threading.Thread(target=_merge_tiff_data, args=(q,), name="process_raw")
-            th.start()
-            threads.append(th)
+        for report in res:
+            self.debug("Merged (%s) - tif (%.3fs), nexus (%s)", report[MERGE_FILE], report[MERGE_TIME],
+                       report[MERGE_NEXUS_TIME])
+        _record_merge_reports(res)
 
-        q.join()
-        for th in threads:
-            th.join()
+        self.debug("Pool was working for (%ss)", time.time() - timestamp)
+        return res
 
-        self.debug("Pool was working for ({}s)".format(time.time() - timestamp))
+    def get_merge_mode(self, num):
+        """
+        Returns the execution mode of the merge stage for a number of folders
+        :param num:
+        :return:
+        """
+        res = MERGE_MODE
+        if res == MERGE_AUTO:
+            res = MERGE_THREAD
+            if num >= MERGE_PROCESS_THRESHOLD:
+                res = MERGE_PROCESS
+        return res
 
     def move_processed_files(self, max_proc, outdir, *args):
         """
         Copies files to the directory, unlocks directory - renames to the value without .lock
-        Thread based, limited by the maximum thread count of max_proc
+        Thread pool based, limited by the maximum thread count of max_proc
         :return:
         """
 
-        q = queue.Queue()
+        items = []
         if os.path.isdir(outdir):
             for path in args:
-                # add to a queue
                 lock_path = "{}{}".format(path, '.lock')
 
-                # if we could lock - add to queue
+                # if we could lock - add to the list
                 if _shmove(path, lock_path, self):
-                    q.put(lock_path)
-
-        threads = []
-        for i in range(max_proc):
-            th = threading.Thread(target=_move_processed_file, args=(q, outdir,), name="move_processed")
-            threads.append(th)
-            th.start()
+                    items.append(lock_path)
 
         # block until the work is done
-        q.join()
-
-        # join available threads
-        for th in threads:
-            th.join()
+        self.get_pool(POOL_LOCAL, max_proc).map(_move_processed_file, items, outdir, self)
 
         self.debug("Moving processed files procedure is finished")
 
     def finalize_files(self, max_proc, outdir, *args):
         """
         Copies files to the directory, unlocks directory - renames to the value without .lock
-        Thread based, limited by the maximum thread count of max_proc
+        Locked folders are handed to the write-behind spool if it is running, otherwise
+        thread pool based, limited by the maximum thread count of max_proc
         :return:
         """
-        q = queue.Queue()
+        items = []
         if os.path.isdir(outdir):
             for path in args:
-                # add to a queue
                 lock_path = "{}{}".format(path, '.lock')
 
-                # if we could lock - add to queue
+                # if we could lock - add to the list
                 if _shmove(path, lock_path, self):
-                    q.put(lock_path)
+                    items.append(lock_path)
 
-        threads = []
-        for i in range(max_proc):
-            th = threading.Thread(target=_move_finalized_files, args=(q, outdir,), name="finalize_files")
-            threads.append(th)
-            th.start()
+        spool = get_spool()
+        if spool is not None:
+            spool.resize(max_proc)
+            for path in items:
+                spool.submit(path, _spool_finalize_path, outdir)
+
+            self.debug("Folders (%s) were queued for the remote directory (%s)", items, outdir)
+            return
 
         # block until the work is done
-        q.join()
+        self.get_pool(POOL_REMOTE, max_proc).map(_move_finalized_files, items, outdir, self)
+
+        self.debug("Finalization procedure of  is finished, files were copied to the remote directory (%s)", outdir)
 
-        # join available threads
-        for th in threads:
-            th.join()
+class LazyWorker(object):
+    """
+    Plugin worker built on its first run - importing a plugin does not create the logger and its log file
+    """
+    def __init__(self, cls, def_file=None, debug_level=None):
+        """
+        :param cls: worker class
+        :param def_file: log file of the worker
+        :param debug_level: log level of the worker
+        """
+        self.cls = cls
+        self.def_file, self.debug_level = def_file, debug_level
 
-        self.debug("Finalization procedure of  is finished, files were copied to the remote directory ({})".format(outdir))
+        self._worker = None
+        self._lock = threading.Lock()
+
+    def get(self):
+        """
+        Returns the worker, creates it if needed
+        :return:
+        """
+        with self._lock:
+            if self._worker is None:
+                self._worker = self.cls(def_file=self.def_file, debug_level=self.debug_level)
+        return self._worker
+
+    def run(self, *args, **kwargs):
+        return self.get().run(*args, **kwargs)
+
+    def get_run_stats(self):
+        """
+        Returns the run counters of the worker, empty before the first run
+        :return:
+        """
+        if self._worker is None:
+            return {}
+        return self._worker.get_run_stats()
 
 ###
 # individual worker functions - as less memory consumption as possible
 ###
 
-def _move_raw_file(local_queue, t=None):
+def _move_raw_file(item, t=None):
     """
-    Simple command to move raw files into a temporary folder
-    :param local_queue
-    :return:
+    Simple command to move a batch of raw files with their meta into a temporary folder
+    Raw and temporary directories share the same (RAM disk) file system - a single rename per file
+    :param item: (list of (fn, fnmeta), outdir, pipeline target)
+    :return: list of the tif files which could not be moved
     """
     t = _get_tester(t)
 
-    while not local_queue.empty():
-        item = local_queue.get()
-
-        fn, fnmeta, outdir = item
+    pairs, outdir, target = item
 
-        # create a temporary folder
-        tempfolder = tempfile.mkdtemp(suffix='.lock', prefix='temp_', dir=outdir)
-        finalfolder = tempfolder.replace(".lock", "")
+    # create a temporary folder
+    tempfolder = tempfile.mkdtemp(suffix='.lock', prefix='temp_', dir=outdir)
+    finalfolder = tempfolder.replace(".lock", "")
 
-        t.debug("Copying file ({}) and its meta ({}) to a new folder ({})".format(fn, fnmeta, tempfolder))
+    record_frames([p[0] for p in pairs], tempfolder, STATE_CLAIMED)
 
-        # make sure all the files are not readonly
-        for p in (fn, fnmeta, tempfolder):
-            os.chmod(p, stat.S_IWRITE)
+    t.debug("Moving (%d) files and their meta to a new folder (%s)", len(pairs), tempfolder)
+    timestamp = time.time()
 
-        # move files to this directory
+    failed = []
+    for (fn, fnmeta) in pairs:
+        moved = []
         for attempt in range(5):
             try:
-                shutil.move(fn, tempfolder)
-                shutil.move(fnmeta, tempfolder)
+                for p in (fn, fnmeta):
+                    if p not in moved:
+                        _rename(p, os.path.join(tempfolder, os.path.basename(p)))
+                        moved.append(p)
                 break
             except (OSError, IOError) as e:
-                t.error("OSError or IOError has occurred, we may have been too fast with renaming - try again..\n{} : {} : {}".format(
-                        e.errno, e.message, e.strerror))
+                t.error("OSError or IOError has occurred, we may have been too fast with renaming - try again..\n%s : %s",
+                        e.errno, e.strerror)
                 time.sleep(0.1)
                 continue
 
-        # unlock
-        _shmove(tempfolder, finalfolder, t)
+        if len(moved) < 2:
+            # the tif goes back to the raw directory if its meta stayed there
+            if len(moved) == 1:
+                _rename(os.path.join(tempfolder, os.path.basename(fn)), fn)
+            failed.append(fn)
+
+    moved = len(pairs) - len(failed)
+    if moved > 0:
+        record(METRIC_RAW_MOVE, (time.time() - timestamp) / moved, frames=moved)
+
+    # frames left in the raw directory are claimed again later
+    forget_frames(failed)
+
+    if len(failed) == len(pairs):
+        t.error("No files could be moved to (%s), removing it", tempfolder)
+        _shrmtree(tempfolder, t)
+        return failed
 
-        local_queue.task_done()
+    # the folder is owned by the merge stage before it becomes visible to the plugins
+    if target is not None:
+        _pipeline_reserve(finalfolder)
 
-def _move_processed_file(local_queue, outdir, t=None):
+    # unlock
+    _shmove(tempfolder, finalfolder, t)
+    record_frames([p[0] for p in pairs if p[0] not in failed], finalfolder, STATE_MOVED)
+
+    if target is not None:
+        _pipeline_submit(STAGE_MERGE, finalfolder, *target)
+    return failed
+
+def _rename(src, dst):
+    """
+    Renames a file, falls back to a copy if the directories are on different devices
+    :param src:
+    :param dst:
+    :return:
     """
-    Simple command to move raw files into a temporary folder
-    :param local_queue
+    try:
+        os.rename(src, dst)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        shutil.move(src, dst)
+
+def _move_processed_file(path, outdir, t=None):
+    """
+    Simple command to move a locked folder into the processed directory
+    :param path:
     :return:
     """
+    _move_processed_path(path, outdir, t)
+
+def _move_processed_path(path, outdir, t=None):
+    """
+    Moves a locked folder into the output directory and unlocks it there
+    :param path: folder path with .lock
+    :param outdir:
+    :return: final path of the folder
+    """
     t = _get_tester(t)
 
-    while not local_queue.empty():
-        item = local_queue.get()
+    # create a temporary folder
+    newpath = os.path.join(outdir, os.path.basename(path))
+    finalpath = os.path.join(newpath.replace(".lock", ""))
 
-        path = item
+    t.debug("Moving processed data (%s) to a new folder (%s)", path, outdir)
+    t.debug("Renaming processed data (%s) to a new folder (%s)", newpath, finalpath)
 
-        # create a temporary folder
-        newpath = os.path.join(outdir, os.path.basename(path))
-        finalpath = os.path.join(newpath.replace(".lock", ""))
+    # make sure all the files are not readonly
+    os.chmod(path, stat.S_IWRITE)
 
-        t.debug("Moving processed data ({}) to a new folder ({})".format(path, outdir))
-        t.debug("Renaming processed data ({}) to a new folder ({})".format(newpath, finalpath))
+    # move files into this directory
+    shutil.move(path, outdir)
 
+    # unlock
+    _shmove(newpath, finalpath, t)
+    record_folder(finalpath, STATE_PROCESSED)
 
-        # make sure all the files are not readonly
-        os.chmod(path, stat.S_IWRITE)
+    return finalpath
+
+def _move_finalized_files(path, outdir, t=None):
+    """
+    Simple command to copy the files of a locked folder into the output directory
+    :param path:
+    :return:
+    """
+    t = _get_tester(t)
 
-        # move files into this directory
-        shutil.move(path, outdir)
+    t.debug("Trying to finalize files into (%s)", outdir)
 
-        # unlock
-        _shmove(newpath, finalpath, t)
+    _finalize_path(path, outdir, t)
 
-        # stop if there were too many errors
-        local_queue.task_done()
+def _spool_finalize_path(path, outdir, t=None):
+    """
+    Finalize of the write-behind spool - the files of a folder are copied one by one,
+    the number of concurrent copies is the number of folders the spool copies at once (its limit)
+    :param path: folder path with .lock
+    :param outdir:
+    :return: number of bytes copied
+    """
+    return _finalize_path(path, outdir, t, workers=1)
 
-def _move_finalized_files(local_queue, outdir, t=None):
+def _finalize_path(path, outdir, t=None, workers=COPY_WORKERS):
     """
-    Simple command to move raw files into a temporary folder
-    :param local_queue
-    :return:
+    Copies the files of a locked folder into the output directory, removes the folder
+    :param path: folder path with .lock
+    :param outdir:
+    :param workers: number of files copied concurrently
+    :return: number of bytes copied
     """
     t = _get_tester(t)
 
-    t.debug("Trying to finalize files into ({})".format(outdir))
+    # path containing all the files
+    t.debug("Origin directory: (%s)", path)
+
+    # nexus files deferred by the merge stage
+    _complete_deferred(path, t)
+
+    # files in the directory
+    files = glob.glob(os.path.join(path, "*"))
+    t.debug("List of files to move: (%s)", files)
+
+    copied = 0
+
+    # files copied by a previous attempt are skipped
+    manifest = read_manifest(path)
+    todo = [fn for fn in files if not is_copied(manifest, fn, outdir)]
+    if len(todo) < len(files):
+        t.info("Skipping (%s) files of (%s) already copied to (%s)", len(files) - len(todo), path, outdir)
+
+    if len(todo) > 0:
+        t.debug("Copying (%d) files to a new folder (%s)", len(todo), outdir)
+
+        # files of the folder are copied concurrently unless the spool copies it
+        timestamp = time.time()
+        res = copy_files(todo, outdir, func=partial(_copy_file, logger=t), workers=workers)
+        elapsed = time.time() - timestamp
+
+        for (src, size, duration, e, digest) in res:
+            if e is None:
+                add_to_manifest(manifest, src, size, digest)
+
+        failed = [r[0] for r in res if r[3] is not None]
+        if len(failed) > 0:
+            # the folder is unlocked and picked up again on the next run, the manifest keeps the copied files
+            t.error("Files (%s) could not be copied to (%s), keeping the folder (%s)", failed, outdir, path)
+            _write_manifest(os.path.join(path, MANIFEST_NAME), manifest, t)
+            _shmove(path, path.replace(".lock", ""), t)
+            return sum([r[1] for r in res])
+
+        copied = sum([r[1] for r in res])
+
+        frames = len([fn for fn in todo if fn.endswith(".tif")])
+        record(METRIC_FINALIZE, elapsed / max(frames, 1), frames=frames, nbytes=copied)
+
+        t.info("Folder (%s) was copied to (%s): %.1f MB at %.1f MB/s",
+               path, outdir, copied / 1e6, copied / elapsed / 1e6 if elapsed > 0 else 0.)
+
+    # sizes and digests of the copies are stored next to them
+    if len(files) > 0:
+        name = "{}{}".format(os.path.basename(path).replace(".lock", ""), MANIFEST_SUFFIX)
+        _write_manifest(os.path.join(outdir, name), manifest, t)
+
+    # frames are appended to the per scan master files before the local copy is removed
+    if NEXUS_MASTER and is_deferred(OPTIONAL_MASTER):
+        t.warning("RAM disk pressure is critical, frames of (%s) are not appended to the master files", path)
+    elif NEXUS_MASTER:
+        for fn in files:
+            if fn.endswith(".tif") and os.path.exists(get_meta_name(fn)):
+                _append_to_master(fn, outdir, t)
+
+    # remote locations of the frames are indexed before the local meta files are removed
+    _index_folder(files, manifest, outdir, t)
+
+    # remove the path
+    _shrmtree(path, t)
+    record_folder(path, STATE_FINALIZED)
+    return copied
+
+def _complete_deferred(path, t=None):
+    """
+    Creates the nexus files deferred by the merge stage - only if the RAM disk is not under pressure anymore
+    :param path: locked folder
+    :return:
+    """
+    t = _get_tester(t)
 
-    while not local_queue.empty():
-        item = local_queue.get()
+    for fn in sorted(glob.glob(os.path.join(path, "*.tif"))):
+        fnmeta = get_meta_name(fn)
+        fnnxs = "{}{}".format(os.path.splitext(fn)[0], ".nxs")
+        if os.path.exists(fnnxs) or not os.path.exists(fnmeta):
+            continue
 
-        # path containing all the files
-        path = item
-        t.debug("Origin directory: ({})".format(path))
+        if is_deferred(OPTIONAL_NEXUS):
+            t.warning("RAM disk is still under pressure, (%s) is finalized without a nexus file", fn)
+            continue
 
-        # files in the directory
-        files = glob.glob(os.path.join(path, "*"))
-        t.debug("List of files to move: ({})".format(files))
+        try:
+            _make_nexus_from_tif(fn, fnmeta, _read_meta_header(fnmeta, t=t), t=t)
+        except (ValueError, IOError, OSError) as e:
+            t.error("Deferred nexus file of (%s) could not be created: %s", fn, e)
 
-        if len(files) > 0:
-            for file in files:
-                t.debug("Moving file ({}) to a new folder ({})".format(file, outdir))
+def _write_manifest(filename, manifest, t=None):
+    """
+    Writes a manifest, errors are only reported
+    :param filename:
+    :param manifest:
+    :return:
+    """
+    t = _get_tester(t)
 
-                # move files to this directory
-                _shcopy(file, outdir, t)
+    try:
+        write_manifest(filename, manifest)
+    except (IOError, OSError) as e:
+        t.error("Manifest (%s) could not be written (%s)", filename, e)
 
-        # remove the path
-        _shrmtree(path, t)
+def _append_to_master(fn, outdir, t=None):
+    """
+    Appends the frame, its header and the reference to the remote copy to the master file of its scan
+    :param fn: local tif file
+    :param outdir: remote directory
+    :return:
+    """
+    t = _get_tester(t)
 
-        local_queue.task_done()
+    try:
+        header = _read_meta_header(get_meta_name(fn), t=t)
+        master = append_frame(fn, outdir, header)
+        t.debug("Frame (%s) was appended to the master file (%s)", fn, master)
+    except (ValueError, IOError, OSError) as e:
+        t.error("Could not append the frame (%s) to the master file: %s", fn, e)
 
-def _remove_file(local_queue, t=None):
+def _index_folder(files, manifest, outdir, t=None):
     """
-    Simple command to remove individual files, based on the queue
-    :param local_queue:
+    Adds the copied frames of a folder to the frame index in one transaction
+    :param files: local files of the folder
+    :param manifest: sizes and digests of the copies
+    :param outdir: remote directory
     :return:
     """
+    if get_frame_index() is None:
+        return
+
     t = _get_tester(t)
 
-    while not local_queue.empty():
-        path = local_queue.get()
+    records = []
+    for fn in files:
+        el = manifest["files"].get(os.path.basename(fn))
+        if not fn.endswith(".tif") or el is None:
+            continue
 
+        try:
+            header = _read_meta_header(get_meta_name(fn), t=t)
+        except (ValueError, IOError, OSError):
+            header = {}
 
-        t.info("Removing a system object ({})".format(path))
+        records.append({"path": os.path.join(outdir, os.path.basename(fn)), "size": el.get("size"),
+                        "checksum": el.get("digest"), "algorithm": manifest["algorithm"],
+                        "header": header, "mtime": el.get("mtime")})
 
-        # removing the path
-        _shrmtree(path, t)
+    index_frames(records)
+    t.debug("Frames (%d) of (%s) were indexed", len(records), outdir)
 
-        local_queue.task_done()
+def _remove_file(path, t=None):
+    """
+    Simple command to remove individual files
+    :param path:
+    :return:
+    """
+    t = _get_tester(t)
+
+    t.info("Removing a system object (%s)", path)
+
+    # single files (darks) - rmtree would retry on them until the timeout
+    if not os.path.isdir(path):
+        try:
+            _on_shutilerror(os.remove, path, None)
+        except OSError as e:
+            # removed by a concurrent run
+            if e.errno != errno.ENOENT:
+                t.error("Could not remove (%s): %s", path, e)
+        return
+
+    # removing the path
+    _shrmtree(path, t)
 
 
 def _on_shutilerror(func, path, exc_info):
@@ -466,96 +842,238 @@ def _on_shutilerror(func, path, exc_info):
     os.unlink(path)
 
 
-def _merge_tiff_data(local_queue, t=None):
+def _merge_tiff_data(path, t=None):
     """
     Merges local data
-    :param local_queue:
-    :return:
+    :param path:
+    :return: list of merge reports
+    """
+    return _merge_folder(path, t)
+
+def _merge_tiff_process(path, bdefer):
+    """
+    Merges local data in a child process - only the path is passed in, headers and timings are returned to the parent
+    :param path:
+    :param bdefer: nexus files are deferred to the finalize stage - decided by the parent
+    :return: list of merge reports
+    """
+    return _merge_folder(path, bdefer=bdefer)
+
+def _merge_folder(path, t=None, bdefer=None):
+    """
+    Merges the meta into the tif files of a folder, creates nexus files
+    :param path:
+    :param bdefer: nexus files are deferred to the finalize stage, None - decided by the RAM disk monitor
+    :return: list of dictionaries with the file name, header and timings or None if the folder does not exist
     """
     t = _get_tester(t)
 
-    while not local_queue.empty():
-        path = local_queue.get()
+    t.debug("Processing task %s", path)
 
-        t.debug("Processing task {}".format(path))
+    # path should exist and contain some tif file and its meta - one file - one meta
+    if not os.path.exists(path):
+        return None
 
-        # path should exist and contain some tif file and its meta - one file - one meta
-        if os.path.exists(path):
-            ref_path = os.path.join(path, "*.tif")
+    res = []
 
-            t.debug("Using reference file path {}".format(ref_path))
+    ref_path = os.path.join(path, "*.tif")
 
-            files2merge = glob.glob(ref_path)
-            if len(files2merge) > 0:
-                for fn in files2merge:
-                    # test for meta file
-                    fnmeta = "{}.metadata".format(fn)
-                    t.debug("{}/{}".format(fn, fnmeta))
+    t.debug("Using reference file path %s", ref_path)
 
-                    if os.path.exists(fn) and os.path.exists(fnmeta):
-                        # do the work - read meta, merge with tif
-                        header = _single_file_merge(fn, fnmeta, t=t)
+    files2merge = sorted(glob.glob(ref_path))
 
-                        # do the work - create NXS file and merge
-                        # TODO: create NXS file with references
-                        _make_nexus_from_tif(fn, fnmeta, header, t=t)
+    # nexus files are created by the finalize stage if the RAM disk is under pressure now
+    if bdefer is None:
+        bdefer = is_deferred(OPTIONAL_NEXUS)
+    if bdefer and len(files2merge) > 0:
+        t.warning("RAM disk is under pressure, deferring the nexus files of (%s)", path)
 
-        else:
-            pass
-        local_queue.task_done()
+    if len(files2merge) > 0:
+        for fn in files2merge:
+            # test for meta file
+            fnmeta = "{}.metadata".format(fn)
+            t.debug("%s/%s", fn, fnmeta)
 
-def _single_file_merge(fn, fnmeta, t=None):
+            if os.path.exists(fn) and os.path.exists(fnmeta):
+                # do the work - read meta, merge with tif
+                timestamp = time.time()
+                header = _single_file_merge(fn, fnmeta, t=t)
+                merge_time = time.time() - timestamp
+
+                # do the work - create NXS file and merge
+                # TODO: create NXS file with references
+                nexus_time = None
+                if not bdefer:
+                    timestamp = time.time()
+                    _make_nexus_from_tif(fn, fnmeta, header, t=t)
+                    nexus_time = time.time() - timestamp
+
+                res.append({MERGE_FILE: fn, MERGE_HEADER: header,
+                            MERGE_TIME: merge_time, MERGE_NEXUS_TIME: nexus_time})
+    return res
+
+def _record_merge_reports(reports):
     """
-    Reads data from meta, adds the header to the TIF
+    Records the merge and nexus times and the journal states of the merge reports
+    Reports of the child processes are recorded by the parent
+    :param reports:
+    :return:
+    """
+    merged, nexus = {}, {}
+    for report in reports:
+        record(METRIC_MERGE, report[MERGE_TIME])
+        folder = os.path.dirname(report[MERGE_FILE])
+        merged.setdefault(folder, []).append(report[MERGE_FILE])
+        if report[MERGE_NEXUS_TIME] is not None:
+            record(METRIC_NEXUS, report[MERGE_NEXUS_TIME])
+            nexus.setdefault(folder, []).append(report[MERGE_FILE])
+
+    # the journal keeps the last state of a frame - nexus written implies merged
+    for (folder, files) in merged.items():
+        done = set(nexus.get(folder, []))
+        record_frames([fn for fn in files if fn not in done], folder, STATE_MERGED)
+        record_frames(list(done), folder, STATE_NEXUS)
+
+###
+# in-process pipeline stages - folders are handed over without waiting for the next tick of the plugins
+###
+
+def _pipeline_reserve(path):
+    pipeline = get_pipeline()
+    if pipeline is not None:
+        pipeline.reserve(path)
+
+def _pipeline_release(path):
+    pipeline = get_pipeline()
+    if pipeline is not None:
+        pipeline.release(path)
+
+def _pipeline_submit(name, path, *args):
+    """
+    Hands the folder over to a pipeline stage, the folder stays visible to the plugins if the stage refuses it
+    :return: (bool)
+    """
+    res = False
+    pipeline = get_pipeline()
+    if pipeline is not None:
+        res = pipeline.submit(name, path, *args)
+    return res
+
+def _pipeline_merge(path, proc_dir, output_dir, t=None):
+    """
+    Merge stage - merges the folder from the temporary dir, moves it into the processed dir and hands it to finalize
+    :param path: unlocked folder in the temporary directory
+    :param proc_dir:
+    :param output_dir:
     :return:
     """
     t = _get_tester(t)
 
-    t.debug("Merging files ({}/{})".format(fn, fnmeta))
+    if MERGE_MODE == MERGE_PROCESS:
+        res = get_pool(POOL_MERGE_PROCESS, _get_merge_processes(), process=True).map(_merge_tiff_process, [path],
+                                                                                      is_deferred(OPTIONAL_NEXUS))[0]
+    else:
+        res = _merge_folder(path, t)
 
-    header = {}
-    max_lines = 30
+    if res is None:
+        return
+    _record_merge_reports(res)
 
-    header = {}
+    lock_path = "{}{}".format(path, '.lock')
+    if not _shmove(path, lock_path, t):
+        return
+
+    finalpath = os.path.join(proc_dir, os.path.basename(path))
+    _pipeline_reserve(finalpath)
 
     try:
-        bflag = True
-        counter = 0
-        patt = re.compile('^\s*(dateString|userComment[0-9]|exposureTime|summedExposures)=(.*)$')
+        _move_processed_path(lock_path, proc_dir, t)
+    except (OSError, IOError) as e:
+        t.error("Could not move the folder (%s) into (%s): %s", lock_path, proc_dir, e)
+        _pipeline_release(finalpath)
+        return
 
+    _pipeline_submit(STAGE_FINALIZE, finalpath, output_dir)
 
+def _pipeline_finalize(path, output_dir, t=None):
+    """
+    Finalize stage - locks the folder in the processed dir, copies its files to the output dir
+    :param path: unlocked folder in the processed directory
+    :param output_dir:
+    :return:
+    """
+    t = _get_tester(t)
 
-        fh = open(fnmeta, "r")
-        for line in fh:
-            line = line.strip()
+    lock_path = "{}{}".format(path, '.lock')
+    if _shmove(path, lock_path, t):
+        spool = get_spool()
+        if spool is not None:
+            spool.submit(lock_path, _spool_finalize_path, output_dir)
+        else:
+            _finalize_path(lock_path, output_dir, t)
 
-            m = patt.match(line)
-            if t.test(m):
-                h, v = m.groups()
-                t.debug("Match found ({}/{})".format(h, v))
-                header[h] = v
+register_stage(STAGE_MERGE, _pipeline_merge)
+register_stage(STAGE_FINALIZE, _pipeline_finalize)
 
-            # break to avoid unnecessary file reading
-            counter += 1
-            if counter > max_lines:
-                break
+def _single_file_merge(fn, fnmeta, t=None):
+    """
+    Reads data from meta, adds the header to the TIF
+    :return:
+    """
+    t = _get_tester(t)
+
+    t.debug("Merging files (%s/%s)", fn, fnmeta)
+
+    header = {}
 
-        t.debug("The metadata header is ({})".format(header))
+    try:
+        header = _read_meta_header(fnmeta, t=t)
+
+        # setting the header - only the tiff header is touched, the pixel data is not decoded
+        bheader_only = False
+        if TIFF_HEADER_ONLY:
+            try:
+                update_tiff_header(fn, header)
+                bheader_only = True
+            except ValueError as e:
+                t.warning("Could not update the tiff header of (%s) in place (%s), rewriting the file", fn, e)
 
         # setting the header - open file, set the header, update
-        img = fabio.open(fn)
-        img.update_header(**header)
-        img.save(fn)
+        if not bheader_only:
+            # fabio is needed only if the header cannot be written in place
+            import fabio
+            img = fabio.open(fn)
+            img.update_header(**header)
+            img.save(fn)
     except IOError:
         t.error("Could not access the meta file")
 
     return header
 
+def _read_meta_header(fnmeta, t=None):
+    """
+    Reads the header values from the meta file
+    :param fnmeta:
+    :return: dictionary, raises IOError if the file cannot be read
+    """
+    t = _get_tester(t)
+
+    header = read_header(fnmeta)
+
+    t.debug("The metadata header is (%s)", header)
+    return header
+
 # set up default element
 NXKEYROOT, NXKEYDATA, NXKEYDEFAULT, NXKEYDETECTOR, NXKEYINSTRUMENT, NXKEYHEADER = 'root', 'data', 'default', 'detector', 'instrument', 'header'
 NXENTRY, NXCLASS, NXDATA = 'NXentry', 'NX_class', 'NXdata'
 NXDETECTOR, NXINSTRUMENT = 'NXdetector', 'NXinstrument'
 
+# modes of storing the image data in the nexus file
+NEXUS_DATA_EXTERNAL, NEXUS_DATA_COPY = "external", "copy"
+
+# external files are looked up in the directory of the nexus file
+NEXUS_EFILE_PREFIX = "${ORIGIN}"
+
 def _make_nexus_from_tif(fn, fnmeta, header, t=None):
     """
     Create the final nexus file with a tree
@@ -568,6 +1086,8 @@ def _make_nexus_from_tif(fn, fnmeta, header, t=None):
 
     nxs_name = os.path.join(base_dir, u'{}{}'.format(base_name, u'.nxs'))
 
+    # imported on the first nexus file, not with the plugins
+    import h5py
     nxfh = h5py.File(nxs_name, "w")
     nxfh.attrs['default'] = NXKEYROOT
 
@@ -583,10 +1103,49 @@ def _make_nexus_from_tif(fn, fnmeta, header, t=None):
               'data': {'source_attr': fn, 'raw_path': os.path.basename(fn), 'meta_path': os.path.basename(fnmeta)}}
 
     # recursively build a nexus tree - take into account the paths, attributes and values
-    _nxs_create_child_group(nxfh, child_name=NXKEYROOT, child_class=NXENTRY, default=NXKEYDATA, data=nxdict)
+    nxroot = _nxs_create_child_group(nxfh, child_name=NXKEYROOT, child_class=NXENTRY, default=NXKEYDATA, data=nxdict)
+
+    # image data - reference to the tif pixel block or a compressed copy
+    if NEXUS_DATA_MODE in (NEXUS_DATA_EXTERNAL, NEXUS_DATA_COPY):
+        try:
+            _nxs_add_image(nxroot[NXKEYDATA], fn, NEXUS_DATA_MODE)
+        except (ValueError, IOError) as e:
+            t.error("Could not add the image data of (%s) to the nexus file: %s", fn, e)
 
     nxfh.close()
 
+def _nxs_add_image(nxdata, fn, mode):
+    """
+    Exposes the tif pixel block as the data dataset of the NXdata group
+    external - hdf5 external storage (offset/size in the tif, file name relative to the nexus file), no bytes are copied
+    the dataset is created with the ${ORIGIN} prefix (h5py 3), hdf5 does not store the prefix - readers set it too
+    copy - chunked and compressed copy read through a memory mapping of the frame
+    :param nxdata:
+    :param fn:
+    :param mode:
+    :return:
+    """
+    if mode == NEXUS_DATA_EXTERNAL:
+        frame = TiffFrame(fn)
+        kwargs = dict(shape=frame.shape, dtype=frame.dtype, external=[(os.path.basename(fn), frame.offset, frame.size)])
+        try:
+            data_set = nxdata.create_dataset(NXKEYDATA, efile_prefix=NEXUS_EFILE_PREFIX, **kwargs)
+        except TypeError:
+            # h5py v2 - no dataset access properties
+            data_set = nxdata.create_dataset(NXKEYDATA, **kwargs)
+        data_set.attrs['efile_prefix'] = NEXUS_EFILE_PREFIX
+    else:
+        frame = open_frame(fn)
+        try:
+            data_set = nxdata.create_dataset(NXKEYDATA, data=frame.data, chunks=(min(frame.height, 64), frame.width),
+                                             compression="gzip", compression_opts=NEXUS_DATA_COMPRESSION,
+                                             shuffle=True)
+        finally:
+            release_frame(frame)
+
+    data_set.attrs['interpretation'] = 'image'
+    nxdata.attrs['signal'] = NXKEYDATA
+
 def _nxs_create_child_group(nxroot, child_name, child_class, default=None, data=None):
     """
     Creates a new
@@ -622,15 +1181,42 @@ def _nxs_create_child_group(nxroot, child_name, child_class, default=None, data=
                 _nxs_create_child_group(nxgroup, key, "NX{}".format(key.lower()), data=data[key])
     return nxgroup
 
+def _get_merge_processes():
+    """
+    Returns the number of processes of the merge stage - all the cores by default
+    :return:
+    """
+    res = MERGE_PROCESSES
+    if res is None:
+        try:
+            res = multiprocessing.cpu_count()
+        except NotImplementedError:
+            res = 1
+    return res
+
+def get_meta_name(filename):
+    """
+    Returns name for the meta file
+    :param filename:
+    :return:
+    """
+    return "{}{}".format(filename, ".metadata")
+
+# tester shared by the calls without a logger - created once per process
+_TESTER = None
+
 def _get_tester(t=None):
     """
     Wrapper assigning the same log file to the tester
     :param t:
     :return:
     """
+    global _TESTER
     res = t
     if t is None:
-        res = Tester(nofile=True)
+        if _TESTER is None:
+            _TESTER = Tester(nofile=True)
+        res = _TESTER
     return res
 
 def _shmove(source, dest, logger, timeout=1):
@@ -663,65 +1249,43 @@ def _shmove(source, dest, logger, timeout=1):
 
                 raise ValueError
             except (OSError, IOError) as e:
-                logger.error("OsError while moving ({}) to  ({}):\n{} : {}".format(source, dest, e.errno,
-                                                                                   e.message))
+                logger.error("OsError while moving (%s) to  (%s):\n%s : %s", source, dest, e.errno,
+                             e.message)
                 time.sleep(OSSLEEP)
 
             # break on timeout
             if time.time() - start_time > timeout:
                 raise AttributeError
     except ValueError:
-        logger.debug("Source ({}) was successfuly moved to ({})".format(source, dest))
+        logger.debug("Source (%s) was successfuly moved to (%s)", source, dest)
     except AttributeError:
-        logger.error("Timeout while moving ({}) to  ({})".format(source, dest))
+        logger.error("Timeout while moving (%s) to  (%s)", source, dest)
     except IOError:
-        logger.error("Source does not exist".format(source))
+        logger.error("Source does not exist (%s)", source)
     return bsuccess
 
-def _shcopy(source, dest, logger, timeout=None):
+def _copy_file(source, dest, logger, timeout=None):
     """
-    Completes the system move function - waits for successful attempt or timeout
+    Copies a file by the copy engine - retries until success or timeout
     :param source:
     :param dest:
     :param logger:
-    :return:
+    :return: (number of bytes copied, digest), raises the last error on timeout
     """
-    bsuccess = False
-
     if timeout is None:
         timeout = OSTIMEOUT
 
     start_time = time.time()
-
-    try:
-        if not os.path.exists(source):
-            raise IOError
-
-        while not bsuccess:
-            try:
-                # TODO: fix OS + Windows Error
-                os.chmod(source, stat.S_IWRITE)
-                shutil.copy(source, dest)
-
-                # copy has succeed
-                bsuccess = True
-
-                raise ValueError
-            except (OSError, IOError) as e:
-                logger.error("OsError while copying ({}) to  ({}):\n{} : {}".format(source, dest, e.errno,
-                                                                                   e.message))
-                time.sleep(OSSLEEP)
+    while True:
+        try:
+            return copy_file(source, dest)
+        except (OSError, IOError) as e:
+            logger.error("OsError while copying (%s) to  (%s):\n%s : %s", source, dest, e.errno, e.strerror)
 
             # break on timeout
-            if time.time() - start_time > timeout:
-                raise AttributeError
-    except ValueError:
-        logger.debug("Source ({}) was successfuly copied to ({})".format(source, dest))
-    except AttributeError:
-        logger.error("Timeout while copying ({}) to  ({})".format(source, dest))
-    except IOError:
-        logger.error("Source does not exist".format(source))
-    return bsuccess
+            if not os.path.exists(source) or time.time() - start_time > timeout:
+                raise
+            time.sleep(OSSLEEP)
 
 ## Functions for working with utilities
 
@@ -756,19 +1320,19 @@ def _shrmtree(source, logger, timeout=None):
 
                 raise ValueError
             except (OSError, IOError) as e:
-                logger.error("OsError while deleting ({}) :\n{} : {}".format(source, e.errno,
-                                                                                   e.message))
+                logger.error("OsError while deleting (%s) :\n%s : %s", source, e.errno,
+                             e.message)
                 time.sleep(OSSLEEP)
 
             # break on timeout
             if time.time() - start_time > timeout:
                 raise AttributeError
     except ValueError:
-        logger.debug("Source ({}) was successfuly deleted".format(source))
+        logger.debug("Source (%s) was successfuly deleted", source)
     except AttributeError:
-        logger.error("Timeout while deleting ({})".format(source))
+        logger.error("Timeout while deleting (%s)", source)
     except IOError:
-        logger.error("Source does not exist".format(source))
+        logger.error("Source does not exist (%s)", source)
     return bsuccess
 
 # test
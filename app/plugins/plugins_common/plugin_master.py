@@ -0,0 +1,299 @@
+__author__ = 'Konstantin Glazyrin'
+
+"""
+Per scan nexus master files - frames of a scan (fileBase prefix, e.g. CeO2_09_11_2017-NNNNN) are collected together
+The master file holds per frame metadata arrays and references to the frame files, the pixels are not copied
+Files are written on the local disk (NEXUS_MASTER_DIR) in the swmr mode - local readers can follow the scan
+The output directory receives a published copy with a virtual (N, height, width) dataset mapped onto the frame nexus files,
+swmr is not supported on the network file systems
+"""
+
+import os
+import time
+import threading
+import zlib
+
+from app.config import NEXUS_MASTER_KEYS, NEXUS_MASTER_DIR, NEXUS_MASTER_IDLE, NEXUS_MASTER_PUBLISH_INTERVAL
+from app.frame_index import get_scan_name
+from app.plugins.plugins_common.plugin_tiff import read_tiff_ifd, read_tiff_layout
+from app.plugins.plugins_common.plugin_copy import copy_file
+
+MASTER_SUFFIX = "_master.nxs"
+
+# image data of the frame nexus files (root/data/data of _make_nexus_from_tif) - sources of the virtual dataset
+FRAME_NEXUS_SUFFIX, FRAME_DATA_PATH = ".nxs", "root/data/data"
+
+# length of the fixed length strings - variable length data cannot be appended in the swmr mode
+STRING_DTYPE = "S256"
+
+# opened master files, key - local file name
+_MASTERS = {}
+_MASTERS_LOCK = threading.Lock()
+
+
+def get_frame_layout(fn):
+    """
+    Returns the shape and the dtype of a frame - only the tiff header is read
+    :param fn:
+    :return: ((height, width), dtype in the numpy notation)
+    """
+    with open(fn, "rb") as fh:
+        order, ifd_offset, entries = read_tiff_ifd(fh)
+        layout = read_tiff_layout(fh, order, entries)
+    return (layout["height"], layout["width"]), layout["dtype"]
+
+
+class ScanMaster(object):
+    def __init__(self, filename, remote, shape, dtype, keys=NEXUS_MASTER_KEYS):
+        """
+        Opens or creates the local master file
+        :param filename: local file
+        :param remote: published copy in the output directory
+        :param shape: frame shape
+        :param dtype: frame dtype
+        :param keys: header keys stored per frame
+        """
+        self.filename = filename
+        self.remote = remote
+        self.keys = tuple(keys)
+        self._lock = threading.Lock()
+        self._publish_lock = threading.Lock()
+
+        # imported on the first master file
+        import h5py
+
+        bnew = not os.path.exists(filename)
+        self.fh = h5py.File(filename, "a", libver="latest")
+
+        if bnew:
+            self._create(shape, dtype)
+
+        frames = self.fh["entry/frames"]
+        if tuple(frames.attrs["frame_shape"]) != tuple(shape):
+            self.fh.close()
+            raise ValueError("Frame shape ({}) does not match the master file ({})".format(shape, frames.attrs["frame_shape"]))
+
+        self.arrays = [frames["name"], frames["path"], frames["timestamp"]]
+        self.arrays.extend([frames["header"][key] for key in self.keys])
+
+        # no new objects can be created from now on
+        self.fh.swmr_mode = True
+
+        self.last_used, self.published = time.time(), 0.
+        self.dirty = False
+
+    def _create(self, shape, dtype):
+        """
+        Creates the tree of a new master file - the image data is added to the published copies
+        :param shape:
+        :param dtype:
+        :return:
+        """
+        self.fh.attrs["default"] = "entry"
+
+        entry = self.fh.create_group("entry")
+        entry.attrs["NX_class"] = "NXentry"
+        entry.attrs["default"] = "data"
+
+        frames = entry.create_group("frames")
+        frames.attrs["NX_class"] = "NXcollection"
+        frames.attrs["frame_shape"] = tuple(shape)
+        frames.attrs["frame_dtype"] = dtype
+        for name in ("name", "path"):
+            frames.create_dataset(name, shape=(0,), maxshape=(None,), dtype=STRING_DTYPE, chunks=(256,))
+        frames.create_dataset("timestamp", shape=(0,), maxshape=(None,), dtype="f8", chunks=(256,))
+
+        header = frames.create_group("header")
+        header.attrs["NX_class"] = "NXcollection"
+        for key in self.keys:
+            header.create_dataset(key, shape=(0,), maxshape=(None,), dtype=STRING_DTYPE, chunks=(256,))
+
+    def append(self, name, path, header):
+        """
+        Appends the metadata of a frame - datasets are extended one by one and flushed for the swmr readers
+        :param name: frame name
+        :param path: reference to the frame file
+        :param header: dictionary
+        :return: index of the frame
+        """
+        values = [name, path, time.time()]
+        values.extend([header.get(key, "") for key in self.keys])
+
+        with self._lock:
+            index = self.arrays[0].shape[0]
+
+            for (data_set, value) in zip(self.arrays, values):
+                if data_set.dtype.kind == "S":
+                    value = _to_bytes(value)
+                data_set.resize(index + 1, axis=0)
+                data_set[index] = value
+
+            for data_set in self.arrays:
+                data_set.flush()
+
+            self.last_used, self.dirty = time.time(), True
+        return index
+
+    def publish(self):
+        """
+        Copies the master file to the output directory, the copy gets the virtual dataset of the frames
+        The tree is copied into a new local file (a copy of the file would keep the swmr writer flags),
+        the copy is written next to the published file and renamed - readers never see a partial file
+        :return:
+        """
+        import h5py
+
+        with self._publish_lock:
+            temp = "{}.publish".format(self.filename)
+            with self._lock:
+                if not self.dirty:
+                    return
+
+                with h5py.File(temp, "w", libver="latest") as fh:
+                    fh.attrs.update(self.fh.attrs)
+                    self.fh.copy(self.fh["entry"], fh, "entry")
+                    _add_virtual_data(fh)
+                self.dirty, self.published = False, time.time()
+
+            try:
+                remote_temp = "{}.tmp".format(self.remote)
+                copy_file(temp, remote_temp, checksum=False)
+                try:
+                    os.remove(self.remote)
+                except OSError:
+                    pass
+                os.rename(remote_temp, self.remote)
+            finally:
+                os.remove(temp)
+
+    def close(self):
+        """
+        Publishes the master file, closes the local file
+        :return:
+        """
+        try:
+            self.publish()
+        finally:
+            with self._lock:
+                self.fh.close()
+
+
+def _add_virtual_data(fh):
+    """
+    Adds the (N, height, width) virtual dataset mapped onto the frame nexus files (relative to the master file)
+    Frames without a nexus file read as zeros
+    :param fh: master file opened for writing, not in the swmr mode
+    :return:
+    """
+    import h5py
+
+    # virtual datasets need hdf5 v1.10+
+    if not hasattr(h5py, "VirtualLayout"):
+        return
+
+    frames = fh["entry/frames"]
+    shape, dtype = tuple(frames.attrs["frame_shape"]), frames.attrs["frame_dtype"]
+    names = [_to_str(el) for el in frames["path"][()]]
+
+    layout = h5py.VirtualLayout(shape=(len(names),) + shape, dtype=dtype)
+    for (i, name) in enumerate(names):
+        source = "{}{}".format(os.path.splitext(name)[0], FRAME_NEXUS_SUFFIX)
+        layout[i] = h5py.VirtualSource(source, FRAME_DATA_PATH, shape=shape)
+
+    data = fh["entry"].create_group("data")
+    data.attrs["NX_class"] = "NXdata"
+    data.attrs["signal"] = "data"
+
+    data_set = data.create_virtual_dataset("data", layout, fillvalue=0)
+    data_set.attrs["interpretation"] = "image"
+
+
+def _to_bytes(value):
+    if not isinstance(value, bytes):
+        value = u"{}".format(value).encode("utf-8")
+    return value
+
+
+def _to_str(value):
+    if isinstance(value, bytes):
+        value = value.decode("utf-8")
+    return value
+
+
+def get_master_names(fn, outdir):
+    """
+    Returns the local and the published file names of the master file of a frame
+    The local name carries a hash of the output directory - the same scan may be written to several directories
+    :param fn:
+    :param outdir:
+    :return: (local file, published file)
+    """
+    name = "{}{}".format(get_scan_name(fn), MASTER_SUFFIX)
+    local = "{}_{:08x}{}".format(get_scan_name(fn), zlib.crc32(outdir.encode("utf-8")) & 0xffffffff, MASTER_SUFFIX)
+    return os.path.join(NEXUS_MASTER_DIR, local), os.path.join(outdir, name)
+
+
+def append_frame(fn, outdir, header):
+    """
+    Appends the frame to the master file of its scan, the masters of the other scans in outdir are closed
+    :param fn: local tif file
+    :param outdir: directory of the published master file and of the frame copies
+    :param header: dictionary
+    :return: name of the published master file
+    """
+    filename, remote = get_master_names(fn, outdir)
+
+    done = []
+    with _MASTERS_LOCK:
+        master = _MASTERS.get(filename)
+        if master is None:
+            # a new scan has started - the previous scans of the directory are finished
+            for (key, el) in list(_MASTERS.items()):
+                if os.path.dirname(el.remote) == os.path.dirname(remote):
+                    done.append(_MASTERS.pop(key))
+
+            if not os.path.isdir(NEXUS_MASTER_DIR):
+                os.makedirs(NEXUS_MASTER_DIR)
+
+            shape, dtype = get_frame_layout(fn)
+            master = ScanMaster(filename, remote, shape, dtype)
+            _MASTERS[filename] = master
+
+    for el in done:
+        el.close()
+
+    name = os.path.basename(fn)
+    master.append(name, name, header)
+
+    if time.time() - master.published >= NEXUS_MASTER_PUBLISH_INTERVAL:
+        master.publish()
+    return remote
+
+
+def close_idle_masters(timeout=NEXUS_MASTER_IDLE):
+    """
+    Closes and publishes the master files without new frames for the timeout
+    :param timeout: s
+    :return: list of the published files
+    """
+    timestamp = time.time()
+    with _MASTERS_LOCK:
+        masters = [el for el in _MASTERS.values() if timestamp - el.last_used >= timeout]
+        for el in masters:
+            _MASTERS.pop(el.filename, None)
+
+    for el in masters:
+        el.close()
+    return [el.remote for el in masters]
+
+
+def close_masters():
+    """
+    Closes and publishes all the master files
+    :return:
+    """
+    with _MASTERS_LOCK:
+        masters = list(_MASTERS.values())
+        _MASTERS.clear()
+    for master in masters:
+        master.close()
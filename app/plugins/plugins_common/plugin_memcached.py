@@ -1,6 +1,191 @@
+import threading
+from contextlib import contextmanager
+
+try:
+    # python v2
+    import Queue as queue
+except ImportError:
+    import queue
+
 import memcache
 from config import *
 
+__all__ = ["ClientPool", "get_client_pool", "flush", "close_memcached", "set_multi", "get_multi", "set_key",
+           "append_key", "get_key"]
+
+# pool of the persistent clients - created on the first use
+_POOL = None
+_POOL_LOCK = threading.Lock()
+
+# values waiting for the next flush and values being sent by a flush, key - value
+_PENDING = {}
+_INFLIGHT = {}
+_PENDING_LOCK = threading.Lock()
+_FLUSH_TIMER = None
+
+
+class ClientPool(object):
+    """
+    Persistent memcached clients shared by the threads - a client is used by a single thread at a time
+    """
+    def __init__(self, host=MEMCACHED_HOST, size=MEMCACHED_POOL_SIZE):
+        self.host = host
+        self.size = max(1, int(size))
+
+        self._clients = queue.Queue()
+        self._created = 0
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def client(self):
+        """
+        Borrows a client, a new one is created while the pool is not full
+        :return:
+        """
+        mc = None
+        try:
+            mc = self._clients.get_nowait()
+        except queue.Empty:
+            with self._lock:
+                if self._created < self.size:
+                    mc = memcache.Client([self.host], debug=0)
+                    self._created += 1
+            if mc is None:
+                mc = self._clients.get()
+
+        try:
+            yield mc
+        finally:
+            self._clients.put(mc)
+
+    def close(self):
+        while True:
+            try:
+                mc = self._clients.get_nowait()
+            except queue.Empty:
+                break
+            mc.disconnect_all()
+
+
+def get_client_pool():
+    global _POOL
+    with _POOL_LOCK:
+        if _POOL is None:
+            _POOL = ClientPool()
+    return _POOL
+
+
+def _send(values, logger=None):
+    """
+    Sends the values in one round trip
+    :param values: dictionary, key - value
+    :param logger:
+    :return: list of the keys which could not be set
+    """
+    if len(values) == 0:
+        return []
+
+    with get_client_pool().client() as mc:
+        res = mc.set_multi(dict([(str(key), value) for (key, value) in values.items()]))
+
+    if logger is not None and len(res) > 0:
+        logger.error("Memcache values could not be set (%s/%s)", MEMCACHED_HOST, res)
+    return res
+
+
+def flush(logger=None):
+    """
+    Sends the values collected since the last flush, the timer of the next flush is stopped
+    The values stay visible to get_multi() until they are sent
+    :param logger:
+    :return:
+    """
+    global _FLUSH_TIMER
+    with _PENDING_LOCK:
+        values = dict(_PENDING)
+        _PENDING.clear()
+        _INFLIGHT.update(values)
+        timer, _FLUSH_TIMER = _FLUSH_TIMER, None
+
+    if timer is not None and timer is not threading.current_thread():
+        timer.cancel()
+        timer.join()
+
+    try:
+        return _send(values, logger=logger)
+    finally:
+        with _PENDING_LOCK:
+            for (key, value) in values.items():
+                # a concurrent flush may be sending a newer value
+                if _INFLIGHT.get(key) is value:
+                    del _INFLIGHT[key]
+
+
+def close_memcached(logger=None):
+    """
+    Sends the values waiting for the flush, disconnects the clients - the daemon calls it on stop
+    :param logger:
+    :return: list of the keys which could not be set
+    """
+    global _POOL
+    res = flush(logger=logger)
+
+    with _POOL_LOCK:
+        pool, _POOL = _POOL, None
+    if pool is not None:
+        pool.close()
+    return res
+
+
+def set_multi(values, logger=None):
+    """
+    Sets several values in one round trip, the values are collected for MEMCACHED_FLUSH_INTERVAL if it is set
+    :param values: dictionary, key - value
+    :param logger:
+    :return:
+    """
+    global _FLUSH_TIMER
+    if logger is not None:
+        logger.debug("Setting memcache values (%s/%s)", MEMCACHED_HOST, values)
+
+    if MEMCACHED_FLUSH_INTERVAL <= 0:
+        _send(values, logger=logger)
+        return
+
+    with _PENDING_LOCK:
+        _PENDING.update(values)
+        if _FLUSH_TIMER is None:
+            _FLUSH_TIMER = threading.Timer(MEMCACHED_FLUSH_INTERVAL, flush)
+            _FLUSH_TIMER.setDaemon(True)
+            _FLUSH_TIMER.start()
+
+
+def get_multi(keys, logger=None):
+    """
+    Gets several values in one round trip, values waiting for the flush or being sent are newer than the stored ones
+    They are taken before the server is read - a flush completing in between does not hide them
+    :param keys:
+    :param logger:
+    :return: dictionary, key - value, missing keys are not included
+    """
+    keys = [str(key) for key in keys]
+
+    newer = {}
+    with _PENDING_LOCK:
+        for values in (_INFLIGHT, _PENDING):
+            for (key, value) in values.items():
+                if str(key) in keys:
+                    newer[str(key)] = value
+
+    with get_client_pool().client() as mc:
+        res = mc.get_multi(keys)
+    res.update(newer)
+
+    if logger is not None:
+        logger.debug("Values are (%s)", res)
+    return res
+
+
 def set_key(key, value, logger=None):
     """
     Sets the values for the logger
@@ -9,14 +194,7 @@ def set_key(key, value, logger=None):
     :param logger:
     :return:
     """
-    if logger is not None:
-        try:
-            logger.debug("Setting memcache values ({}/{}/{})".format(MEMCACHED_HOST, key, value))
-        except UnicodeEncodeError:
-            logger.debug(u"Setting memcache values ({}/{}/{})".format(MEMCACHED_HOST, unicode(key), unicode(value)))
-
-    mc = memcache.Client([MEMCACHED_HOST], debug=0)
-    mc.set(str(key), value)
+    set_multi({key: value}, logger=logger)
 
 
 def append_key(key, value, logger=None):
@@ -28,12 +206,13 @@ def append_key(key, value, logger=None):
     :return:
     """
     if logger is not None:
-        try:
-            logger.debug("Appending memcache values ({}/{}/{})".format(MEMCACHED_HOST, key, value))
-        except UnicodeEncodeError:
-            logger.debug(u"Appending memcache values ({}/{}/{})".format(MEMCACHED_HOST, unicode(key), unicode(value)))
-    mc = memcache.Client([MEMCACHED_HOST], debug=0)
-    mc.append(str(key), value)
+        logger.debug("Appending memcache values (%s/%s/%s)", MEMCACHED_HOST, key, value)
+
+    # the value appended to has to be stored first
+    flush(logger=logger)
+
+    with get_client_pool().client() as mc:
+        mc.append(str(key), value)
 
 
 def get_key(key, logger=None):
@@ -44,16 +223,7 @@ def get_key(key, logger=None):
     :param logger:
     :return:
     """
-    res = None
     if logger is not None:
-        try:
-            logger.debug("Getting memcache values ({}/{})".format(MEMCACHED_HOST, key))
-        except UnicodeEncodeError:
-            logger.debug(u"Getting memcache values ({}/{})".format(MEMCACHED_HOST, unicode(key)))
+        logger.debug("Getting memcache values (%s/%s)", MEMCACHED_HOST, key)
 
-    mc = memcache.Client([MEMCACHED_HOST], debug=0)
-    res = mc.get(str(key))
-
-    if logger is not None:
-        logger.debug("Value is ({})".format(res))
-    return res
\ No newline at end of file
+    return get_multi([key], logger=logger).get(str(key))
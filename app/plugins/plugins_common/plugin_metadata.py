@@ -0,0 +1,268 @@
+__author__ = 'Konstantin Glazyrin'
+
+"""
+Parser of the QXRD .metadata files
+The file is read at once, all key=value pairs of the [metadata] section are converted into typed values
+@Variant(...) fields are decoded from the QSettings/QDataStream notation (QDateTime, QcepDoubleList)
+Raw values are cached by name, size and modification time - the same file is read by several stages
+Only the requested (whitelisted) keys are converted
+A file is complete once the used= line closing the [metadata] section has been written
+"""
+
+import os
+import re
+import time
+import glob
+import struct
+import datetime
+import threading
+
+from app.config import METADATA_KEYS
+
+# section of the file holding the values
+METADATA_SECTION = "metadata"
+
+PATT_SECTION = re.compile(r"^\s*\[(.*)\]\s*$", re.M)
+PATT_INT = re.compile(r"^[-+]?\d+$")
+PATT_FLOAT = re.compile(r"^[-+]?(\d+\.\d*|\.\d+|\d+)([eE][-+]?\d+)?$")
+
+# last key of the [metadata] section written by QXRD
+METADATA_LAST_KEY = "used"
+
+VARIANT_PREFIX, VARIANT_SUFFIX = "@Variant(", ")"
+PATT_ESCAPE = re.compile(r"\\(x[0-9a-fA-F]{1,4}|[0-7]{1,3}|.)")
+
+ESCAPES = {"a": 7, "b": 8, "f": 12, "n": 10, "r": 13, "t": 9, "v": 11}
+
+# QVariant types
+QVARIANT_DATETIME = 16
+QVARIANT_USERTYPE = 127
+
+# julian day of 0001-01-01 (proleptic gregorian ordinal 1)
+JULIAN_DAY_OFFSET = 1721425
+
+# number of cached files
+CACHE_SIZE = 256
+
+_CACHE = {}
+_CACHE_LOCK = threading.Lock()
+
+
+def _unescape(text):
+    """
+    Converts the QSettings escaped string into bytes
+    :param text:
+    :return:
+    """
+    res = bytearray()
+    pos = 0
+    for m in PATT_ESCAPE.finditer(text):
+        res.extend(bytearray(text[pos:m.start()].encode("latin-1")))
+        code = m.group(1)
+        if code[0] == "x":
+            res.append(int(code[1:], 16) & 0xff)
+        elif code[0] in "01234567":
+            res.append(int(code, 8) & 0xff)
+        elif code in ESCAPES:
+            res.append(ESCAPES[code])
+        else:
+            res.extend(bytearray(code.encode("latin-1")))
+        pos = m.end()
+    res.extend(bytearray(text[pos:].encode("latin-1")))
+    return bytes(res)
+
+
+def decode_variant(text):
+    """
+    Decodes a serialized QVariant
+    :param text: content of @Variant(...)
+    :return: iso string for QDateTime, list of floats for QcepDoubleList, raw bytes otherwise
+    """
+    raw = _unescape(text)
+    if len(raw) < 4:
+        return raw
+
+    # QSettings stream version has no null flag after the type
+    vtype, = struct.unpack(">I", raw[:4])
+    body = raw[4:]
+
+    try:
+        if vtype == QVARIANT_DATETIME:
+            jd, msec = struct.unpack(">II", body[:8])
+            date = datetime.date.fromordinal(jd - JULIAN_DAY_OFFSET)
+            res = datetime.datetime(date.year, date.month, date.day) + datetime.timedelta(milliseconds=msec)
+            return res.isoformat()
+        elif vtype == QVARIANT_USERTYPE:
+            length, = struct.unpack(">I", body[:4])
+            name = body[4:4 + length].rstrip(b"\0")
+            body = body[4 + length:]
+            if name == b"QcepDoubleList":
+                count, = struct.unpack(">I", body[:4])
+                return list(struct.unpack(">{}d".format(count), body[4:4 + 8 * count]))
+    except (struct.error, ValueError, OverflowError):
+        pass
+    return raw
+
+
+def convert_value(value):
+    """
+    Converts a metadata value into a typed value
+    :param value:
+    :return:
+    """
+    if value.startswith(VARIANT_PREFIX) and value.endswith(VARIANT_SUFFIX):
+        return decode_variant(value[len(VARIANT_PREFIX):-len(VARIANT_SUFFIX)])
+
+    if PATT_INT.match(value):
+        return int(value)
+    if PATT_FLOAT.match(value):
+        return float(value)
+
+    low = value.lower()
+    if low == "true":
+        return True
+    if low == "false":
+        return False
+    return value
+
+
+def parse_metadata_text(text, section=METADATA_SECTION):
+    """
+    Splits the key=value pairs of a section
+    :param text:
+    :param section:
+    :return: dictionary with raw string values
+    """
+    # locate the section body
+    start, end = None, len(text)
+    for m in PATT_SECTION.finditer(text):
+        if start is not None:
+            end = m.start()
+            break
+        if m.group(1).strip() == section:
+            start = m.end()
+
+    res = {}
+    if start is not None:
+        for line in text[start:end].splitlines():
+            key, sep, value = line.partition("=")
+            key = key.strip()
+            if sep and key:
+                res[key] = value.strip()
+    return res
+
+
+def parse_metadata(fnmeta, keys=None, cache=True):
+    """
+    Reads and parses a .metadata file
+    :param fnmeta:
+    :param keys: whitelist of the keys, None - all the keys
+    :param cache: use the cache of the parsed files
+    :return: dictionary with typed values, raises IOError if the file cannot be read
+    """
+    st = os.stat(fnmeta)
+    key = (os.path.basename(fnmeta), st.st_size, st.st_mtime)
+
+    raw = None
+    if cache:
+        with _CACHE_LOCK:
+            raw = _CACHE.get(key)
+
+    if raw is None:
+        with open(fnmeta, "r") as fh:
+            raw = parse_metadata_text(fh.read())
+
+        if cache:
+            with _CACHE_LOCK:
+                if len(_CACHE) >= CACHE_SIZE:
+                    _CACHE.clear()
+                _CACHE[key] = raw
+
+    if keys is None:
+        keys = raw.keys()
+
+    return dict([(k, convert_value(raw[k])) for k in keys if k in raw])
+
+
+def is_metadata_complete(fnmeta, st=None):
+    """
+    Tests that a .metadata file has been written completely - the used= line is present and the last line is terminated
+    The values of a complete file are cached, the merge stage does not read it again
+    :param fnmeta:
+    :param st: stat result of the file if known
+    :return: (bool), raises IOError/OSError if the file cannot be read
+    """
+    with open(fnmeta, "r") as fh:
+        text = fh.read()
+
+    if not text.endswith("\n"):
+        return False
+
+    raw = parse_metadata_text(text)
+    if METADATA_LAST_KEY not in raw:
+        return False
+
+    if st is None:
+        st = os.stat(fnmeta)
+
+    # the file is complete - its size and modification time do not change anymore
+    with _CACHE_LOCK:
+        if len(_CACHE) >= CACHE_SIZE:
+            _CACHE.clear()
+        _CACHE[(os.path.basename(fnmeta), st.st_size, st.st_mtime)] = raw
+    return True
+
+
+def read_header(fnmeta):
+    """
+    Returns the whitelisted header of a .metadata file (METADATA_KEYS)
+    :param fnmeta:
+    :return:
+    """
+    return parse_metadata(fnmeta, keys=METADATA_KEYS)
+
+
+def _legacy_header(fnmeta):
+    """
+    Loop used before by _single_file_merge - kept for comparison
+    :param fnmeta:
+    :return:
+    """
+    header = {}
+    counter = 0
+    patt = re.compile(r'^\s*(dateString|userComment[0-9]|exposureTime|summedExposures)=(.*)$')
+
+    fh = open(fnmeta, "r")
+    for line in fh:
+        line = line.strip()
+
+        m = patt.match(line)
+        if m is not None:
+            h, v = m.groups()
+            header[h] = v
+
+        counter += 1
+        if counter > 30:
+            break
+    fh.close()
+    return header
+
+
+# benchmark on the sample files
+if __name__ == "__main__":
+    samples = glob.glob(os.path.join(os.path.dirname(__file__), "..", "..", "..", "files", "*.metadata"))
+    repeat = 2000
+
+    for (name, func) in (("legacy loop", _legacy_header),
+                         ("parser", lambda fn: parse_metadata(fn, keys=METADATA_KEYS, cache=False)),
+                         ("parser, all keys", lambda fn: parse_metadata(fn, cache=False)),
+                         ("parser, cached", read_header)):
+        timestamp = time.time()
+        for i in range(repeat):
+            for fn in samples:
+                func(fn)
+        elapsed = time.time() - timestamp
+        print("{:20s} {:8.1f} us/file".format(name, elapsed / (repeat * max(len(samples), 1)) * 1e6))
+
+    for fn in samples:
+        print("{}: {}".format(os.path.basename(fn), parse_metadata(fn)))
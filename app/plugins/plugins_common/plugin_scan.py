@@ -0,0 +1,109 @@
+__author__ = 'Konstantin Glazyrin'
+
+"""
+Single pass scanning of the stage directories
+The raw directory is read once, tif files are paired with their .metadata and darks are singled out in the same pass
+The stat results of the directory entries are reused for the readiness test - one stat per entry at most
+"""
+
+import os
+
+try:
+    # python v3.5+
+    from os import scandir
+except ImportError:
+    try:
+        # python v2 backport
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+# suffixes of the raw frames
+TIF_SUFFIX, META_SUFFIX = ".tif", ".tif.metadata"
+
+# marker of the dark frames in the file names
+DARK_MARKER = "dark"
+
+
+class _Entry(object):
+    """
+    Minimal counterpart of os.DirEntry if scandir is not available - the stat result is cached as well
+    """
+    def __init__(self, path, name):
+        self.name = name
+        self.path = os.path.join(path, name)
+        self._stat = None
+
+    def stat(self):
+        if self._stat is None:
+            self._stat = os.stat(self.path)
+        return self._stat
+
+    def is_dir(self):
+        try:
+            return os.path.isdir(self.path)
+        except OSError:
+            return False
+
+
+def iter_entries(path):
+    """
+    Returns the entries of a directory
+    :param path:
+    :return: list of os.DirEntry or its counterpart
+    """
+    if scandir is not None:
+        it = scandir(path)
+        try:
+            return list(it)
+        finally:
+            # python v3.6+ keeps the directory open until the iterator is closed
+            if hasattr(it, "close"):
+                it.close()
+    return [_Entry(path, name) for name in os.listdir(path)]
+
+
+def scan_raw_dir(path):
+    """
+    Walks the raw directory once, pairs the tif files with their meta
+    Entries which disappear while the directory is scanned are skipped
+    :param path:
+    :return: (list of (fn, fnmeta, tif stat, meta stat) sorted by the file name, list of darks, list of tif files without meta)
+    """
+    tifs, metas, darks = {}, {}, []
+
+    for entry in iter_entries(path):
+        name = entry.name
+        if DARK_MARKER in name:
+            darks.append(entry.path)
+        elif name.endswith(TIF_SUFFIX):
+            tifs[name] = entry
+        elif name.endswith(META_SUFFIX):
+            metas[name[:-len(".metadata")]] = entry
+
+    frames, orphans = [], []
+    for name in sorted(tifs.keys()):
+        entry, entry_meta = tifs[name], metas.get(name)
+        if entry_meta is None:
+            orphans.append(entry.path)
+            continue
+
+        try:
+            frames.append((entry.path, entry_meta.path, entry.stat(), entry_meta.stat()))
+        except OSError:
+            continue
+    return frames, darks, orphans
+
+
+def scan_folders(path, prefix="temp"):
+    """
+    Returns the folders of a stage directory - the type of the entry is known without a stat on most systems
+    :param path:
+    :param prefix: name prefix of the folders
+    :return: sorted list of paths
+    """
+    res = []
+    for entry in iter_entries(path):
+        if entry.name.startswith(prefix) and entry.is_dir():
+            res.append(entry.path)
+    return sorted(res)
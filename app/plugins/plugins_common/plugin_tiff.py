@@ -0,0 +1,338 @@
+__author__ = 'Konstantin Glazyrin'
+
+"""
+Header only access to the TIFF files - the pixel data is neither read nor rewritten
+The merged header is stored in the ImageDescription tag as key=value lines
+A new IFD with the updated tag is appended to the end of the file and the header offset is patched
+The layout of the pixel block (strip offsets, data type) is parsed for the zero copy access to the frames
+Completeness of a frame is tested on the structure - the first IFD, its values and all the strips have to be in the file
+"""
+
+import os
+import struct
+
+# classic TIFF header
+TIFF_LITTLE, TIFF_BIG = b"II", b"MM"
+TIFF_MAGIC = 42
+
+# tag storing the merged header
+TAG_IMAGE_DESCRIPTION = 270
+
+# tags describing the pixel block
+TAG_WIDTH, TAG_HEIGHT, TAG_BITS, TAG_COMPRESSION = 256, 257, 258, 259
+TAG_STRIP_OFFSETS, TAG_SAMPLES, TAG_STRIP_COUNTS, TAG_SAMPLE_FORMAT = 273, 277, 279, 339
+
+# field type - ASCII
+TYPE_ASCII = 2
+
+# size of the field types in bytes (TIFF 6.0)
+TYPE_SIZES = {1: 1, 2: 1, 3: 2, 4: 4, 5: 8, 6: 1, 7: 1, 8: 2, 9: 4, 10: 8, 11: 4, 12: 8}
+
+# struct codes of the integer field types
+TYPE_CODES = {1: "B", 3: "H", 4: "I", 6: "b", 8: "h", 9: "i"}
+
+# SampleFormat - numpy kind
+SAMPLE_KINDS = {1: "u", 2: "i", 3: "f"}
+
+IFD_ENTRY_SIZE = 12
+
+
+class TruncatedError(ValueError):
+    """
+    The file ends before its structure - it is still being written or it has been cut
+    """
+    pass
+
+
+def read_tiff_ifd(fh):
+    """
+    Reads the header and the first IFD of a classic TIFF file
+    :param fh: file opened in binary mode
+    :return: (byte order prefix, offset of the first ifd, list of entries (tag, type, count, raw value bytes))
+    """
+    fh.seek(0)
+    head = fh.read(8)
+    if len(head) < 8 or head[:2] not in (TIFF_LITTLE, TIFF_BIG):
+        raise ValueError("Not a TIFF file")
+
+    order = "<" if head[:2] == TIFF_LITTLE else ">"
+    magic, ifd_offset = struct.unpack(order + "HI", head[2:8])
+    if magic != TIFF_MAGIC:
+        raise ValueError("Unsupported TIFF flavour ({})".format(magic))
+
+    fh.seek(ifd_offset)
+    raw = fh.read(2)
+    if len(raw) < 2:
+        raise TruncatedError("Truncated IFD")
+    num, = struct.unpack(order + "H", raw)
+
+    raw = fh.read(num * IFD_ENTRY_SIZE)
+    if len(raw) < num * IFD_ENTRY_SIZE:
+        raise TruncatedError("Truncated IFD")
+
+    entries = []
+    for i in range(num):
+        chunk = raw[i * IFD_ENTRY_SIZE:(i + 1) * IFD_ENTRY_SIZE]
+        tag, ftype, count = struct.unpack(order + "HHI", chunk[:8])
+        entries.append((tag, ftype, count, chunk[8:12]))
+
+    return order, ifd_offset, entries
+
+
+def read_tiff_description(fh, order, entries):
+    """
+    Returns the content of the ImageDescription tag or None
+    :param fh:
+    :param order:
+    :param entries:
+    :return:
+    """
+    res = None
+    for (tag, ftype, count, value) in entries:
+        if tag == TAG_IMAGE_DESCRIPTION and ftype == TYPE_ASCII:
+            if count <= 4:
+                res = value[:count]
+            else:
+                offset, = struct.unpack(order + "I", value)
+                fh.seek(offset)
+                res = fh.read(count)
+            res = res.rstrip(b"\0")
+            break
+    return res
+
+
+def read_tag_values(fh, order, entry):
+    """
+    Returns the values of an integer tag
+    :param fh:
+    :param order:
+    :param entry: (tag, type, count, raw value bytes)
+    :return: list of integers
+    """
+    tag, ftype, count, value = entry
+    if ftype not in TYPE_CODES:
+        raise ValueError("Unsupported type ({}) of the tag ({})".format(ftype, tag))
+
+    size = TYPE_SIZES[ftype] * count
+    if size > 4:
+        offset, = struct.unpack(order + "I", value)
+        fh.seek(offset)
+        value = fh.read(size)
+        if len(value) < size:
+            raise TruncatedError("Truncated values of the tag ({})".format(tag))
+
+    return list(struct.unpack("{}{}{}".format(order, count, TYPE_CODES[ftype]), value[:size]))
+
+
+def read_tiff_layout(fh, order, entries):
+    """
+    Describes the pixel block of an uncompressed single sample image stored in contiguous strips
+    :param fh:
+    :param order:
+    :param entries:
+    :return: dictionary - width, height, bits, dtype (numpy notation), offset and size of the pixel block
+    """
+    tags = dict([(e[0], e) for e in entries])
+
+    def value(tag, default=None):
+        if tag not in tags:
+            if default is None:
+                raise ValueError("Missing tag ({})".format(tag))
+            return default
+        return read_tag_values(fh, order, tags[tag])
+
+    width, height = value(TAG_WIDTH)[0], value(TAG_HEIGHT)[0]
+    bits = value(TAG_BITS, [1])[0]
+    samples = value(TAG_SAMPLES, [1])[0]
+    kind = SAMPLE_KINDS.get(value(TAG_SAMPLE_FORMAT, [1])[0])
+
+    if value(TAG_COMPRESSION, [1])[0] != 1:
+        raise ValueError("Compressed images are not supported")
+    if samples != 1 or kind is None or bits % 8:
+        raise ValueError("Unsupported pixel format ({} samples, {} bits)".format(samples, bits))
+
+    offsets, counts = value(TAG_STRIP_OFFSETS), value(TAG_STRIP_COUNTS)
+    if len(offsets) != len(counts):
+        raise ValueError("Inconsistent strip tags")
+
+    for i in range(1, len(offsets)):
+        if offsets[i] != offsets[i - 1] + counts[i - 1]:
+            raise ValueError("Strips are not contiguous")
+
+    size = width * height * bits // 8
+    if sum(counts) < size:
+        raise ValueError("Strips are shorter than the image")
+
+    return {"width": width, "height": height, "bits": bits,
+            "dtype": "{}{}{}".format(order, kind, bits // 8),
+            "offset": offsets[0], "size": size}
+
+
+def get_tiff_end(fh, order, ifd_offset, entries):
+    """
+    Returns the length a complete file needs - the end of the IFD, of the values stored outside of it and of the strips
+    :param fh:
+    :param order:
+    :param ifd_offset:
+    :param entries:
+    :return: (bytes)
+    """
+    res = ifd_offset + 2 + len(entries) * IFD_ENTRY_SIZE + 4
+
+    tags = {}
+    for entry in entries:
+        tag, ftype, count, value = entry
+        tags[tag] = entry
+
+        size = TYPE_SIZES.get(ftype, 1) * count
+        if size > 4:
+            offset, = struct.unpack(order + "I", value)
+            res = max(res, offset + size)
+
+    if TAG_STRIP_OFFSETS not in tags or TAG_STRIP_COUNTS not in tags:
+        raise ValueError("Missing strip tags")
+
+    offsets = read_tag_values(fh, order, tags[TAG_STRIP_OFFSETS])
+    counts = read_tag_values(fh, order, tags[TAG_STRIP_COUNTS])
+    if len(offsets) != len(counts):
+        raise ValueError("Inconsistent strip tags")
+
+    # uncompressed strips have to hold the whole image
+    if TAG_COMPRESSION not in tags or read_tag_values(fh, order, tags[TAG_COMPRESSION])[0] == 1:
+        width, height = read_tag_values(fh, order, tags[TAG_WIDTH])[0], read_tag_values(fh, order, tags[TAG_HEIGHT])[0]
+        bits = read_tag_values(fh, order, tags[TAG_BITS])[0] if TAG_BITS in tags else 1
+        samples = read_tag_values(fh, order, tags[TAG_SAMPLES])[0] if TAG_SAMPLES in tags else 1
+        if sum(counts) < width * height * samples * bits // 8:
+            raise ValueError("Strips are shorter than the image")
+
+    for (offset, count) in zip(offsets, counts):
+        res = max(res, offset + count)
+    return res
+
+
+def is_tiff_complete(fn, size=None):
+    """
+    Tests that a tif file has been written completely - only the header and the first IFD are read
+    A file being written has no IFD yet (libtiff writes it last), or is shorter than the end of its strips
+    :param fn:
+    :param size: size of the file if known
+    :return: (bool), raises ValueError if the file is not a classic TIFF file, IOError/OSError if it cannot be read
+    """
+    with open(fn, "rb") as fh:
+        if size is None:
+            size = os.fstat(fh.fileno()).st_size
+
+        head = fh.read(8)
+        if len(head) < 8:
+            return False
+
+        # zero or out of file offset - the IFD has not been written yet
+        order = "<" if head[:2] == TIFF_LITTLE else ">"
+        ifd_offset, = struct.unpack(order + "I", head[4:8])
+        if head[:2] in (TIFF_LITTLE, TIFF_BIG) and (ifd_offset < 8 or ifd_offset + 2 > size):
+            return False
+
+        try:
+            order, ifd_offset, entries = read_tiff_ifd(fh)
+            end = get_tiff_end(fh, order, ifd_offset, entries)
+        except TruncatedError:
+            return False
+    return size >= end
+
+
+def _to_text(value):
+    if isinstance(value, bytes) and not isinstance(value, str):
+        value = value.decode("utf-8", "replace")
+    return value
+
+
+def _to_bytes(value):
+    if not isinstance(value, bytes):
+        value = value.encode("utf-8")
+    return value
+
+
+def format_description(header, description=None):
+    """
+    Merges the header into an existing description of key=value lines
+    :param header: dictionary
+    :param description: existing description or None
+    :return: bytes
+    """
+    lines, keys = [], {}
+    if description:
+        for line in _to_text(description).splitlines():
+            key = line.split("=", 1)[0] if "=" in line else None
+            if key is not None:
+                keys[key] = len(lines)
+            lines.append(line)
+
+    for key in sorted(header.keys()):
+        line = u"{}={}".format(_to_text(key), _to_text(header[key]))
+        if key in keys:
+            lines[keys[key]] = line
+        else:
+            lines.append(line)
+
+    return _to_bytes(u"\n".join([_to_text(line) for line in lines]))
+
+
+def update_tiff_header(fn, header):
+    """
+    Stores the header in the ImageDescription tag touching only the header bytes
+    The description and a copy of the first IFD are appended, the offset in the TIFF header is patched last
+    :param fn: tif file
+    :param header: dictionary
+    :return: (bool) - True if the file was modified, False if it already had the same description
+    """
+    with open(fn, "r+b") as fh:
+        order, ifd_offset, entries = read_tiff_ifd(fh)
+
+        # next ifd offset follows the entries
+        fh.seek(ifd_offset + 2 + len(entries) * IFD_ENTRY_SIZE)
+        next_ifd = fh.read(4)
+        if len(next_ifd) < 4:
+            raise ValueError("Truncated IFD")
+
+        old_description = read_tiff_description(fh, order, entries)
+        description = format_description(header, old_description) + b"\0"
+
+        if old_description is not None and old_description + b"\0" == description:
+            return False
+
+        fh.seek(0, os.SEEK_END)
+        end = fh.tell()
+
+        # description value - inline if it fits 4 bytes
+        count = len(description)
+        chunks = []
+        if count <= 4:
+            value = description.ljust(4, b"\0")
+        else:
+            end += end % 2
+            chunks.append((end, description))
+            value = struct.pack(order + "I", end)
+            end += count
+
+        entries = [e for e in entries if e[0] != TAG_IMAGE_DESCRIPTION]
+        entries.append((TAG_IMAGE_DESCRIPTION, TYPE_ASCII, count, value))
+        entries.sort(key=lambda e: e[0])
+
+        ifd = [struct.pack(order + "H", len(entries))]
+        for (tag, ftype, cnt, val) in entries:
+            ifd.append(struct.pack(order + "HHI", tag, ftype, cnt) + val)
+        ifd.append(next_ifd)
+
+        end += end % 2
+        new_ifd_offset = end
+        chunks.append((new_ifd_offset, b"".join(ifd)))
+
+        for (offset, data) in chunks:
+            fh.seek(offset)
+            fh.write(data)
+        fh.flush()
+
+        # switch to the new ifd - the file stays valid at every moment
+        fh.seek(4)
+        fh.write(struct.pack(order + "I", new_ifd_offset))
+    return True
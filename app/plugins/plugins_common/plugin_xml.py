@@ -1,4 +1,4 @@
-from plugin_memcached import set_key
+from plugin_memcached import set_multi
 import time
 import re
 import xml.etree.ElementTree as ET
@@ -12,6 +12,8 @@ def process_xml_root(worker, xml_root, root_ref=""):
     :param root_ref:
     :return:
     """
+    # values of the document are sent in one round trip
+    values = {}
     try:
         # process all update values
         for child in xml_root.findall("update"):
@@ -47,11 +49,12 @@ def process_xml_root(worker, xml_root, root_ref=""):
             id = u"{}{}".format(root_ref, id)
 
             # set memcache
-            set_key(id, value, logger=worker)
+            values[id] = value
 
-            # set timestamp
-            id = u"{}{}".format(root_ref, "timestamp")
-            set_key(id, time.time(), logger=worker)
+        # set timestamp
+        if len(values) > 0:
+            values[u"{}{}".format(root_ref, "timestamp")] = time.time()
+            set_multi(values, logger=worker)
 
     except ET.ParseError as e:
         worker.error(u"Could not process data - invalid response from the server: {}".format(e))
\ No newline at end of file
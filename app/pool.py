@@ -0,0 +1,285 @@
+__author__ = 'Konstantin Glazyrin'
+
+"""
+Long lived worker pools shared by the plugins
+Thread pools serve the I/O bound tasks (one pool per I/O class), process pools serve the CPU bound tasks
+Pools stay alive between the ticks and are resized on the fly - the size of the plugin pools follows the MaxProc attribute
+"""
+
+import threading
+import multiprocessing
+
+try:
+    # python v2
+    import Queue as queue
+except ImportError:
+    import queue
+
+from app.common import *
+
+# I/O classes of the thread pools
+POOL_LOCAL, POOL_MERGE, POOL_REMOTE = "local", "merge", "remote"
+
+# file copies issued by the POOL_REMOTE tasks - a separate pool, nested map() calls on the same pool could deadlock
+POOL_COPY = "copy"
+
+# name - pool
+_POOLS = {}
+_POOLS_LOCK = threading.Lock()
+
+
+class _Batch(object):
+    """
+    Collects the results of the tasks submitted by a single map() call
+    """
+    def __init__(self, size):
+        self.results = [None] * size
+        self.left = size
+        self.event = threading.Event()
+        self._lock = threading.Lock()
+
+        if size == 0:
+            self.event.set()
+
+    def done(self, index, value):
+        with self._lock:
+            self.results[index] = value
+            self.left -= 1
+            if self.left == 0:
+                self.event.set()
+
+
+class ThreadPool(Tester):
+    # the size follows the MaxProc attribute
+    maxproc = False
+
+    # time for an idle thread to check if the pool has been shrunk (s)
+    IDLE_TIMEOUT = 1.
+
+    def __init__(self, name, size=1, debug_level=None):
+        Tester.__init__(self, def_file="pool_{}".format(name), debug_level=debug_level, nofile=True)
+
+        self.name = name
+        self.size = 0
+
+        self.tasks = queue.Queue()
+
+        # index - thread
+        self.threads = {}
+        self._lock = threading.Lock()
+
+        self.resize(size)
+
+    def resize(self, size):
+        """
+        Changes the number of the threads - new threads are started at once, surplus threads exit when idle
+        :param size:
+        :return:
+        """
+        size = max(1, int(size))
+        with self._lock:
+            if size != self.size:
+                self.debug("Resizing the pool ({}) from ({}) to ({})".format(self.name, self.size, size))
+            self.size = size
+
+            for index in range(size):
+                if index not in self.threads:
+                    th = threading.Thread(target=self._run, args=(index,), name="{}_{}".format(self.name, index))
+                    th.setDaemon(True)
+                    self.threads[index] = th
+                    th.start()
+
+    def map(self, func, items, *args):
+        """
+        Runs func(item, *args) for every item, blocks until all the items are processed
+        :param func:
+        :param items:
+        :param args:
+        :return: list of results in the order of items
+        :raise RuntimeError: the pool has been shut down - there are no threads left to run the tasks
+        """
+        items = list(items)
+        batch = _Batch(len(items))
+
+        # the tasks are queued under the lock - a thread exits only on an empty queue,
+        # the queued tasks keep at least one thread of a running pool alive
+        with self._lock:
+            if self.size == 0:
+                raise RuntimeError("Pool ({}) has been shut down".format(self.name))
+
+            for (i, item) in enumerate(items):
+                self.tasks.put((func, (item,) + args, batch, i))
+
+        batch.event.wait()
+        return batch.results
+
+    def shutdown(self):
+        """
+        Lets the threads exit after the queued tasks are done
+        :return:
+        """
+        with self._lock:
+            self.size = 0
+
+    def _run(self, index):
+        while True:
+            with self._lock:
+                # surplus threads exit only when there is nothing to do
+                if index >= self.size and self.tasks.empty():
+                    del self.threads[index]
+                    break
+
+            try:
+                func, args, batch, i = self.tasks.get(timeout=self.IDLE_TIMEOUT)
+            except queue.Empty:
+                continue
+
+            res = None
+            try:
+                res = func(*args)
+            except Exception as e:
+                self.error("Task ({}) of the pool ({}) has failed: {}".format(func.__name__, self.name, e))
+            finally:
+                batch.done(i, res)
+                self.tasks.task_done()
+
+
+class TaskError(object):
+    """
+    Marker returned by a task of a process pool which has raised - the exception is formatted in the child,
+    exceptions are not always picklable
+    """
+    def __init__(self, name, item, message):
+        self.name = name
+        self.item = item
+        self.message = message
+
+    def __repr__(self):
+        return "TaskError({}, {}, {})".format(self.name, self.item, self.message)
+
+
+def _call(task):
+    """
+    Unpacks a task in the child process, an exception affects only its own task
+    :param task:
+    :return: result of the task or TaskError
+    """
+    func, item, args = task
+    try:
+        return func(item, *args)
+    except Exception as e:
+        return TaskError(func.__name__, item, "{}: {}".format(e.__class__.__name__, e))
+
+
+class ProcessPool(Tester):
+    # the size follows the MaxProc attribute
+    maxproc = False
+
+    def __init__(self, name, size=1, debug_level=None):
+        Tester.__init__(self, def_file="pool_{}".format(name), debug_level=debug_level, nofile=True)
+
+        self.name = name
+        self.size = max(1, int(size))
+
+        self._pool = None
+        self._lock = threading.Lock()
+
+    def resize(self, size):
+        """
+        Changes the number of the processes - the old pool finishes its tasks, a new one is created on demand
+        :param size:
+        :return:
+        """
+        size = max(1, int(size))
+        with self._lock:
+            if size != self.size:
+                self.debug("Resizing the pool ({}) from ({}) to ({})".format(self.name, self.size, size))
+                self.size = size
+
+                if self._pool is not None:
+                    self._pool.close()
+                    self._pool = None
+
+    def map(self, func, items, *args):
+        """
+        Runs func(item, *args) in the child processes, func, items and args should be picklable
+        :param func: module level function
+        :param items:
+        :param args:
+        :return: list of results in the order of items, None for the failed tasks
+        """
+        items = list(items)
+        if len(items) == 0:
+            return []
+
+        tasks = [(func, item, args) for item in items]
+
+        # the tasks are submitted under the lock - resize() cannot close the pool in between,
+        # a pool closed afterwards still completes the submitted tasks
+        with self._lock:
+            if self._pool is None:
+                # the children log synchronously - the queue of the parent is not read by anyone in a child
+                self._pool = multiprocessing.Pool(processes=self.size, initializer=after_fork)
+            res = self._pool.map_async(_call, tasks, chunksize=1)
+        res = res.get()
+
+        # failed tasks are reported and return None, the same as in the thread pools
+        for (i, el) in enumerate(res):
+            if isinstance(el, TaskError):
+                self.error("Task (%s) of the pool (%s) has failed for (%s): %s", el.name, self.name, el.item, el.message)
+                res[i] = None
+        return res
+
+    def shutdown(self):
+        with self._lock:
+            if self._pool is not None:
+                self._pool.close()
+                self._pool.join()
+                self._pool = None
+
+
+def get_pool(name, size, process=False, maxproc=False):
+    """
+    Returns a shared pool, creates it on the first use and resizes it if the size has changed
+    :param name: I/O class or any other pool identifier
+    :param size: number of the workers
+    :param process: True for a process pool
+    :param maxproc: True if the size follows the MaxProc attribute - the pool is resized by resize_pools()
+    :return:
+    """
+    with _POOLS_LOCK:
+        pool = _POOLS.get(name)
+        if pool is None:
+            if process:
+                pool = ProcessPool(name, size)
+            else:
+                pool = ThreadPool(name, size)
+            pool.maxproc = maxproc
+            _POOLS[name] = pool
+    pool.resize(size)
+    return pool
+
+
+def resize_pools(size):
+    """
+    Resizes the pools sized by MaxProc - applied when MaxProc is changed
+    Pools with a size of their own (cores, COPY_WORKERS) are not touched
+    :param size:
+    :return:
+    """
+    with _POOLS_LOCK:
+        pools = [pool for pool in _POOLS.values() if pool.maxproc]
+    for pool in pools:
+        pool.resize(size)
+
+
+def shutdown_pools():
+    """
+    Stops all the pools
+    :return:
+    """
+    with _POOLS_LOCK:
+        pools = list(_POOLS.values())
+        _POOLS.clear()
+    for pool in pools:
+        pool.shutdown()
@@ -0,0 +1,325 @@
+__author__ = 'Konstantin Glazyrin'
+
+"""
+Write-behind spool of the remote output
+Locked folders are queued by the finalize stage and copied in the background, older folders first
+The copies share a token bucket limiting the bandwidth to the remote storage
+The number of concurrent copies follows the observed throughput - it grows while the throughput grows
+"""
+
+import heapq
+import threading
+
+from app.common import *
+from app.config import SPOOL_BANDWIDTH, SPOOL_BURST, SPOOL_ADAPT_INTERVAL, SPOOL_ADAPT_GAIN, SPOOL_BOOST_FACTOR
+
+# bytes in MB
+MB = 1e6
+
+_SPOOL = None
+_SPOOL_LOCK = threading.Lock()
+
+
+class TokenBucket(object):
+    """
+    Bandwidth limit shared by the copies - consume() sleeps while the bucket is in debt
+    """
+    def __init__(self, rate=SPOOL_BANDWIDTH, burst=SPOOL_BURST):
+        self._lock = threading.Lock()
+        self.rate = 0.
+        self.suspended = False
+        self.burst = float(burst)
+        self.tokens = self.burst
+        self.timestamp = time.time()
+
+        self.set_rate(rate)
+
+    def set_rate(self, rate):
+        """
+        Changes the limit
+        :param rate: MB/s, 0 or None - no limit
+        :return:
+        """
+        with self._lock:
+            self._refill()
+            self.rate = max(0., float(rate or 0.)) * MB
+
+    def get_rate(self):
+        return self.rate / MB
+
+    def consume(self, size):
+        """
+        Takes size bytes from the bucket, sleeps until the debt is paid back
+        :param size:
+        :return:
+        """
+        with self._lock:
+            if self.rate <= 0. or self.suspended:
+                return
+            self._refill()
+            self.tokens -= size
+            delay = -self.tokens / self.rate if self.tokens < 0 else 0.
+
+        if delay > 0:
+            time.sleep(delay)
+
+    def _refill(self):
+        now = time.time()
+        if self.rate > 0.:
+            self.tokens = min(self.burst, self.tokens + (now - self.timestamp) * self.rate)
+        else:
+            self.tokens = self.burst
+        self.timestamp = now
+
+
+_BUCKET = TokenBucket()
+
+
+class Spool(Tester):
+    # time to wait for a new folder (s)
+    IDLE_TIMEOUT = 0.5
+
+    def __init__(self, workers=1, debug_level=None):
+        Tester.__init__(self, def_file="spool", debug_level=debug_level, nofile=True)
+
+        # queued folders (age, sequence number, path, func, args)
+        self.heap = []
+        self.counter = 0
+
+        # maximum and current number of concurrent copies
+        self.workers = max(1, int(workers))
+        self.limit = max(1, self.workers // 2)
+        self.active = 0
+
+        # all the threads copy while the RAM disk is under pressure
+        self.boost = False
+
+        self.threads = []
+        self._cond = threading.Condition()
+        self._stop_flag = threading.Event()
+
+        # throughput of the current window and of the previous limit
+        self.window_bytes = 0
+        self.window_start = time.time()
+        self.last_rate = None
+        self.direction = 1
+
+        self.resize(workers)
+
+    def resize(self, workers):
+        """
+        Changes the maximum number of concurrent copies
+        :param workers:
+        :return:
+        """
+        with self._cond:
+            self.workers = max(1, int(workers))
+            self.limit = min(self.limit, self.workers)
+            self._start_threads()
+
+    def set_boost(self, boost):
+        """
+        Raises the number of concurrent copies to SPOOL_BOOST_FACTOR * workers, the adaptation is paused meanwhile
+        :param boost:
+        :return:
+        """
+        with self._cond:
+            if boost == self.boost:
+                return
+            self.boost = boost
+
+            if boost:
+                self.limit = self.get_max_limit()
+            else:
+                self.limit = min(self.limit, self.workers)
+            self.debug("Boost of the spool ({}), number of copies ({})".format(boost, self.limit))
+            self._start_threads()
+
+    def get_max_limit(self):
+        if self.boost:
+            return max(1, int(self.workers * SPOOL_BOOST_FACTOR))
+        return self.workers
+
+    def _start_threads(self):
+        """
+        Starts the missing threads - called with the condition held
+        :return:
+        """
+        while len(self.threads) < self.get_max_limit():
+            th = threading.Thread(target=self._run, name="spool_{}".format(len(self.threads)))
+            th.setDaemon(True)
+            self.threads.append(th)
+            th.start()
+        self._cond.notify_all()
+
+    def submit(self, path, func, *args):
+        """
+        Queues a locked folder, returns at once
+        :param path: folder
+        :param func: func(path, *args, t=logger) copying the folder, returns the number of bytes copied
+        :param args:
+        :return:
+        """
+        try:
+            age = os.path.getmtime(path)
+        except OSError:
+            age = time.time()
+
+        with self._cond:
+            self.counter += 1
+            heapq.heappush(self.heap, (age, self.counter, path, func, args))
+            self._cond.notify()
+
+        self.debug("Folder ({}) was queued, ({}) folders are waiting".format(path, len(self.heap)))
+
+    def get_info(self):
+        """
+        Returns the state of the spool
+        :return: dictionary - queued, active, limit, workers, bandwidth limit (MB/s) and the last throughput (MB/s)
+        """
+        with self._cond:
+            return {"queued": len(self.heap), "active": self.active, "limit": self.limit, "workers": self.workers,
+                    "boost": self.boost, "bandwidth": _BUCKET.get_rate(), "rate": self.last_rate or 0.}
+
+    def stop(self, timeout=1.):
+        """
+        Stops the threads after the running copies, queued folders are unlocked for the plugins
+        :param timeout:
+        :return:
+        """
+        self._stop_flag.set()
+        with self._cond:
+            self._cond.notify_all()
+
+        for th in self.threads:
+            th.join(timeout)
+
+        with self._cond:
+            items, self.heap = self.heap, []
+
+        for item in items:
+            path = item[2]
+            try:
+                os.rename(path, path.replace(".lock", ""))
+            except OSError as e:
+                self.error("Could not unlock the queued folder ({}): {}".format(path, e))
+
+    def _run(self):
+        while not self._stop_flag.is_set():
+            with self._cond:
+                if len(self.heap) == 0 or self.active >= self.limit:
+                    self._cond.wait(self.IDLE_TIMEOUT)
+                    continue
+
+                age, counter, path, func, args = heapq.heappop(self.heap)
+                self.active += 1
+
+            size = 0
+            try:
+                size = func(path, *args, t=self) or 0
+            except Exception as e:
+                self.error("Spooled copy of ({}) has failed: {}".format(path, e))
+            finally:
+                with self._cond:
+                    self.active -= 1
+                    self.window_bytes += size
+                    self._adapt()
+                    self._cond.notify_all()
+
+    def _adapt(self):
+        """
+        Hill climbing on the number of concurrent copies - called with the condition held
+        The limit is moved in the same direction while the throughput improves, the direction is reversed otherwise
+        :return:
+        """
+        now = time.time()
+        elapsed = now - self.window_start
+        if elapsed < SPOOL_ADAPT_INTERVAL:
+            return
+
+        rate = self.window_bytes / elapsed / MB
+        self.window_bytes, self.window_start = 0, now
+
+        # nothing to compare if the spool was not busy or if the limit is fixed
+        if self.boost or (len(self.heap) == 0 and self.active == 0):
+            self.last_rate = rate
+            return
+
+        if self.last_rate is not None and rate < self.last_rate * (1. + SPOOL_ADAPT_GAIN):
+            self.direction = -self.direction
+
+        limit = max(1, min(self.workers, self.limit + self.direction))
+        if limit != self.limit:
+            self.debug("Throughput ({:.1f} MB/s), changing the number of copies from ({}) to ({})".format(
+                rate, self.limit, limit))
+        self.limit = limit
+        self.last_rate = rate
+
+
+def throttle(size):
+    """
+    Takes size bytes from the bandwidth limit - called by the copies before every chunk
+    :param size:
+    :return:
+    """
+    _BUCKET.consume(size)
+
+
+def set_bandwidth(rate):
+    """
+    Changes the bandwidth limit of the remote copies
+    :param rate: MB/s, 0 - no limit
+    :return:
+    """
+    _BUCKET.set_rate(rate)
+
+
+def suspend_bandwidth(suspended):
+    """
+    Lifts the bandwidth limit temporarily, the configured value is kept
+    :param suspended:
+    :return:
+    """
+    _BUCKET.suspended = suspended
+
+
+def get_bandwidth():
+    return _BUCKET.get_rate()
+
+
+def is_throttled():
+    return _BUCKET.rate > 0.
+
+
+def get_spool():
+    """
+    Returns the running spool or None
+    :return:
+    """
+    return _SPOOL
+
+
+def start_spool(workers=1, debug_level=None):
+    """
+    Starts the spool if it is not running
+    :param workers:
+    :param debug_level:
+    :return:
+    """
+    global _SPOOL
+    with _SPOOL_LOCK:
+        if _SPOOL is None:
+            _SPOOL = Spool(workers=workers, debug_level=debug_level)
+    return _SPOOL
+
+
+def stop_spool():
+    """
+    Stops the spool
+    :return:
+    """
+    global _SPOOL
+    with _SPOOL_LOCK:
+        res, _SPOOL = _SPOOL, None
+    if res is not None:
+        res.stop()
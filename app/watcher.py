@@ -0,0 +1,305 @@
+__author__ = 'Konstantin Glazyrin'
+
+"""
+Event based monitoring of the raw directory
+On linux the kernel inotify interface is used (close-write and moved-to events), otherwise the directory listing is polled
+Events are collected into a persistent queue which is drained by the plugins
+"""
+
+import os
+import sys
+import time
+import struct
+import select
+import threading
+import ctypes
+import ctypes.util
+
+try:
+    # python v2
+    import Queue as queue
+except ImportError:
+    import queue
+
+from app.common import *
+
+# modes of operation
+WATCH_AUTO, WATCH_INOTIFY, WATCH_POLL = "auto", "inotify", "poll"
+
+# inotify constants - linux/inotify.h
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_Q_OVERFLOW = 0x00004000
+IN_NONBLOCK = 0x00000800
+IN_CLOEXEC = 0x00080000
+
+# struct inotify_event {int wd; uint32 mask; uint32 cookie; uint32 len; char name[];}
+EVENT_FORMAT = "iIII"
+EVENT_SIZE = struct.calcsize(EVENT_FORMAT)
+EVENT_BUFFER = 65536
+
+# watchers shared by the daemon and the plugins, key - normalized path
+_WATCHERS = {}
+_WATCHERS_LOCK = threading.Lock()
+
+
+class RawDirWatcher(Tester):
+    # interval between the directory listings in the polling mode (s)
+    POLL_INTERVAL = 0.05
+
+    # timeout of a blocking wait on the inotify descriptor (s) - controls the reaction on stop()
+    SELECT_TIMEOUT = 0.5
+
+    def __init__(self, path, mode=WATCH_AUTO, debug_level=None):
+        Tester.__init__(self, def_file="watcher", debug_level=debug_level)
+
+        self.path = path
+        self.mode = mode
+
+        # persistent queue of the file paths reported by the watcher
+        self.events = queue.Queue()
+
+        # set every time a new event is added to the queue
+        self.event_flag = threading.Event()
+
+        self._stop_flag = threading.Event()
+        self._thread = None
+        self._libc = None
+        self._fd = None
+
+    def start(self):
+        """
+        Selects the mode of operation and starts a watching thread
+        :return: (bool) - True if the watcher is running
+        """
+        if self.is_alive():
+            return True
+
+        if not os.path.isdir(self.path):
+            self.error("Cannot watch the directory ({}) - it does not exist".format(self.path))
+            return False
+
+        self._stop_flag.clear()
+
+        target = self._run_poll
+        if self.mode in (WATCH_AUTO, WATCH_INOTIFY) and self._init_inotify():
+            target = self._run_inotify
+            self.mode = WATCH_INOTIFY
+        else:
+            if self.mode == WATCH_INOTIFY:
+                self.warning("Inotify is not available, falling back to the polling of ({})".format(self.path))
+            self.mode = WATCH_POLL
+
+        self.info("Watching the directory ({}) in the ({}) mode".format(self.path, self.mode))
+
+        # files which were present before the start are reported as well
+        self._put_listing()
+
+        self._thread = threading.Thread(target=target, name="watch_raw")
+        self._thread.setDaemon(True)
+        self._thread.start()
+        return True
+
+    def stop(self, timeout=1.):
+        """
+        Stops the watching thread and releases the inotify descriptor
+        :param timeout:
+        :return:
+        """
+        self._stop_flag.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+        if self._fd is not None:
+            try:
+                os.close(self._fd)
+            except OSError:
+                pass
+            self._fd = None
+
+    def is_alive(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def wait(self, timeout=None):
+        """
+        Blocks until new events arrive or timeout expires
+        :param timeout:
+        :return: (bool) - True if new events were reported
+        """
+        res = self.event_flag.wait(timeout)
+        if res:
+            self.event_flag.clear()
+        return bool(res)
+
+    def get_events(self, max_items=None):
+        """
+        Drains the event queue without blocking
+        :param max_items: maximum number of paths to return
+        :return: list of paths
+        """
+        res = []
+        while max_items is None or len(res) < max_items:
+            try:
+                res.append(self.events.get_nowait())
+            except queue.Empty:
+                break
+        return res
+
+    def _put(self, name):
+        self.events.put(os.path.join(self.path, name))
+        self.event_flag.set()
+
+    def _put_listing(self):
+        """
+        Reports every entry of the directory - used on start and on inotify queue overflow
+        :return: set of the entry names
+        """
+        names = set()
+        try:
+            names = set(os.listdir(self.path))
+        except OSError as e:
+            self.error("Could not list the directory ({}): {}".format(self.path, e))
+
+        for name in names:
+            self._put(name)
+        return names
+
+    def _init_inotify(self):
+        """
+        Opens an inotify descriptor through the C library
+        :return: (bool) - success
+        """
+        try:
+            libname = ctypes.util.find_library("c")
+            if libname is None:
+                raise AttributeError
+
+            libc = ctypes.CDLL(libname, use_errno=True)
+            fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+            if fd < 0:
+                raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+
+            path = self.path
+            if not isinstance(path, bytes):
+                path = path.encode(sys.getfilesystemencoding())
+
+            wd = libc.inotify_add_watch(fd, ctypes.c_char_p(path), IN_CLOSE_WRITE | IN_MOVED_TO)
+            if wd < 0:
+                os.close(fd)
+                raise OSError(ctypes.get_errno(), "inotify_add_watch failed")
+        except (AttributeError, OSError) as e:
+            self.debug("Inotify is not available ({})".format(e))
+            return False
+
+        self._libc, self._fd = libc, fd
+        return True
+
+    def _run_inotify(self):
+        """
+        Reads the close-write and moved-to events from the inotify descriptor
+        :return:
+        """
+        while not self._stop_flag.is_set():
+            try:
+                ready, _, _ = select.select([self._fd], [], [], self.SELECT_TIMEOUT)
+                if not ready:
+                    continue
+
+                buf = os.read(self._fd, EVENT_BUFFER)
+            except (OSError, select.error, ValueError) as e:
+                if self._stop_flag.is_set():
+                    break
+                self.error("Error while reading inotify events ({})".format(e))
+                time.sleep(self.SELECT_TIMEOUT)
+                continue
+
+            offset = 0
+            while offset + EVENT_SIZE <= len(buf):
+                wd, mask, cookie, length = struct.unpack_from(EVENT_FORMAT, buf, offset)
+                name = buf[offset + EVENT_SIZE:offset + EVENT_SIZE + length].rstrip(b"\0")
+                offset += EVENT_SIZE + length
+
+                if mask & IN_Q_OVERFLOW:
+                    self.warning("Inotify queue overflow, rescanning the directory ({})".format(self.path))
+                    self._put_listing()
+                    continue
+
+                if len(name) == 0:
+                    continue
+
+                if not isinstance(name, str):
+                    name = name.decode(sys.getfilesystemencoding())
+
+                self._put(name)
+
+    def _run_poll(self):
+        """
+        Fallback - compares consecutive directory listings, reports new entries
+        :return:
+        """
+        known = set()
+        try:
+            known = set(os.listdir(self.path))
+        except OSError:
+            pass
+
+        while not self._stop_flag.wait(self.POLL_INTERVAL):
+            try:
+                names = set(os.listdir(self.path))
+            except OSError as e:
+                self.error("Could not list the directory ({}): {}".format(self.path, e))
+                continue
+
+            for name in names - known:
+                self._put(name)
+            known = names
+
+
+def _norm_path(path):
+    return os.path.normcase(os.path.abspath(path))
+
+
+def get_watcher(path):
+    """
+    Returns a running watcher for the path or None
+    :param path:
+    :return:
+    """
+    with _WATCHERS_LOCK:
+        res = _WATCHERS.get(_norm_path(path))
+    if res is not None and not res.is_alive():
+        res = None
+    return res
+
+
+def start_watcher(path, mode=WATCH_AUTO, debug_level=None):
+    """
+    Starts (or returns an already running) watcher of the path
+    :param path:
+    :param mode:
+    :param debug_level:
+    :return: watcher or None if it could not be started
+    """
+    key = _norm_path(path)
+    with _WATCHERS_LOCK:
+        res = _WATCHERS.get(key)
+        if res is None or not res.is_alive():
+            res = RawDirWatcher(path, mode=mode, debug_level=debug_level)
+            if res.start():
+                _WATCHERS[key] = res
+            else:
+                res = None
+    return res
+
+
+def stop_watcher(path):
+    """
+    Stops the watcher of the path if it exists
+    :param path:
+    :return:
+    """
+    with _WATCHERS_LOCK:
+        res = _WATCHERS.pop(_norm_path(path), None)
+    if res is not None:
+        res.stop()
@@ -0,0 +1,343 @@
+__author__ = 'Konstantin Glazyrin'
+
+"""
+End-to-end benchmark of the plugin chain (Linux)
+Synthetic QXRD frames (tif + .metadata, darks included) are written at a given rate into a tmpfs raw directory,
+the daemon with the real plugins moves, merges and finalizes them into the output directory
+Frames/s, end-to-end and per stage latencies, CPU time and peak RSS are written as JSON
+
+The finalize copies are made by the kernel (copy_file_range, sendfile) and verified by their size by default,
+--checksum measures the checksummed copies (COPY_CHECKSUM) instead
+
+python benchmark.py --frames=200 --rate=10 --maxproc=1,2,5 --output=results.json
+"""
+
+import os
+import sys
+import json
+import time
+import glob
+import shutil
+import struct
+import argparse
+import platform
+import tempfile
+import threading
+import subprocess
+import multiprocessing
+
+import numpy
+
+import app.config as config
+
+# templates of the metadata files
+DIR_FILES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "files")
+TEMPLATE_FRAME = os.path.join(DIR_FILES, "CeO2_09_11_2017-00001.tif.metadata")
+TEMPLATE_DARK = os.path.join(DIR_FILES, "CeO2_09_11_2017-00001.dark.tif.metadata")
+
+# numpy type - (bits, SampleFormat)
+PIXEL_TYPES = {"uint16": (16, 1), "uint32": (32, 1), "int32": (32, 2), "float32": (32, 3)}
+
+# number of distinct pixel blocks cycled by the generator
+PIXEL_BLOCKS = 4
+
+# period of the output directory scan (s)
+POLL_INTERVAL = 0.02
+
+
+def make_tiff_header(width, height, dtype):
+    """
+    Returns the header and the first IFD of a little endian single strip uncompressed tiff, the pixels follow it
+    :param width:
+    :param height:
+    :param dtype: key of PIXEL_TYPES
+    :return: bytes
+    """
+    bits, sample_format = PIXEL_TYPES[dtype]
+    size = width * height * bits // 8
+
+    entries = [(256, 4, width), (257, 4, height), (258, 3, bits), (259, 3, 1), (262, 3, 1), (273, 4, 0),
+               (277, 3, 1), (278, 4, height), (279, 4, size), (339, 3, sample_format)]
+
+    ifd_size = 2 + len(entries) * 12 + 4
+    data_offset = 8 + ifd_size
+
+    res = [b"II", struct.pack("<HI", 42, 8), struct.pack("<H", len(entries))]
+    for (tag, ftype, value) in entries:
+        if tag == 273:
+            value = data_offset
+        if ftype == 3:
+            res.append(struct.pack("<HHIHH", tag, ftype, 1, value, 0))
+        else:
+            res.append(struct.pack("<HHII", tag, ftype, 1, value))
+    res.append(struct.pack("<I", 0))
+    return b"".join(res)
+
+
+def read_template(filename):
+    with open(filename, "r") as fh:
+        return fh.read().splitlines()
+
+
+def format_metadata(template, values):
+    """
+    Replaces the values of the [metadata] keys in a template
+    :param template: list of lines
+    :param values: dictionary
+    :return: text
+    """
+    res = []
+    for line in template:
+        key = line.split("=", 1)[0]
+        if "=" in line and key in values:
+            line = "{}={}".format(key, values[key])
+        res.append(line)
+    return "\n".join(res) + "\n"
+
+
+class FrameGenerator(object):
+    """
+    Writes the frames the way QXRD does - the tif first, its .metadata afterwards, darks every dark_every frames
+    """
+    def __init__(self, raw_dir, width=2048, height=2048, dtype="float32", dark_every=10, prefix="Bench"):
+        self.raw_dir = raw_dir
+        self.width, self.height = width, height
+        self.dtype = dtype
+        self.dark_every = dark_every
+        self.prefix = prefix
+
+        self.header = make_tiff_header(width, height, dtype)
+
+        rnd = numpy.random.RandomState(0)
+        self.blocks = []
+        for i in range(PIXEL_BLOCKS):
+            data = rnd.poisson(1000., size=(height, width)).astype(dtype)
+            self.blocks.append(data.tobytes())
+
+        self.template_frame = read_template(TEMPLATE_FRAME)
+        self.template_dark = read_template(TEMPLATE_DARK)
+
+        # frame name - time of the completed write
+        self.written = {}
+        self.darks = 0
+
+    def write(self, index, dark=False):
+        """
+        Writes a frame and its metadata
+        :param index:
+        :param dark:
+        :return: name of the tif file
+        """
+        name = "{}-{:05d}{}.tif".format(self.prefix, index, ".dark" if dark else "")
+        fn = os.path.join(self.raw_dir, name)
+
+        with open(fn, "wb") as fh:
+            fh.write(self.header)
+            fh.write(self.blocks[index % len(self.blocks)])
+
+        now = time.time()
+        values = {"width": self.width, "height": self.height, "fileBase": name, "title": name,
+                  "fileName": fn.replace(os.sep, "/"), "imageNumber": -1 if dark else index,
+                  "dateString": time.strftime("%Y.%m.%d : %H:%M:%S", time.localtime(now)) + ".{:03d}".format(
+                      int(now * 1000) % 1000)}
+
+        with open("{}.metadata".format(fn), "w") as fh:
+            fh.write(format_metadata(self.template_dark if dark else self.template_frame, values))
+
+        if dark:
+            self.darks += 1
+        else:
+            self.written[name] = time.time()
+        return name
+
+    def run(self, frames, rate, stop_event=None):
+        """
+        Writes frames at a constant rate - deadlines do not drift with the write time
+        :param frames:
+        :param rate: frames/s, 0 - as fast as possible
+        :param stop_event:
+        :return:
+        """
+        period = 1. / rate if rate > 0 else 0.
+        start = time.time()
+        for index in range(1, frames + 1):
+            if stop_event is not None and stop_event.is_set():
+                break
+
+            delay = start + (index - 1) * period - time.time()
+            if delay > 0:
+                time.sleep(delay)
+
+            if self.dark_every > 0 and index % self.dark_every == 1:
+                self.write(index, dark=True)
+            self.write(index)
+
+
+def get_usage():
+    """
+    Returns the cpu time of the process and its children and the peak resident size
+    :return: (user s, system s, peak rss MB)
+    """
+    import resource
+
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+
+    # kB on linux
+    rss = max(own.ru_maxrss, children.ru_maxrss) / 1024.
+    return own.ru_utime + children.ru_utime, own.ru_stime + children.ru_stime, rss
+
+
+def get_revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=os.path.dirname(
+            os.path.abspath(__file__))).decode("ascii").strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def percentiles(values, points=(50, 90, 99)):
+    if len(values) == 0:
+        return dict([("p{}".format(p), None) for p in points])
+    values = numpy.asarray(values)
+    return dict([("p{}".format(p), float(numpy.percentile(values, p))) for p in points])
+
+
+def run_benchmark(root, frames, rate, maxproc, width, height, dtype, dark_every, timeout, checksum=False):
+    """
+    Runs the daemon on a fresh set of directories under root - called in a separate process per run,
+    the metrics, pools and resource usage do not leak between the runs
+    :return: dictionary of the results
+    """
+    work = tempfile.mkdtemp(prefix="pewatch_bench_", dir=root)
+    dirs = dict([(name, os.path.join(work, name)) for name in ("raw", "temp", "proc", "output")])
+    for path in dirs.values():
+        os.makedirs(path)
+
+    # the configuration, the journal and the frame index of the installation are not touched
+    config.CONFIG_INI = os.path.join(work, "config.ini")
+    config.JOURNAL_FILE = os.path.join(work, "journal.db")
+    config.INDEX_FILE = os.path.join(work, "frames.db")
+    config.COPY_CHECKSUM = checksum
+
+    from app.daemon import Daemon
+    from app.metrics import get_stats
+
+    daemon = Daemon()
+    daemon.RAW_DIR, daemon.TEMP_DIR, daemon.PROC_DIR = dirs["raw"], dirs["temp"], dirs["proc"]
+    daemon.OUTPUT_ROOT, daemon.OUTPUT_DIR = dirs["output"], ""
+    daemon.MAXPROC = maxproc
+
+    generator = FrameGenerator(dirs["raw"], width=width, height=height, dtype=dtype, dark_every=dark_every)
+
+    usage_start = get_usage()
+    timestamp = time.time()
+
+    th_daemon = threading.Thread(target=daemon.start, name="bench_daemon")
+    th_daemon.setDaemon(True)
+    th_daemon.start()
+
+    stop_event = threading.Event()
+    th_generator = threading.Thread(target=generator.run, args=(frames, rate, stop_event), name="bench_generator")
+    th_generator.setDaemon(True)
+    th_generator.start()
+
+    # frame name - time of its appearance in the output
+    arrived = {}
+    deadline = timestamp + timeout
+    while len(arrived) < frames and time.time() < deadline:
+        for fn in glob.glob(os.path.join(dirs["output"], "*.tif")):
+            name = os.path.basename(fn)
+            if name not in arrived and not name.endswith(".dark.tif"):
+                arrived[name] = time.time()
+        time.sleep(POLL_INTERVAL)
+
+    elapsed = time.time() - timestamp
+    stop_event.set()
+    daemon.stop()
+    th_daemon.join(5.)
+    th_generator.join(5.)
+
+    usage_end = get_usage()
+
+    latencies = [arrived[name] - generator.written[name] for name in arrived if name in generator.written]
+    last = max(arrived.values()) if len(arrived) > 0 else time.time()
+
+    res = {"parameters": {"frames": frames, "rate": rate, "maxproc": maxproc, "width": width, "height": height,
+                          "dtype": dtype, "dark_every": dark_every, "timeout": timeout, "checksum": checksum},
+           "frames_written": len(generator.written), "darks_written": generator.darks,
+           "frames_finalized": len(arrived), "darks_left": len(glob.glob(os.path.join(dirs["output"], "*dark*"))),
+           "elapsed": elapsed, "fps": len(arrived) / (last - timestamp) if last > timestamp else 0.,
+           "mbps": len(arrived) * len(generator.blocks[0]) / 1e6 / (last - timestamp) if last > timestamp else 0.,
+           "latency": percentiles(latencies), "stages": get_stats(),
+           "cpu_user": usage_end[0] - usage_start[0], "cpu_system": usage_end[1] - usage_start[1],
+           "peak_rss_mb": usage_end[2]}
+
+    shutil.rmtree(work, ignore_errors=True)
+    return res
+
+
+def _run_process(queue, *args):
+    try:
+        queue.put(run_benchmark(*args))
+    except Exception as e:
+        queue.put({"error": "{}: {}".format(type(e).__name__, e)})
+
+
+def run_isolated(*args):
+    """
+    Runs a benchmark in a child process
+    :param args: arguments of run_benchmark
+    :return: dictionary of the results
+    """
+    queue = multiprocessing.Queue()
+    proc = multiprocessing.Process(target=_run_process, args=(queue,) + args)
+    proc.start()
+    res = queue.get()
+    proc.join()
+    return res
+
+
+def main():
+    parser = argparse.ArgumentParser(description="End-to-end benchmark of the plugin chain")
+    parser.add_argument("--frames", type=int, default=100, help="number of frames")
+    parser.add_argument("--rate", type=float, default=10., help="frames per second, 0 - as fast as possible")
+    parser.add_argument("--maxproc", default="5", help="comma separated MaxProc values, one run per value")
+    parser.add_argument("--size", type=int, default=2048, help="width and height of the frames")
+    parser.add_argument("--dtype", default="float32", choices=sorted(PIXEL_TYPES.keys()))
+    parser.add_argument("--dark-every", type=int, default=10, help="a dark file every N frames, 0 - no darks")
+    parser.add_argument("--root", default="/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir(),
+                        help="tmpfs directory holding the raw, temporary, processed and output directories")
+    parser.add_argument("--timeout", type=float, default=300., help="maximum time of a run (s)")
+    parser.add_argument("--output", default=None, help="JSON file of the results, stdout by default")
+    parser.add_argument("--checksum", action="store_true",
+                        help="checksums of the finalize copies - the kernel copy is not used")
+    args = parser.parse_args()
+
+    results = {"revision": get_revision(), "python": sys.version.split()[0], "platform": platform.platform(),
+               "config": {"DAEMON_PIPELINE": config.DAEMON_PIPELINE, "DAEMON_SPOOL": config.DAEMON_SPOOL,
+                          "MERGE_MODE": config.MERGE_MODE, "RAW_BATCH_SIZE": config.RAW_BATCH_SIZE,
+                          "NEXUS_DATA_MODE": config.NEXUS_DATA_MODE, "NEXUS_MASTER": config.NEXUS_MASTER,
+                          "COPY_CHECKSUM": args.checksum},
+               "runs": []}
+
+    for maxproc in [int(value) for value in args.maxproc.split(",")]:
+        res = run_isolated(args.root, args.frames, args.rate, maxproc, args.size, args.size, args.dtype,
+                            args.dark_every, args.timeout, args.checksum)
+        results["runs"].append(res)
+        if "error" in res:
+            sys.stderr.write("maxproc {}: {}\n".format(maxproc, res["error"]))
+        else:
+            sys.stderr.write("maxproc {}: {}/{} frames, {:.2f} frames/s, latency p50 {}\n".format(
+                maxproc, res["frames_finalized"], res["frames_written"], res["fps"], res["latency"]["p50"]))
+
+    text = json.dumps(results, indent=1, sort_keys=True)
+    if args.output is None:
+        print(text)
+    else:
+        with open(args.output, "w") as fh:
+            fh.write(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,169 @@
+__author__ = 'Konstantin Glazyrin'
+
+"""
+Batched memcached values against a fake client - neither a memcached server nor the memcache package is needed
+The module is loaded by its path, the package of the plugins uses the python v2 relative imports
+python -m unittest discover -s tests
+"""
+
+import os
+import sys
+import types
+import threading
+import unittest
+
+PLUGINS_COMMON = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                              "app", "plugins", "plugins_common")
+
+
+def load_source(name, path):
+    try:
+        from importlib.util import spec_from_file_location, module_from_spec
+    except ImportError:
+        # python v2
+        import imp
+        return imp.load_source(name, path)
+
+    spec = spec_from_file_location(name, path)
+    module = module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def load_memcached():
+    """
+    Loads plugin_memcached with a memcache stub and the configuration of the plugins as its config module
+    :return:
+    """
+    saved = dict([(name, sys.modules.get(name)) for name in ("memcache", "config")])
+    try:
+        sys.modules["memcache"] = types.ModuleType("memcache")
+        sys.modules["config"] = load_source("plugins_common_config", os.path.join(PLUGINS_COMMON, "config.py"))
+        return load_source("plugin_memcached_test", os.path.join(PLUGINS_COMMON, "plugin_memcached.py"))
+    finally:
+        for (name, module) in saved.items():
+            if module is None:
+                sys.modules.pop(name, None)
+            else:
+                sys.modules[name] = module
+
+
+plugin_memcached = load_memcached()
+
+
+class FakeClient(object):
+    """
+    Stores the values of all the clients in one dictionary, counts the round trips
+    """
+    store = {}
+    calls = []
+
+    def __init__(self, servers, debug=0):
+        self.servers = servers
+
+    def set_multi(self, values):
+        FakeClient.calls.append(("set_multi", sorted(values.keys())))
+        FakeClient.store.update(values)
+        return []
+
+    def get_multi(self, keys):
+        FakeClient.calls.append(("get_multi", sorted(keys)))
+        return dict([(key, FakeClient.store[key]) for key in keys if key in FakeClient.store])
+
+    def append(self, key, value):
+        FakeClient.calls.append(("append", key))
+        FakeClient.store[key] = FakeClient.store.get(key, "") + value
+
+    def disconnect_all(self):
+        FakeClient.calls.append(("disconnect_all", None))
+
+
+class FakeMemcache(object):
+    Client = FakeClient
+
+
+class MemcachedTest(unittest.TestCase):
+    def setUp(self):
+        FakeClient.store, FakeClient.calls = {}, []
+
+        self.memcache, self.interval = plugin_memcached.memcache, plugin_memcached.MEMCACHED_FLUSH_INTERVAL
+        plugin_memcached.memcache = FakeMemcache
+        plugin_memcached.close_memcached()
+
+    def tearDown(self):
+        plugin_memcached.close_memcached()
+        plugin_memcached.memcache, plugin_memcached.MEMCACHED_FLUSH_INTERVAL = self.memcache, self.interval
+
+    def test_set_get_multi(self):
+        plugin_memcached.MEMCACHED_FLUSH_INTERVAL = 0.
+        plugin_memcached.set_multi({"a": "1", "b": "2"})
+
+        self.assertEqual(FakeClient.calls, [("set_multi", ["a", "b"])])
+        self.assertEqual(plugin_memcached.get_multi(["a", "b", "c"]), {"a": "1", "b": "2"})
+        self.assertEqual(plugin_memcached.get_key("b"), "2")
+
+    def test_pending_flush(self):
+        plugin_memcached.MEMCACHED_FLUSH_INTERVAL = 60.
+        plugin_memcached.set_multi({"a": "1"})
+        plugin_memcached.set_key("b", "2")
+
+        # the values wait for the flush, the readers see them already
+        self.assertEqual(FakeClient.store, {})
+        self.assertEqual(plugin_memcached.get_multi(["a", "b"]), {"a": "1", "b": "2"})
+
+        # one round trip on stop, the clients are disconnected
+        plugin_memcached.close_memcached()
+        self.assertEqual(FakeClient.store, {"a": "1", "b": "2"})
+        self.assertEqual([el for el in FakeClient.calls if el[0] != "get_multi"],
+                         [("set_multi", ["a", "b"]), ("disconnect_all", None)])
+
+    def test_inflight_values(self):
+        plugin_memcached.MEMCACHED_FLUSH_INTERVAL = 60.
+        plugin_memcached.set_key("a", "1")
+
+        # the send of the flush is held until the value has been read
+        sending, read = threading.Event(), threading.Event()
+
+        def set_multi(client, values):
+            sending.set()
+            read.wait(5.)
+            return FakeClient.set_multi(client, values)
+
+        client = FakeClient(None)
+        client.set_multi = types.MethodType(set_multi, client)
+        plugin_memcached.get_client_pool()._clients.put(client)
+        plugin_memcached.get_client_pool()._created = plugin_memcached.get_client_pool().size
+
+        th = threading.Thread(target=plugin_memcached.flush)
+        th.start()
+        self.assertTrue(sending.wait(5.))
+
+        pool, plugin_memcached._POOL = plugin_memcached._POOL, plugin_memcached.ClientPool()
+        try:
+            self.assertEqual(plugin_memcached.get_key("a"), "1")
+        finally:
+            plugin_memcached._POOL = pool
+            read.set()
+            th.join()
+
+        self.assertEqual(FakeClient.store, {"a": "1"})
+        self.assertEqual(plugin_memcached._INFLIGHT, {})
+
+    def test_append_flushes_first(self):
+        plugin_memcached.MEMCACHED_FLUSH_INTERVAL = 60.
+        plugin_memcached.set_key("a", "1")
+        plugin_memcached.append_key("a", "2")
+
+        self.assertEqual(FakeClient.store, {"a": "12"})
+
+    def test_pool_size(self):
+        pool = plugin_memcached.ClientPool(size=1)
+        with pool.client() as mc:
+            self.assertTrue(isinstance(mc, FakeClient))
+        with pool.client() as other:
+            self.assertTrue(other is mc)
+        self.assertEqual(pool._created, 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,49 @@
+__author__ = 'Konstantin Glazyrin'
+
+"""
+Thread pools - a stopped pool refuses the tasks instead of blocking the caller
+python -m unittest discover -s tests
+"""
+
+import time
+import unittest
+
+from app.pool import ThreadPool
+
+
+def square(value, offset=0):
+    return value * value + offset
+
+
+class ThreadPoolTest(unittest.TestCase):
+    def setUp(self):
+        self.pool = ThreadPool("test", size=2)
+
+    def tearDown(self):
+        # the idle threads exit within IDLE_TIMEOUT
+        self.pool.shutdown()
+        timestamp = time.time()
+        while self.pool.threads and time.time() - timestamp < 5.:
+            time.sleep(0.05)
+
+    def test_map(self):
+        self.assertEqual(self.pool.map(square, range(5), 1), [1, 2, 5, 10, 17])
+        self.assertEqual(self.pool.map(square, []), [])
+
+    def test_resize_zero(self):
+        # the pool keeps at least one thread
+        self.pool.resize(0)
+        self.assertEqual(self.pool.size, 1)
+        self.assertEqual(self.pool.map(square, range(3)), [0, 1, 4])
+
+    def test_shutdown(self):
+        self.pool.shutdown()
+        self.assertRaises(RuntimeError, self.pool.map, square, range(3))
+
+        # a resized pool runs again
+        self.pool.resize(1)
+        self.assertEqual(self.pool.map(square, range(3)), [0, 1, 4])
+
+
+if __name__ == "__main__":
+    unittest.main()
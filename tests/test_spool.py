@@ -0,0 +1,87 @@
+__author__ = 'Konstantin Glazyrin'
+
+"""
+Concurrency of the write-behind spool - the boost under the RAM disk pressure raises the number of concurrent copies
+python -m unittest discover -s tests
+"""
+
+import time
+import threading
+import unittest
+
+from app.config import SPOOL_BOOST_FACTOR
+from app.spool import Spool
+
+
+class FakeCopy(object):
+    """
+    Copy of a folder blocking until it is released, counts the copies running at once
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.release = threading.Event()
+        self.running, self.peak, self.done = 0, 0, 0
+
+    def __call__(self, path, t=None):
+        with self.lock:
+            self.running += 1
+            self.peak = max(self.peak, self.running)
+        self.release.wait(5.)
+        with self.lock:
+            self.running -= 1
+            self.done += 1
+        return 0
+
+    def wait_running(self, count, timeout=2.):
+        timestamp = time.time()
+        while time.time() - timestamp < timeout:
+            with self.lock:
+                if self.running >= count:
+                    break
+            time.sleep(0.01)
+        with self.lock:
+            return self.running
+
+
+class SpoolTest(unittest.TestCase):
+    FOLDERS = 12
+
+    def setUp(self):
+        self.spool = Spool(workers=2)
+        self.copy = FakeCopy()
+
+    def tearDown(self):
+        self.copy.release.set()
+        self.spool.stop()
+
+    def test_boost(self):
+        for i in range(self.FOLDERS):
+            self.spool.submit("folder_{}.lock".format(i), self.copy)
+
+        limit = self.spool.get_info()["limit"]
+        self.assertEqual(self.copy.wait_running(limit), limit)
+
+        # the other folders wait for the running copies
+        time.sleep(0.2)
+        self.assertEqual(self.copy.peak, limit)
+
+        self.spool.set_boost(True)
+        boosted = int(2 * SPOOL_BOOST_FACTOR)
+        self.assertEqual(self.spool.get_info()["limit"], boosted)
+        self.assertEqual(self.copy.wait_running(boosted), boosted)
+        self.assertTrue(boosted > limit)
+
+        self.copy.release.set()
+        timestamp = time.time()
+        while self.copy.done < self.FOLDERS and time.time() - timestamp < 5.:
+            time.sleep(0.01)
+        self.assertEqual(self.copy.done, self.FOLDERS)
+
+    def test_boost_off(self):
+        self.spool.set_boost(True)
+        self.spool.set_boost(False)
+        self.assertEqual(self.spool.get_info()["limit"], 2)
+
+
+if __name__ == "__main__":
+    unittest.main()